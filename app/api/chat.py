@@ -1,13 +1,23 @@
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import StreamingResponse
-from app.schemas.chat import ChatRequest
-from app.services.dify_service import dify_stream_generator, get_api_key, dify_discuss_stream_generator
-from app.core.config import DIFY_KEYS
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException, Request, WebSocket
+from app.schemas.chat import ChatRequest, MultiTalkRequest
+from app.services.dify_service import DifyRun, dify_stream_generator, pick_backend, dify_discuss_stream_generator
+from app.services.stream_guard import guard_disconnect
+from app.services.multi_talk import TalkTargetRun, dify_multi_stream_generator
+from app.services.ws_session import ChatSession
+from app.services.stream_hub import StreamGone, stream_hub
+from app.services.admission import POOL_INTERACTIVE, POOL_WORKFLOW, admission, hold_lease
+from app.services.response_cache import response_cache, make_cache_key
+from app.services.transcript_store import transcript_store
+from app.core.config import settings
+from app.core.resilience import raise_if_open
+from app.core.sse import sse_response
 
 router = APIRouter()
 
 @router.post("/n1-talk")
-async def n1_talk_endpoint(request: ChatRequest):
+async def n1_talk_endpoint(request: ChatRequest, http_request: Request):
     """
     Khởi tạo cuộc hội thoại 1-1 với một nhân vật AI cụ thể (N1).
     Hỗ trợ đa chế độ (Response, Search, Thinking) đối với nhân vật Tech Director.
@@ -30,6 +40,13 @@ async def n1_talk_endpoint(request: ChatRequest):
     - **Stream (text/event-stream)**: Dữ liệu trả về dạng Server-Sent Events (SSE).
         - Event `message`: Chứa text câu trả lời (`data: {"text": "..."}`).
         - Event `message_end`: Chứa `conversation_id` khi kết thúc.
+        - Mỗi frame có `id:` tăng dần; header `X-Stream-Id` dùng để nối lại stream
+          qua `GET /api/streams/{stream_id}` khi rớt mạng.
+        - Dòng bắt đầu bằng `:` là comment SSE (`: ok` ngay khi mở stream, `: keep-alive` khi chờ lâu),
+          client bỏ qua. Stream vẫn kết thúc bằng `data: [DONE]`.
+    - Header `X-Cache`: `HIT` nếu câu trả lời được phát lại từ cache (chỉ áp dụng khi
+      `conversation_id` rỗng và bật `N1_TALK_CACHE_ENABLED`). Khi HIT, `conversation_id`
+      trả về là chuỗi rỗng và có thêm `"cached": true`.
 
     **Example Body:**
     ```json
@@ -44,12 +61,17 @@ async def n1_talk_endpoint(request: ChatRequest):
 
     **Raises:**
     - **400 Bad Request**: Nếu không tìm thấy cấu hình API Key cho Persona/Mode yêu cầu.
+    - **429 Too Many Requests**: User gửi quá nhiều request (xem header `Retry-After`).
+    - **503 Service Unavailable**: Hết slot xử lý cho persona / mode này, hoặc app Dify của
+      persona / mode đang bị ngắt mạch do lỗi liên tiếp (xem header `Retry-After`).
     - **500 Internal Server Error**: Lỗi kết nối đến Dify hoặc lỗi hệ thống.
     """
-    target_key = get_api_key(request.target_persona, request.mode)
-    
-    if not target_key:
+    # Hội thoại cũ về đúng backend Dify đã tạo ra nó, hội thoại mới theo DIFY_ROUTING
+    backend = await pick_backend(request.target_persona, request.mode, request.conversation_id)
+
+    if not backend:
         raise HTTPException(status_code=400, detail=f"Cấu hình lỗi cho {request.target_persona}")
+    target_key = backend.api_key
 
     payload = {
         "inputs": request.inputs or {},
@@ -60,11 +82,128 @@ async def n1_talk_endpoint(request: ChatRequest):
         "auto_generate_name": False
     }
 
-    return StreamingResponse(dify_stream_generator(payload, target_key), media_type="text/event-stream")
+    # Query stateless (không có conversation_id) -> thử phát lại từ cache
+    use_cache = settings.N1_TALK_CACHE_ENABLED and not request.conversation_id
+    if use_cache:
+        cache_key = make_cache_key(request.target_persona, request.mode, request.query, request.inputs)
+        frames = response_cache.get(cache_key)
+        if frames is not None:
+            return sse_response(response_cache.replay(frames), headers={"X-Cache": "HIT"})
+
+    # Dify đang lỗi liên tục -> trả 503 ngay, không giữ slot / không chờ timeout
+    raise_if_open(backend.breaker)
+
+    # Xin slot xử lý (rate limit theo user + giới hạn đồng thời theo persona / mode)
+    lease = await admission.admit(request.user_id, POOL_INTERACTIVE, request.target_persona, request.mode)
+
+    # Run chạy độc lập với kết nối: client rớt mạng có thể nối lại, quá STREAM_DETACH_GRACE mới stop trên Dify
+    run = DifyRun(target_key, request.user_id, kind="chat", persona=request.target_persona, mode=request.mode, backend=backend)
+    upstream = hold_lease(dify_stream_generator(payload, target_key, run), lease)
+    headers = {}
+    if use_cache:
+        upstream = response_cache.record(cache_key, upstream)
+        headers["X-Cache"] = "MISS"
+    broadcast = stream_hub.start(run, upstream)
+    headers["X-Stream-Id"] = broadcast.stream_id
+
+    return sse_response(guard_disconnect(http_request, broadcast.subscribe()), headers=headers)
+
+
+@router.post("/n1-talk/multi")
+async def n1_talk_multi_endpoint(request: MultiTalkRequest, http_request: Request):
+    """
+    Hỏi cùng một câu cho nhiều nhân vật AI cùng lúc, trả về trong **một** stream SSE.
+    Các persona chạy song song: persona chậm không làm trễ câu trả lời của persona khác,
+    persona lỗi chỉ nhận event `error` riêng, các persona còn lại vẫn chạy tiếp.
+
+    **Parameters:**
+    - **query** (str): Câu hỏi chung.
+    - **user_id** (str): ID định danh người dùng.
+    - **targets** (list): Danh sách persona, mỗi phần tử gồm `persona`, `mode` (mặc định `response`)
+      và `conversation_id` (optional, hội thoại cũ của riêng persona đó). Tối đa `MULTI_TALK_MAX_TARGETS`.
+
+    **Returns:**
+    - **Stream (text/event-stream)**: `data: {"bot_id": ..., "event": ..., "payload": ...}` giống `/discuss`,
+      các persona xen kẽ nhau theo thứ tự text về tới server.
+        - `bot_id`: tên persona (vd. `TECH`); nếu một persona xuất hiện nhiều lần với mode khác nhau thì là `TECH:search`.
+        - Event `start`: persona bắt đầu.
+        - Event `content`: một đoạn text câu trả lời.
+        - Event `error`: lỗi của riêng persona này.
+        - Event `done`: persona kết thúc, payload `{"status": "completed" | "error", "conversation_id": ...}`.
+    - Kết thúc bằng `data: [DONE]` sau khi mọi persona đã `done`.
+
+    **Example Body:**
+    ```json
+    {
+      "query": "Có nên đầu tư vào AI Agent năm nay?",
+      "user_id": "user_123",
+      "targets": [
+        {"persona": "CEO"},
+        {"persona": "TECH", "mode": "search"}
+      ]
+    }
+    ```
+
+    **Raises:**
+    - **400 Bad Request**: Danh sách `targets` quá dài, bị trùng, hoặc không có API Key cho một Persona/Mode.
+    - **429 Too Many Requests**: User gửi quá nhiều request (mỗi persona tính như một request).
+    - **503 Service Unavailable**: Hết slot xử lý cho một trong các persona / mode (xem header `Retry-After`).
+    """
+    if len(request.targets) > settings.MULTI_TALK_MAX_TARGETS:
+        raise HTTPException(status_code=400, detail=f"Tối đa {settings.MULTI_TALK_MAX_TARGETS} persona mỗi request")
+
+    pairs = [(t.persona, t.mode) for t in request.targets]
+    if len(set(pairs)) != len(pairs):
+        raise HTTPException(status_code=400, detail="Danh sách persona bị trùng")
+
+    backends = []
+    for target in request.targets:
+        backend = await pick_backend(target.persona, target.mode, target.conversation_id)
+        if not backend:
+            raise HTTPException(status_code=400, detail=f"Cấu hình lỗi cho {target.persona}")
+        backends.append(backend)
+
+    # Breaker đang mở không chặn cả request: persona đó nhận event `error`, các persona khác vẫn chạy
+    personas = [t.persona for t in request.targets]
+    runs = []
+    try:
+        for target, backend in zip(request.targets, backends):
+            lease = await admission.admit(request.user_id, POOL_INTERACTIVE, target.persona, target.mode)
+            bot_id = target.persona if personas.count(target.persona) == 1 else f"{target.persona}:{target.mode}"
+            payload = {
+                "inputs": request.inputs or {},
+                "query": request.query,
+                "response_mode": "streaming",
+                "conversation_id": target.conversation_id,
+                "user": request.user_id,
+                "auto_generate_name": False
+            }
+            run = DifyRun(backend.api_key, request.user_id, kind="multi", persona=target.persona, mode=target.mode, backend=backend)
+            runs.append(TalkTargetRun(bot_id, payload, backend.api_key, run, lease))
+    except HTTPException:
+        # Không xin đủ slot -> trả lại các slot đã lấy
+        for target_run in runs:
+            target_run.lease.release()
+        raise
+
+    # Không qua ring buffer (không resume), nhưng vẫn được đếm vào metric stream + drain khi tắt server
+    stream = stream_hub.track("multi", dify_multi_stream_generator(runs), runs=len(runs))
+    return sse_response(guard_disconnect(http_request, stream))
+
+
+@router.get("/n1-talk/cache-stats")
+async def n1_talk_cache_stats():
+    """
+    Thống kê cache câu trả lời của `/n1-talk` (hit / miss, số entry, dung lượng).
+    """
+    return {
+        "status": "success",
+        "data": response_cache.stats()
+    }
 
 
 @router.post("/discuss")
-async def discuss_endpoint(request: ChatRequest):
+async def discuss_endpoint(request: ChatRequest, http_request: Request):
     """
     Kích hoạt phiên thảo luận nhóm giữa 3 AI (CEO, Business, Tech).
     Dựa trên mô hình 'N1s Discussion Insight Model' để tự động sinh ra kịch bản tranh luận và tổng hợp Insight.
@@ -76,8 +215,20 @@ async def discuss_endpoint(request: ChatRequest):
     - **query** (str): Chủ đề cần thảo luận.
     - **user_id** (str): ID định danh người dùng.
     - **conversation_id** (str, optional): ID cuộc hội thoại cũ.
+    - **auto_report** (bool, optional): `true` để backend tự tạo report Gamma từ Insight ngay khi
+      node `Answer Summary` kết thúc (không cần gọi `/create-report`).
 
     **Returns:**
+    - **Stream (text/event-stream)**: `data: {"bot_id": ..., "event": ..., "payload": ...}`.
+        - Với `bot_id` = `Insight`: event `delta` gửi từng section (`summary`, `highlights`,
+          `reference_links`) ngay khi section đó hoàn chỉnh; event `content` gửi object đầy đủ khi node kết thúc.
+        - Với `auto_report`: `bot_id` = `Report`, event `start` khi bắt đầu tạo report, event `content`
+          trước `[DONE]` với payload `{"generation_id", "status", "deduplicated"}` (hoặc `{"error": ...}`).
+          Theo dõi tiến độ qua `/api/status/{generation_id}` hoặc `/api/status/{generation_id}/events`.
+    - Header `X-Discussion-Id`: ID phiên thảo luận đã lưu (transcript từng bot + Insight), gửi vào
+      `/api/create-report` bằng `discussion_id` thay vì upload lại toàn bộ nội dung.
+    - Khi bật `DISCUSS_SINGLE_FLIGHT_ENABLED`: header `X-Single-Flight` = `LEAD` (tạo run) hoặc `JOIN`
+      (dùng chung run đang chạy cùng chủ đề). Người `JOIN` không nhận `X-Discussion-Id` / `conversation_id`.
     - **Document link:**: https://docs.google.com/document/d/1NCoiHu5sPlAyExVqZJTJ_riaXdTc_5b9vX7AGYSjIzQ/edit?usp=sharing
 
     **Example Body:**
@@ -90,12 +241,16 @@ async def discuss_endpoint(request: ChatRequest):
     ```
 
     **Raises:**
+    - **429 Too Many Requests**: User gửi quá nhiều request (xem header `Retry-After`).
+    - **503 Service Unavailable**: Hết slot cho workflow thảo luận, hoặc app Dify thảo luận
+      đang bị ngắt mạch (xem header `Retry-After`).
     - **500 Internal Server Error**: Chưa cấu hình `DIFY_KEY_DISCUSS` trong file môi trường (.env).
     """
-    discuss_key = DIFY_KEYS["DISCUSS"].get("default")
-    
-    if not discuss_key:
+    backend = await pick_backend("DISCUSS", "default", request.conversation_id)
+
+    if not backend:
         raise HTTPException(status_code=500, detail="Chưa cấu hình DIFY_KEY_DISCUSS")
+    discuss_key = backend.api_key
 
     payload = {
         "inputs": request.inputs or {},
@@ -106,5 +261,110 @@ async def discuss_endpoint(request: ChatRequest):
         "auto_generate_name": False
     }
 
+    # Cùng chủ đề (conversation_id rỗng, cùng query + inputs) đang được thảo luận -> dùng chung run đó.
+    # Run auto_report không gộp: report Gamma thuộc về người tạo run.
+    flight_key = None
+    if settings.DISCUSS_SINGLE_FLIGHT_ENABLED and not request.conversation_id and not request.auto_report:
+        flight_key = make_cache_key(
+            "DISCUSS", None, request.query, request.inputs,
+            request.user_id if settings.DISCUSS_SINGLE_FLIGHT_PER_USER else None,
+        )
+        broadcast = stream_hub.join(flight_key)
+        if broadcast is not None:
+            # Không tốn slot upstream, chỉ áp rate limit theo user.
+            # Người join không nhận conversation_id / transcript (X-Discussion-Id) của người tạo run
+            await admission.check_rate(request.user_id)
+            headers = {"X-Stream-Id": broadcast.stream_id, "X-Single-Flight": "JOIN"}
+            return sse_response(guard_disconnect(http_request, broadcast.subscribe(scrub=True)), headers=headers)
+
+    raise_if_open(backend.breaker)
+
+    # Workflow dài dùng pool riêng, không tranh slot với chat ngắn
+    lease = await admission.admit(request.user_id, POOL_WORKFLOW, "DISCUSS")
+
+    # Workflow thảo luận chạy tới 300s: rớt mạng thì nối lại được, đóng tab hẳn thì huỷ trên Dify sau grace period
+    run = DifyRun(discuss_key, request.user_id, kind="discuss", persona="DISCUSS", backend=backend)
+    if settings.TRANSCRIPT_ENABLED:
+        run.recorder = transcript_store.recorder(request.user_id, request.query)
+    upstream = hold_lease(dify_discuss_stream_generator(payload, discuss_key, run, request.auto_report), lease)
+    broadcast = stream_hub.start(run, upstream, key=flight_key)
+
+    headers = {"X-Stream-Id": broadcast.stream_id}
+    if run.recorder is not None:
+        headers["X-Discussion-Id"] = run.recorder.discussion_id
+    if flight_key is not None:
+        headers["X-Single-Flight"] = "LEAD"
     # return StreamingResponse(dify_stream_generator(payload, discuss_key), media_type="text/event-stream")
-    return StreamingResponse(dify_discuss_stream_generator(payload, discuss_key), media_type="text/event-stream")
\ No newline at end of file
+    return sse_response(guard_disconnect(http_request, broadcast.subscribe()), headers=headers)
+
+
+@router.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket):
+    """
+    Kết nối WebSocket dùng chung cho cả phiên: gửi nhiều request `/n1-talk` / `/discuss` trên một kết nối,
+    nhiều request chạy song song và huỷ được từng request (không tốn preflight CORS + bắt tay TCP/TLS mỗi lượt).
+
+    **Client gửi (JSON text):**
+    - `{"type": "chat", "id": "r1", "query": ..., "user_id": ..., "target_persona": "TECH", "mode": "response", "conversation_id": ""}`
+    - `{"type": "discuss", "id": "r2", "query": ..., "user_id": ...}`
+    - `{"type": "cancel", "id": "r1"}`: huỷ request r1 (dừng cả task trên Dify).
+    - `{"type": "ping"}`
+
+    **Server gửi:** mọi message có dạng `{"id": ..., "type": ...}`
+    - `start`: request đã được nhận slot và bắt đầu gọi Dify (discuss: kèm `discussion_id`).
+    - `frame`: `data` giống hệt nội dung `data:` của SSE tương ứng (`{"text": ...}` với chat,
+      `{"bot_id", "event", "payload"}` với discuss).
+    - `done` / `cancelled`: request kết thúc.
+    - `error`: `status` + `detail` (+ `retry_after`) giống mã lỗi HTTP của endpoint tương ứng
+      (400, 409 id trùng, 422 sai body, 429, 503).
+    - `pong`
+
+    Tối đa `WS_MAX_INFLIGHT` request đồng thời mỗi kết nối. Client đọc chậm thì các stream bị tạm dừng;
+    không nhận message nào quá `WS_SEND_TIMEOUT` giây thì kết nối bị đóng (code 1008).
+    Cache `/n1-talk`, single-flight `/discuss` và resume không áp dụng qua WebSocket.
+    """
+    await ChatSession(websocket).serve()
+
+
+@router.get("/streams/{stream_id}")
+async def resume_stream(
+    stream_id: str,
+    http_request: Request,
+    last_event_id: Optional[str] = Header(None),
+    after: Optional[int] = None,
+):
+    """
+    Nối lại một stream `/n1-talk` hoặc `/discuss` đang chạy (hoặc vừa kết thúc) sau khi rớt mạng.
+
+    **Parameters:**
+    - **stream_id** (str): Giá trị header `X-Stream-Id` nhận được khi bắt đầu stream.
+    - Header **Last-Event-ID** (hoặc query `after`): `id` của frame cuối cùng client đã nhận.
+      Bỏ trống để đọc lại từ đầu.
+
+    **Returns:**
+    - **Stream (text/event-stream)**: Các frame sau `Last-Event-ID`, tiếp theo là phần đang stream (nếu run chưa xong).
+
+    **Raises:**
+    - **400 Bad Request**: `Last-Event-ID` không hợp lệ.
+    - **404 Not Found**: Stream không tồn tại hoặc đã hết hạn (`STREAM_RESUME_TTL`).
+    - **410 Gone**: Các frame cần đọc đã bị đẩy khỏi buffer, cần bắt đầu lại.
+    """
+    broadcast = stream_hub.get(stream_id)
+    if broadcast is None:
+        raise HTTPException(status_code=404, detail="Stream không tồn tại hoặc đã hết hạn")
+
+    if last_event_id is not None:
+        try:
+            after = int(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Last-Event-ID không hợp lệ")
+
+    try:
+        broadcast.check_resume(after)
+    except StreamGone:
+        raise HTTPException(status_code=410, detail="Dữ liệu stream đã bị xoá khỏi buffer, vui lòng bắt đầu lại")
+
+    stream_hub.resumed += 1
+    # Run single-flight có nhiều người đọc chung stream_id: không phát conversation_id khi nối lại
+    stream = broadcast.subscribe(after, scrub=broadcast.key is not None)
+    return sse_response(guard_disconnect(http_request, stream), headers={"X-Stream-Id": stream_id})
\ No newline at end of file
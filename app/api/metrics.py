@@ -0,0 +1,111 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from app.core.metrics import FunctionMetric, registry
+from app.core.resilience import breakers
+from app.core.sse_reader import upstream_sse_stats
+from app.services.admission import admission
+from app.services.dify_backends import dify_backends
+from app.services.report_dedupe import generation_store
+from app.services.response_cache import response_cache
+from app.services.stream_hub import stream_hub
+from app.services.transcript_store import transcript_store
+from app.services.ws_session import session_stats
+
+router = APIRouter()
+
+_BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+# Các bộ đếm có sẵn ở từng service, đọc lúc scrape (không tốn chi phí trên đường xử lý request)
+FunctionMetric(
+    "n1_sse_active_streams", "Số client đang đọc stream SSE",
+    lambda: {endpoint: subscribers for endpoint, (_, subscribers) in stream_hub.by_endpoint().items()},
+    ("endpoint",),
+)
+FunctionMetric(
+    "n1_dify_live_runs", "Số run Dify đang chạy (kể cả run đang chờ client nối lại)",
+    lambda: {endpoint: live for endpoint, (live, _) in stream_hub.by_endpoint().items()},
+    ("endpoint",),
+)
+FunctionMetric(
+    "n1_stream_buffer_bytes", "Tổng dung lượng ring buffer của các stream",
+    lambda: stream_hub.stats()["buffer_bytes"],
+)
+FunctionMetric(
+    "n1_stream_events_total", "Số lần tạo stream / nối lại / dùng chung run (single-flight)",
+    lambda: {(k,): stream_hub.stats()[k] for k in ("started", "resumed", "single_flight_joined")},
+    ("event",), type="counter",
+)
+FunctionMetric(
+    "n1_admission_in_use", "Số slot admission đang dùng theo pool / persona / mode",
+    lambda: admission.snapshot()["in_use"], ("key",),
+)
+FunctionMetric(
+    "n1_admission_waiting", "Số request đang chờ slot theo pool",
+    lambda: admission.snapshot()["waiting"], ("pool",),
+)
+FunctionMetric(
+    "n1_admission_decisions_total", "Kết quả admission",
+    lambda: {(k,): admission.snapshot()[k] for k in ("admitted", "rate_limited", "rejected_queue_full", "rejected_timeout")},
+    ("result",), type="counter",
+)
+FunctionMetric(
+    "n1_upstream_breaker_state", "Trạng thái circuit breaker (0 = closed, 1 = half_open, 2 = open)",
+    lambda: {name: _BREAKER_STATES[b["state"]] for name, b in breakers.snapshot().items()},
+    ("upstream",),
+)
+FunctionMetric(
+    "n1_upstream_calls_total", "Số lần gọi upstream theo kết quả ghi nhận bởi breaker",
+    lambda: {
+        (name, result): b[result]
+        for name, b in breakers.snapshot().items()
+        for result in ("successes", "failures", "rejected")
+    },
+    ("upstream", "result"), type="counter",
+)
+FunctionMetric(
+    "n1_dify_backend_outstanding", "Số stream đang chạy trên từng backend Dify",
+    lambda: {b.name: b.outstanding for b in dify_backends.backends()}, ("backend",),
+)
+FunctionMetric(
+    "n1_dify_backend_requests_total", "Số request đã gửi tới từng backend Dify",
+    lambda: {b.name: b.requests for b in dify_backends.backends()}, ("backend",), type="counter",
+)
+FunctionMetric(
+    "n1_upstream_sse_events_total", "Số event SSE đọc từ Dify theo cách xử lý",
+    lambda: {(k,): v for k, v in upstream_sse_stats.snapshot().items()},
+    ("kind",), type="counter",
+)
+FunctionMetric(
+    "n1_response_cache_requests_total", "Số lần tra cache /n1-talk",
+    lambda: {("hit",): response_cache.hits, ("miss",): response_cache.misses},
+    ("result",), type="counter",
+)
+FunctionMetric(
+    "n1_response_cache_bytes", "Dung lượng cache /n1-talk",
+    lambda: response_cache.stats()["bytes"],
+)
+FunctionMetric(
+    "n1_gamma_dedupe_lookups_total", "Số lần tra store dedupe generation Gamma",
+    lambda: {("hit",): generation_store.hits, ("miss",): generation_store.misses},
+    ("result",), type="counter",
+)
+FunctionMetric(
+    "n1_transcript_ops_total", "Số thao tác ghi transcript /discuss theo kết quả (dropped = hàng đợi đầy / lỗi ghi)",
+    lambda: {("written",): transcript_store.written, ("dropped",): transcript_store.dropped},
+    ("result",), type="counter",
+)
+FunctionMetric("n1_transcript_queue_depth", "Số thao tác transcript đang chờ ghi", lambda: transcript_store.stats()["queued"])
+FunctionMetric("n1_ws_sessions", "Số kết nối WebSocket /api/ws/chat đang mở", lambda: session_stats.sessions)
+FunctionMetric("n1_ws_requests_inflight", "Số request đang chạy qua WebSocket", lambda: session_stats.inflight)
+FunctionMetric(
+    "n1_ws_events_total", "Số request / huỷ / kết nối bị đóng do client đọc chậm qua WebSocket",
+    lambda: {(k,): getattr(session_stats, k) for k in ("requests", "cancelled", "slow_client_closed")},
+    ("event",), type="counter",
+)
+
+
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics():
+    """Metric cho Prometheus (text format 0.0.4)."""
+    await admission.refresh_usage()
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,107 @@
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse
+from app.core.profiling import profiler, verify_admin_token
+from app.core.resilience import breakers
+from app.services.admission import admission
+from app.services.dify_backends import dify_backends
+from app.services.stream_hub import stream_hub
+
+router = APIRouter()
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not profiler.enabled:
+        raise HTTPException(status_code=404, detail="Profiling chưa được bật (PROFILING_ADMIN_TOKEN)")
+    if not verify_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="X-Admin-Token không hợp lệ")
+
+
+@router.get("/ops/admission")
+async def admission_stats():
+    """
+    **Chức năng:** Xem trạng thái admission control (slot đang dùng theo pool / persona / mode,
+    số request đang chờ, số request bị từ chối do rate limit / quá tải).
+    """
+    return {
+        "status": "success",
+        "data": await admission.stats()
+    }
+
+
+@router.get("/ops/upstreams")
+async def upstream_stats():
+    """
+    **Chức năng:** Xem trạng thái circuit breaker của từng upstream (mỗi API key Dify theo
+    `persona/mode`, và Gamma): `closed` / `open` / `half_open`, số lỗi liên tiếp,
+    số request thành công / lỗi / bị từ chối do fail-fast.
+    """
+    return {
+        "status": "success",
+        "data": breakers.snapshot()
+    }
+
+
+@router.get("/ops/backends")
+async def backend_stats():
+    """
+    **Chức năng:** Xem pool backend Dify của từng persona / mode: số stream đang chạy (`outstanding`)
+    và tổng số request trên mỗi backend, trọng số, trạng thái breaker (backend `open` bị loại khỏi routing),
+    số hội thoại đang được gắn cố định vào backend.
+    """
+    return {
+        "status": "success",
+        "data": dify_backends.stats()
+    }
+
+
+@router.get("/ops/streams")
+async def stream_stats():
+    """
+    **Chức năng:** Xem các stream đang giữ để resume (số run đang chạy / đã xong,
+    số client đang đọc, dung lượng ring buffer, số lần client nối lại).
+    """
+    return {
+        "status": "success",
+        "data": stream_hub.stats()
+    }
+
+
+@router.get("/ops/profiles", dependencies=[Depends(require_admin)])
+async def list_profiles():
+    """
+    **Chức năng:** Danh sách báo cáo profiling gần nhất (cần header `X-Admin-Token`).
+
+    **Bật profiling cho một request:** gửi kèm `X-Profile: cpu` (hoặc `mem`, `cpu,mem`) và `X-Admin-Token`;
+    response có header `X-Profile-Id`. Ngoài ra: user trong `PROFILING_USERS`, hoặc lấy mẫu theo `PROFILING_SAMPLE_RATE`.
+    """
+    return {
+        "status": "success",
+        "data": {**profiler.stats(), "profiles": profiler.list()}
+    }
+
+
+@router.get("/ops/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+async def download_profile(profile_id: str, format: str = "json"):
+    """
+    **Chức năng:** Tải báo cáo profiling của một request (cần header `X-Admin-Token`).
+
+    **Định dạng:**
+    - `json` (mặc định): hot function (self / cumulative), độ trễ event loop, allocation (nếu profile `mem`).
+    - `collapsed`: stack dạng `a;b;c <số mẫu>` cho flamegraph.pl / speedscope.
+    """
+    profile = profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy profile (có thể đã bị xoá khỏi bộ nhớ)")
+    if format == "collapsed":
+        return PlainTextResponse(
+            profile.collapsed(),
+            headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.folded"'},
+        )
+    if format != "json":
+        raise HTTPException(status_code=400, detail="format phải là `json` hoặc `collapsed`")
+    return JSONResponse(
+        profile.report(),
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.json"'},
+    )
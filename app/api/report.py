@@ -1,6 +1,11 @@
-from fastapi import APIRouter
-from app.schemas.report import ReportRequest
-from app.services.gamma_service import create_gamma_presentation, get_generation_status
+import asyncio
+from fastapi import APIRouter, HTTPException, Query, Request
+from app.core.config import settings
+from app.core.sse import SSE_DONE, encode_frame, sse_response
+from app.schemas.report import BatchReportRequest, BatchStatusRequest, ReportRequest
+from app.services.gamma_service import create_gamma_presentation, create_gamma_presentations
+from app.services.gamma_tracker import GammaJob, gamma_tracker
+from app.services.stream_guard import guard_disconnect
 
 router = APIRouter()
 
@@ -11,12 +16,19 @@ async def create_report_endpoint(request: ReportRequest):
     
     **Cơ chế:** - API này hoạt động **Bất đồng bộ**. 
     - Nó sẽ trả về ngay lập tức một `generation_id` (Job ID).
-    - Client cần dùng ID này để gọi API `/status/{id}` kiểm tra tiến độ.
+    - Client cần dùng ID này để gọi API `/status/{id}` kiểm tra tiến độ
+      (hoặc subscribe `/status/{id}/events` để nhận kết quả ngay khi xong).
+    - Backend tự poll Gamma cho job này, client không cần gọi Gamma trực tiếp.
     
     **Tham số đầu vào:**
     - `content`: Nội dung thô cần chuyển đổi.
+    - `discussion_id`: Dùng thay cho `content` — ID phiên `/discuss` (header `X-Discussion-Id`),
+      backend tự lấy Insight + transcript đã lưu (404 nếu không còn, 409 nếu phiên chưa kết thúc).
     - `format`: Mặc định là 'presentation' (Allowed:presentation, document, webpage, social).
     - `numcard`: Số lượng trang muốn tạo
+    - `force`: `true` để luôn tạo generation mới. Mặc định, request có nội dung giống hệt một report
+      gần đây (trong `GAMMA_DEDUPE_TTL`) sẽ nhận lại `generationId` cũ (kèm `"deduplicated": true`,
+      và link export nếu đã xong) thay vì tạo mới.
 
     **Example Body:**
     ```json
@@ -28,24 +40,167 @@ async def create_report_endpoint(request: ReportRequest):
     ```
     """
     result = await create_gamma_presentation(request)
+
+    # Đăng ký job để backend tự poll Gamma
+    generation_id = result.get("generationId") if isinstance(result, dict) else None
+    if generation_id:
+        gamma_tracker.register(generation_id)
+
     return {
         "status": "success",
         "data": result
     }
 
+@router.post("/create-reports")
+async def create_reports_endpoint(request: BatchReportRequest):
+    """
+    **Chức năng:** Tạo nhiều report Gamma trong một lần gọi (thay cho gọi `/create-report` lần lượt).
+
+    **Cơ chế:**
+    - Backend gửi song song tối đa `GAMMA_BATCH_CONCURRENCY` request tới Gamma.
+    - Gamma trả 429: cả batch tạm dừng theo `Retry-After` rồi thử lại item đó (tối đa `GAMMA_BATCH_429_RETRIES` lần).
+    - Lỗi của một item không ảnh hưởng các item khác.
+    - Các generation tạo thành công được backend tự poll, kiểm tra bằng `/status/batch` hoặc `/status/{id}`.
+
+    **Example Body:**
+    ```json
+    {
+      "items": [
+        {"content": "Chiến lược AI năm nay", "format": "presentation"},
+        {"content": "Tối ưu chi phí Cloud", "format": "document"}
+      ]
+    }
+    ```
+
+    **Returns:** `data` là mảng theo đúng thứ tự `items`, mỗi phần tử:
+    - `{"index": 0, "status": "success", "generationId": "...", "data": {...}}`
+    - `{"index": 1, "status": "error", "error": {"status_code": 429, "detail": "..."}}`
+
+    **Raises:**
+    - **400 Bad Request**: Số item vượt `GAMMA_BATCH_MAX_ITEMS`.
+    """
+    if len(request.items) > settings.GAMMA_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Tối đa {settings.GAMMA_BATCH_MAX_ITEMS} item mỗi batch")
+
+    results = await create_gamma_presentations(request.items)
+    for result in results:
+        if result.get("generationId"):
+            gamma_tracker.register(result["generationId"])
+
+    return {
+        "status": "success",
+        "data": results
+    }
+
+@router.post("/status/batch")
+async def get_batch_report_status(
+    request: BatchStatusRequest,
+    wait: float = Query(0, ge=0, le=60, description="Long-poll: số giây tối đa chờ tất cả job hoàn tất"),
+):
+    """
+    **Chức năng:** Kiểm tra trạng thái nhiều generation trong một lần gọi.
+
+    **Cơ chế:** Giống `/status/{id}`: đọc trạng thái đã cache phía server, không gọi thêm Gamma.
+    Truyền `?wait=30` để chờ tới khi tất cả job xong (hoặc hết thời gian).
+
+    **Example Body:**
+    ```json
+    {"generation_ids": ["abc123", "def456"]}
+    ```
+
+    **Returns:** `data` là object `generation_id -> trạng thái` (cùng dạng `data` của `/status/{id}`).
+    ID không tồn tại trên Gamma, hoặc chưa kiểm tra được (Gamma lỗi / quá nhiều job đang theo dõi) có `status` = `"error"`.
+
+    **Raises:**
+    - **400 Bad Request**: Số ID vượt `GAMMA_BATCH_MAX_ITEMS`.
+    """
+    generation_ids = list(dict.fromkeys(request.generation_ids))
+    if len(generation_ids) > settings.GAMMA_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Tối đa {settings.GAMMA_BATCH_MAX_ITEMS} ID mỗi lần")
+
+    lookups = await asyncio.gather(
+        *(gamma_tracker.lookup(generation_id) for generation_id in generation_ids), return_exceptions=True,
+    )
+    for job in lookups:
+        if isinstance(job, BaseException) and not isinstance(job, HTTPException):
+            raise job
+    jobs = [job for job in lookups if isinstance(job, GammaJob)]
+    if wait:
+        await asyncio.gather(*(job.wait_finished(timeout=wait) for job in jobs))
+
+    data = {}
+    for generation_id, job in zip(generation_ids, lookups):
+        if isinstance(job, HTTPException):
+            # Gamma lỗi tạm thời / quá nhiều job: chỉ item này lỗi, client hỏi lại sau
+            data[generation_id] = {"generationId": generation_id, "status": "error", "error": job.detail}
+        else:
+            data[generation_id] = job.snapshot()
+    return {
+        "status": "success",
+        "data": data
+    }
+
 @router.get("/status/{generation_id}")
-async def get_report_status(generation_id: str):
+async def get_report_status(
+    generation_id: str,
+    wait: float = Query(0, ge=0, le=60, description="Long-poll: số giây tối đa chờ job hoàn tất"),
+):
     """
     **Chức năng:** Kiểm tra xem Gamma đã tạo xong slide chưa.
     
+    **Cơ chế:** Trả về trạng thái đã cache phía server (backend tự poll Gamma),
+    nên gọi API này không phát sinh thêm request tới Gamma. ID backend chưa biết được kiểm tra với Gamma
+    một lần; chỉ ID tồn tại và chưa xong mới được poll nền.
+
     **Hướng dẫn tích hợp (Frontend):** 
-    1. Gọi API này mỗi **3-5 giây** (Polling).  
+    1. Gọi API này mỗi **3-5 giây** (Polling), hoặc truyền `?wait=30` để long-poll
+       (API chỉ trả về khi job xong hoặc hết thời gian chờ).  
     2. Nếu `data.status` == `"pending"` hoặc `"processing"`: Tiếp tục chờ và hiển thị loading.  
     3. Nếu `data.status` == `"completed"`: Lấy link từ `data.url` (hoặc output object) để hiển thị.
     4. Nếu `data.status` == `"error"`: Thông báo lỗi.
+
+    **Raises:**
+    - **404 Not Found**: Generation ID không tồn tại trên Gamma.
+    - **503 Service Unavailable**: Đang theo dõi quá nhiều generation (`GAMMA_JOB_MAX_ACTIVE`), thử lại sau `Retry-After`.
     """
-    result = await get_generation_status(generation_id)
+    job = await gamma_tracker.lookup(generation_id)
+    if wait:
+        await job.wait_finished(timeout=wait)
+
+    if job.error is not None and job.error.status_code == 404:
+        raise HTTPException(status_code=404, detail=job.error.detail)
+
     return {
         "status": "success",
-        "data": result
-    }
\ No newline at end of file
+        "data": job.snapshot()
+    }
+
+@router.get("/status/{generation_id}/events")
+async def stream_report_status(generation_id: str, http_request: Request):
+    """
+    **Chức năng:** Subscribe trạng thái job Gamma qua Server-Sent Events (thay cho polling).
+
+    **Returns:**
+    - **Stream (text/event-stream)**: Mỗi khi trạng thái thay đổi sẽ gửi
+      `data: {"status": "success", "data": {...}}`. Khi job `completed` / `error`
+      sẽ gửi frame cuối chứa link rồi `data: [DONE]`.
+    - Comment `: ok` khi mở stream và `: keep-alive` sau mỗi `SSE_HEARTBEAT_INTERVAL` giây không có thay đổi
+      (giống các stream chat / discuss).
+    """
+    job = await gamma_tracker.lookup(generation_id)
+    if job.error is not None and job.error.status_code == 404:
+        raise HTTPException(status_code=404, detail=job.error.detail)
+
+    async def event_generator():
+        last_status = object()
+        while True:
+            if job.updated_at is not None and job.status != last_status:
+                last_status = job.status
+                yield encode_frame({"status": "success", "data": job.snapshot()})
+            if job.finished:
+                yield encode_frame(SSE_DONE)
+                return
+            await job.wait_changed(timeout=None)
+
+    # Ack / keep-alive / phát hiện client ngắt kết nối dùng chung với stream chat
+    return sse_response(guard_disconnect(http_request, event_generator()))
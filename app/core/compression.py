@@ -0,0 +1,153 @@
+import zlib
+from typing import Optional
+
+from app.core.config import settings
+from app.core.metrics import Counter, Histogram
+
+try:
+    import brotli
+except ImportError:  # brotli là tuỳ chọn
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # zstandard là tuỳ chọn
+    zstandard = None
+
+SSE_COMPRESSION_BYTES = Counter(
+    "n1_sse_compression_bytes_total", "Số byte SSE trước (raw) / sau (compressed) khi nén", ("encoding", "stage"),
+)
+SSE_COMPRESSION_RATIO = Histogram(
+    "n1_sse_compression_ratio", "Tỉ lệ byte sau nén / trước nén của mỗi stream SSE", ("encoding",),
+    buckets=(0.05, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.7, 1.0, 1.5),
+)
+
+
+class _GzipStream:
+    def __init__(self):
+        self._compressor = zlib.compressobj(settings.SSE_COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        # Z_SYNC_FLUSH: client giải nén được ngay toàn bộ frame, không chờ block tiếp theo
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class _BrotliStream:
+    def __init__(self):
+        self._compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=settings.SSE_COMPRESSION_BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class _ZstdStream:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=settings.SSE_COMPRESSION_ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+_ENCODERS = {"gzip": _GzipStream}
+if brotli is not None:
+    _ENCODERS["br"] = _BrotliStream
+if zstandard is not None:
+    _ENCODERS["zstd"] = _ZstdStream
+
+
+def available_encodings() -> list:
+    """Các encoding trong SSE_COMPRESSION_ENCODINGS có thư viện cài sẵn, theo thứ tự ưu tiên của server."""
+    return [name for name in settings.SSE_COMPRESSION_ENCODINGS if name in _ENCODERS]
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """Chọn encoding theo header Accept-Encoding (bỏ các encoding có q=0). None = không nén."""
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            accepted[name.strip().lower()] = q
+    wildcard = accepted.get("*", 0.0)
+    for name in available_encodings():
+        if accepted.get(name, wildcard) > 0:
+            return name
+    return None
+
+
+def new_encoder(encoding: str):
+    return _ENCODERS[encoding]()
+
+
+class SSECompressionMiddleware:
+    """
+    Nén response `text/event-stream` của các path trong SSE_COMPRESSION_PATHS theo Accept-Encoding
+    (zstd / br nếu có cài thư viện, gzip). Khác GZipMiddleware: mỗi chunk ASGI (một frame SSE hoặc một nhóm
+    frame đã gộp) được flush ngay sau khi nén, nên nén không làm chậm frame nào, chỉ giảm số byte gửi đi.
+
+    Encoding phải có trong header nên được chọn ngay lúc bắt đầu response, không giữ lại header hay ack
+    để đo độ dài stream. Vì vậy chỉ bật cho path có stream dài: stream ngắn (vd. một câu /n1-talk vài trăm
+    byte) bị phình vì header gzip + flush mỗi frame.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.SSE_COMPRESSION_ENABLED:
+            return await self.app(scope, receive, send)
+        if not scope["path"].startswith(tuple(settings.SSE_COMPRESSION_PATHS)):
+            return await self.app(scope, receive, send)
+        encoding = negotiate(dict(scope["headers"]).get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        encoder = None
+        raw = compressed = 0
+
+        async def send_compressed(message):
+            nonlocal encoder, raw, compressed
+            if message["type"] == "http.response.start":
+                names = {name.lower(): value for name, value in message.get("headers", [])}
+                if (
+                    message["status"] == 200
+                    and names.get(b"content-type", b"").startswith(b"text/event-stream")
+                    and b"content-encoding" not in names
+                ):
+                    encoder = new_encoder(encoding)
+                    headers = [(name, value) for name, value in message.get("headers", []) if name.lower() != b"content-length"]
+                    headers += [(b"content-encoding", encoding.encode()), (b"vary", b"Accept-Encoding")]
+                    message = {**message, "headers": headers}
+            elif message["type"] == "http.response.body" and encoder is not None:
+                body = message.get("body", b"")
+                data = encoder.compress(body) if body else b""
+                if not message.get("more_body", False):
+                    data += encoder.finish()
+                raw += len(body)
+                compressed += len(data)
+                message = {**message, "body": data}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_compressed)
+        finally:
+            if encoder is not None and raw:
+                SSE_COMPRESSION_BYTES.labels(encoding, "raw").inc(raw)
+                SSE_COMPRESSION_BYTES.labels(encoding, "compressed").inc(compressed)
+                SSE_COMPRESSION_RATIO.labels(encoding).observe(compressed / raw)
@@ -1,4 +1,5 @@
 import os
+from pydantic import Field
 from pydantic_settings import BaseSettings # Cần cài thư viện pydantic-settings
 
 class Settings(BaseSettings):
@@ -14,8 +15,162 @@ class Settings(BaseSettings):
     DIFY_KEY_IR: str = ""
     DIFY_KEY_DISCUSS: str = ""
 
+    # Backend Dify bổ sung cho từng persona / mode (ngoài key mặc định ở trên, chạy trên DIFY_API_URL).
+    # Khoá "PERSONA/mode" hoặc "PERSONA" (mode default), persona phải có trong DIFY_KEYS. Ví dụ:
+    # {"TECH/response": [{"url": "https://dify-2.example.com/v1", "key": "app-xxx", "weight": 2}]}
+    DIFY_BACKENDS: dict = {}
+    DIFY_ROUTING: str = "least_outstanding"     # "least_outstanding" | "weighted"
+    DIFY_STICKY_DB_PATH: str = "dify_sticky.db"  # Map conversation_id -> backend dùng chung mọi worker
+    DIFY_STICKY_TTL: int = 30 * 24 * 3600        # Giây giữ map kể từ lượt cuối của hội thoại
+    DIFY_STICKY_MAX_CONVERSATIONS: int = 1000000  # Số dòng tối đa trong DB, quá thì xoá hội thoại cũ nhất
+    DIFY_STICKY_CACHE_SIZE: int = 100000         # Cache LRU trong mỗi process
+
     # Gamma key
     GAMMA_API_KEY: str = os.getenv("GAMMA_API_KEY", "")
+    GAMMA_API_URL: str = "https://public-api.gamma.app/v1.0"
+
+    # HTTP client pool dùng chung cho các upstream (Dify, Gamma)
+    HTTP_MAX_CONNECTIONS: int = 100             # Tổng số connection tối đa / upstream
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 20    # Số connection idle được giữ lại để tái sử dụng
+    HTTP_KEEPALIVE_EXPIRY: float = 30.0         # Thời gian (giây) giữ connection idle
+    HTTP_CONNECT_TIMEOUT: float = 10.0
+    HTTP_HTTP2: bool = False                    # Cần cài thêm gói `h2` (httpx[http2])
+    HTTP_PREWARM: bool = False                  # Mở sẵn connection (DNS + TCP + TLS) khi khởi động
+    HTTP_PREWARM_CONNECTIONS: int = 2
+
+    # Gamma job tracker (poll phía server thay cho frontend)
+    GAMMA_POLL_INITIAL_INTERVAL: float = 2.0    # Giây, khoảng cách giữa 2 lần poll đầu tiên
+    GAMMA_POLL_MAX_INTERVAL: float = 15.0
+    GAMMA_POLL_BACKOFF: float = 1.5             # Hệ số giãn khoảng cách poll sau mỗi lần
+    GAMMA_POLL_TIMEOUT: float = 900.0           # Bỏ cuộc nếu job chạy quá lâu
+    GAMMA_JOB_TTL: float = 3600.0               # Giữ kết quả job đã xong trong bộ nhớ
+    GAMMA_JOB_MAX_ENTRIES: int = 5000
+    GAMMA_JOB_MAX_ACTIVE: int = 500             # Số job chưa xong được poll nền tối đa (ID do client gửi tới)
+
+    # Tạo report hàng loạt (/create-reports)
+    GAMMA_BATCH_MAX_ITEMS: int = 50             # Số item tối đa mỗi batch (cũng áp cho batch status)
+    GAMMA_BATCH_CONCURRENCY: int = 4            # Số request tạo generation gửi Gamma đồng thời
+    GAMMA_BATCH_429_RETRIES: int = 3            # Số lần thử lại mỗi item khi Gamma trả 429
+
+    # Dedupe generation Gamma theo nội dung payload (request giống hệt -> dùng lại generation cũ)
+    GAMMA_DEDUPE_ENABLED: bool = True
+    GAMMA_DEDUPE_TTL: float = 6 * 3600          # Giây
+    GAMMA_DEDUPE_DB_PATH: str = "gamma_dedupe.db"
+
+    # Cache câu trả lời /n1-talk cho query không có conversation_id (opt-in)
+    N1_TALK_CACHE_ENABLED: bool = False
+    N1_TALK_CACHE_TTL: float = 600.0            # Giây
+    N1_TALK_CACHE_MAX_ENTRIES: int = 1000
+    N1_TALK_CACHE_MAX_BYTES: int = 32 * 1024 * 1024
+    N1_TALK_CACHE_REPLAY_DELAY_MS: float = 0.0  # > 0: phát lại từng frame như đang gõ chữ
+
+    # Gộp các chunk `content` liên tiếp (cùng bot_id) thành 1 SSE frame
+    SSE_COALESCE_WINDOW_MS: float = 0.0         # 0 = tắt, gửi từng token như cũ
+    SSE_COALESCE_MAX_BYTES: int = 4096          # Đủ số byte này thì gửi luôn, không chờ hết window
+
+    # Timeout stream Dify theo giai đoạn (giây): connect, chờ event đầu tiên, khoảng lặng tối đa giữa 2 event
+    # (ping không tính), tổng thời gian. Theo endpoint ("chat" cho /n1-talk, /n1-talk/multi; "discuss")
+    DIFY_STREAM_TIMEOUTS: dict = {
+        "chat": {"connect": 10.0, "first_event": 30.0, "idle": 60.0, "total": 120.0},
+        "discuss": {"connect": 10.0, "first_event": 60.0, "idle": 120.0, "total": 300.0},
+    }
+    DIFY_STREAM_TIMEOUT_OVERRIDES: dict = {}    # Theo persona hoặc persona/mode, vd. {"TECH/thinking": {"first_event": 90}}
+
+    # Huỷ upstream Dify khi client đóng kết nối
+    STREAM_DISCONNECT_POLL_INTERVAL: float = 1.0  # Giây giữa 2 lần kiểm tra client còn kết nối
+
+    # Giữ kết nối SSE qua proxy / CDN: comment `: ok` ngay khi mở stream (trước khi Dify trả byte đầu tiên)
+    # và comment `: keep-alive` khi không có frame nào trong SSE_HEARTBEAT_INTERVAL giây
+    SSE_ACK_ENABLED: bool = True
+    SSE_HEARTBEAT_INTERVAL: float = 15.0        # 0 = tắt
+
+    # Nén stream SSE theo Accept-Encoding, flush sau mỗi frame (opt-in)
+    SSE_COMPRESSION_ENABLED: bool = False
+    # Prefix path. Chỉ nên gồm stream dài: /n1-talk thường vài trăm byte, nén (header gzip + flush mỗi frame)
+    # làm phình response, và encoding phải chọn ngay khi gửi header nên không đợi đo được độ dài
+    SSE_COMPRESSION_PATHS: list = ["/api/discuss", "/api/streams/"]
+    SSE_COMPRESSION_ENCODINGS: list = ["zstd", "br", "gzip"]  # Thứ tự ưu tiên; zstd / br cần cài zstandard / brotli
+    SSE_COMPRESSION_GZIP_LEVEL: int = 6
+    SSE_COMPRESSION_BROTLI_QUALITY: int = 5
+    SSE_COMPRESSION_ZSTD_LEVEL: int = 3
+
+    # Resume stream (SSE `id:` + Last-Event-ID)
+    STREAM_DETACH_GRACE: float = 30.0           # Giây giữ run khi không còn client nào, quá hạn thì huỷ trên Dify
+    STREAM_BUFFER_MAX_FRAMES: int = 5000        # Ring buffer mỗi stream
+    STREAM_BUFFER_MAX_BYTES: int = 2 * 1024 * 1024
+    STREAM_RESUME_TTL: float = 300.0            # Giây giữ stream đã xong để client nối lại đọc nốt
+    STREAM_RESUME_MAX_RUNS: int = 1000
+    STREAM_RESUME_MAX_BYTES: int = 64 * 1024 * 1024  # Tổng dung lượng buffer của mọi stream
+
+    # Admission control: giới hạn tốc độ theo user + giới hạn đồng thời theo pool / persona / mode
+    ADMISSION_ENABLED: bool = True
+    ADMISSION_USER_RATE: float = Field(1.0, gt=0)  # Số request / giây mỗi user (token bucket), phải > 0
+    ADMISSION_USER_BURST: int = 10              # Dung lượng bucket (cho phép burst)
+    # Pool riêng cho chat ngắn (interactive) và workflow thảo luận dài (workflow)
+    ADMISSION_POOL_LIMITS: dict = {"interactive": 64, "workflow": 16}
+    ADMISSION_PERSONA_LIMITS: dict = {}         # Ví dụ: {"TECH": 32, "IR": 16}
+    ADMISSION_MODE_LIMITS: dict = {}            # Ví dụ: {"thinking": 8}
+    ADMISSION_QUEUE_SIZE: int = 100             # Số request tối đa được xếp hàng chờ mỗi pool
+    ADMISSION_QUEUE_TIMEOUT: float = 10.0       # Giây chờ tối đa trong hàng đợi trước khi trả 503
+    ADMISSION_LEASE_TTL: float = 900.0          # Slot tự hết hạn (phòng worker chết không kịp trả slot)
+    ADMISSION_BACKEND: str = "memory"           # "memory" (1 process) hoặc "sqlite" (dùng chung nhiều worker)
+    ADMISSION_SQLITE_PATH: str = "admission.db"
+
+    # Retry + circuit breaker cho Dify / Gamma
+    UPSTREAM_RETRY_ATTEMPTS: int = 2            # Số lần thử lại (chỉ trước khi gửi byte đầu tiên cho client)
+    UPSTREAM_RETRY_BASE_DELAY: float = 0.5      # Giây, backoff lũy thừa + jitter
+    UPSTREAM_RETRY_MAX_DELAY: float = 4.0
+    BREAKER_FAILURE_THRESHOLD: int = 5          # Số lỗi liên tiếp trước khi ngắt mạch
+    BREAKER_OPEN_SECONDS: float = 30.0          # Thời gian fail-fast trước khi cho probe thử lại
+    BREAKER_HALF_OPEN_PROBES: int = 1           # Số request probe đồng thời ở trạng thái half-open
+
+    # Lưu transcript /discuss (SQLite, ghi nền theo batch) để /create-report nhận discussion_id
+    TRANSCRIPT_ENABLED: bool = True
+    TRANSCRIPT_DB_PATH: str = "transcripts.db"
+    TRANSCRIPT_QUEUE_MAX: int = 10000           # Số thao tác chờ ghi tối đa, đầy thì bỏ message (không chặn stream)
+    TRANSCRIPT_RUNNING_MAX_AGE: float = 600.0   # Phiên `running` lâu hơn (> total timeout workflow) coi như bị ngắt
+    TRANSCRIPT_BATCH_SIZE: int = 500
+    TRANSCRIPT_FLUSH_INTERVAL: float = 0.5      # Giây
+    TRANSCRIPT_TTL: float = 7 * 24 * 3600
+    TRANSCRIPT_MAX_DISCUSSIONS: int = 10000
+    TRANSCRIPT_MAX_BYTES: int = 256 * 1024 * 1024
+
+    # /discuss với `auto_report`: thời gian tối đa chờ Gamma trả generationId trước frame [DONE]
+    DISCUSS_AUTO_REPORT_WAIT: float = 30.0
+
+    # /n1-talk/multi: hỏi nhiều persona cùng lúc trong một stream
+    MULTI_TALK_MAX_TARGETS: int = 5
+
+    # WebSocket /api/ws/chat: một kết nối cho nhiều request chat / discuss
+    WS_MAX_INFLIGHT: int = 4            # Số request chạy song song tối đa trên một kết nối
+    WS_SEND_QUEUE_SIZE: int = 256       # Số message chờ gửi tối đa; đầy thì các stream tạm dừng đọc Dify
+    WS_SEND_TIMEOUT: float = 30.0       # Client không nhận message quá lâu -> đóng kết nối
+
+    # Gộp các /discuss giống hệt nhau (conversation_id rỗng, cùng query + inputs, không auto_report) vào một run Dify
+    DISCUSS_SINGLE_FLIGHT_ENABLED: bool = False
+    DISCUSS_SINGLE_FLIGHT_PER_USER: bool = False  # True: chỉ gộp request của cùng một user
+
+    # Profiling theo request (CPU lấy mẫu, tracemalloc, độ trễ event loop). Token rỗng = tắt hẳn.
+    # Bật cho một request: header `X-Profile: cpu,mem` + `X-Admin-Token`; tải báo cáo ở /api/ops/profiles
+    PROFILING_ADMIN_TOKEN: str = ""
+    PROFILING_USERS: list = []                  # user_id luôn được profile
+    PROFILING_SAMPLE_RATE: float = 0.0          # Tỉ lệ request /api được profile ngẫu nhiên (0..1)
+    PROFILING_DEFAULT_KINDS: list = ["cpu"]     # Loại profile khi chọn theo user / ngẫu nhiên: "cpu", "mem"
+    PROFILING_SAMPLE_INTERVAL_MS: float = 5.0   # Chu kỳ lấy mẫu stack
+    PROFILING_LAG_INTERVAL_MS: float = 50.0     # Chu kỳ đo độ trễ event loop
+    PROFILING_TRACEMALLOC_FRAMES: int = 10
+    PROFILING_TOP_N: int = 30                   # Số dòng hot function / allocation trong báo cáo
+    PROFILING_MAX_CONCURRENT: int = 4           # Số request được profile cùng lúc, vượt thì bỏ qua
+    PROFILING_MAX_REPORTS: int = 50             # Số báo cáo giữ trong bộ nhớ (cũ nhất bị xoá trước)
+
+    # Chạy server (main.py). Có thể override bằng tham số dòng lệnh
+    SERVER_HOST: str = "0.0.0.0"
+    SERVER_PORT: int = 8000
+    SERVER_WORKERS: int = 1                     # > 1: nên dùng ADMISSION_BACKEND="sqlite" để giới hạn chung
+    SERVER_BACKLOG: int = 2048                  # Hàng đợi kết nối TCP chưa accept
+    SERVER_KEEPALIVE_TIMEOUT: int = 75          # Giây, nên lớn hơn idle timeout của load balancer phía trước
+    SERVER_GRACEFUL_TIMEOUT: float = 30.0       # Giây chờ các stream SSE đang chạy kết thúc khi tắt server
+    SERVER_RELOAD: bool = False                 # Chỉ dùng khi dev
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from urllib.parse import urlsplit
+
+import httpx
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _origin(url: str) -> str:
+    # Gom các URL cùng scheme + host + port về chung một pool
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def _http2_enabled() -> bool:
+    if not settings.HTTP_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning("HTTP_HTTP2 được bật nhưng chưa cài gói `h2`, dùng HTTP/1.1")
+        return False
+    return True
+
+
+class UpstreamClients:
+    """
+    Registry giữ một `httpx.AsyncClient` (có connection pool) cho mỗi upstream.
+    Được khởi tạo / đóng trong lifespan của FastAPI (xem `app/main.py`).
+    """
+
+    def __init__(self):
+        self._clients: dict[str, httpx.AsyncClient] = {}
+
+    def _build_client(self) -> httpx.AsyncClient:
+        limits = httpx.Limits(
+            max_connections=settings.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+        )
+        # Timeout mặc định, từng request có thể override (stream Dify cần lâu hơn)
+        timeout = httpx.Timeout(60.0, connect=settings.HTTP_CONNECT_TIMEOUT)
+        return httpx.AsyncClient(limits=limits, timeout=timeout, http2=_http2_enabled())
+
+    def get(self, url: str) -> httpx.AsyncClient:
+        origin = _origin(url)
+        client = self._clients.get(origin)
+        if client is None or client.is_closed:
+            # Tạo lazy: trường hợp được gọi ngoài lifespan (script, test...)
+            client = self._build_client()
+            self._clients[origin] = client
+        return client
+
+    def upstream_urls(self) -> list[str]:
+        extra = [item.get("url") for pool in settings.DIFY_BACKENDS.values() for item in pool if item.get("url")]
+        return list(dict.fromkeys([settings.DIFY_API_URL, settings.GAMMA_API_URL, *extra]))
+
+    async def startup(self):
+        for url in self.upstream_urls():
+            self.get(url)
+        if settings.HTTP_PREWARM:
+            await self.prewarm()
+
+    async def prewarm(self):
+        """Mở sẵn connection tới từng upstream để request đầu tiên không phải chờ handshake."""
+        async def _warm(url: str):
+            try:
+                await self.get(url).head(_origin(url), timeout=settings.HTTP_CONNECT_TIMEOUT)
+            except httpx.HTTPError as e:
+                logger.warning("Pre-warm %s thất bại: %s", url, e)
+
+        jobs = [
+            _warm(url)
+            for url in self.upstream_urls()
+            for _ in range(max(1, settings.HTTP_PREWARM_CONNECTIONS))
+        ]
+        await asyncio.gather(*jobs)
+
+    async def aclose(self):
+        clients, self._clients = list(self._clients.values()), {}
+        await asyncio.gather(*(c.aclose() for c in clients), return_exceptions=True)
+
+
+upstream_clients = UpstreamClients()
+
+
+def get_dify_client(base_url: str = None) -> httpx.AsyncClient:
+    return upstream_clients.get(base_url or settings.DIFY_API_URL)
+
+
+def get_gamma_client() -> httpx.AsyncClient:
+    return upstream_clients.get(settings.GAMMA_API_URL)
@@ -0,0 +1,438 @@
+import asyncio
+import contextvars
+import hmac
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+import weakref
+from collections import Counter, OrderedDict
+from typing import Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+PROFILE_KINDS = ("cpu", "mem")
+
+# Profile của request hiện tại; task con tạo trong request (task group của StreamingResponse,
+# producer của stream_hub...) kế thừa qua context nên được tính chung
+_current_profile: contextvars.ContextVar = contextvars.ContextVar("n1_profile", default=None)
+
+# Chỉ đọc trước body tới từng này byte để tìm `user_id` (PROFILING_USERS)
+_PEEK_MAX_BYTES = 64 * 1024
+# Số stack khác nhau tối đa giữ cho mỗi profile (định dạng collapsed cho flamegraph)
+_MAX_STACKS = 5000
+_MAX_LAG_PROBES = 20000
+
+
+def verify_admin_token(token: Optional[str]) -> bool:
+    expected = settings.PROFILING_ADMIN_TOKEN
+    return bool(expected) and token is not None and hmac.compare_digest(token.encode(), expected.encode())
+
+
+def _short_path(filename: str) -> str:
+    for prefix in (os.getcwd() + os.sep, sys.prefix + os.sep):
+        if filename.startswith(prefix):
+            return filename[len(prefix):]
+    return filename
+
+
+def _is_loop_frame(code) -> bool:
+    # Handle._run của asyncio: các frame bên dưới là vòng lặp sự kiện, không thuộc request
+    return code.co_name == "_run" and code.co_filename.endswith(os.path.join("asyncio", "events.py"))
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str, user_id: Optional[str], trigger: str, kinds: tuple):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.user_id = user_id
+        self.trigger = trigger
+        self.kinds = kinds
+        self.started_at = time.time()
+        self._t0 = time.perf_counter()
+        self.duration = 0.0
+        self.status: Optional[int] = None
+        self.response_bytes = 0
+        self.tasks: weakref.WeakSet = weakref.WeakSet()
+        self._lock = threading.Lock()
+        # Mẫu CPU: loop đang chạy task của request / task khác / rảnh
+        self.samples = 0
+        self.other_samples = 0
+        self.idle_samples = 0
+        self.self_counts: Counter = Counter()
+        self.cumulative_counts: Counter = Counter()
+        self.stacks: Counter = Counter()
+        self.lag: list = []
+        self.lag_task: Optional[asyncio.Task] = None
+        self.mem_start: Optional[tracemalloc.Snapshot] = None
+        self.memory: Optional[dict] = None
+
+    def add_sample(self, frame):
+        stack = []
+        while frame is not None and not _is_loop_frame(frame.f_code):
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if not stack:
+            return
+        with self._lock:
+            self.samples += 1
+            self.self_counts[stack[0]] += 1
+            self.cumulative_counts.update(set(stack))
+            key = ";".join(reversed(stack))
+            if key in self.stacks or len(self.stacks) < _MAX_STACKS:
+                self.stacks[key] += 1
+            else:
+                self.stacks["[truncated]"] += 1
+
+    def add_loop_state(self, idle: bool):
+        with self._lock:
+            if idle:
+                self.idle_samples += 1
+            else:
+                self.other_samples += 1
+
+    def _top(self, counts: Counter, interval_ms: float) -> list:
+        return [
+            {"function": function, "samples": n, "ms": round(n * interval_ms, 1)}
+            for function, n in counts.most_common(settings.PROFILING_TOP_N)
+        ]
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "user_id": self.user_id,
+            "trigger": self.trigger,
+            "kinds": list(self.kinds),
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 1),
+            "status": self.status,
+            "response_bytes": self.response_bytes,
+        }
+
+    def report(self) -> dict:
+        data = self.summary()
+        if "cpu" in self.kinds:
+            interval_ms = settings.PROFILING_SAMPLE_INTERVAL_MS
+            with self._lock:
+                data["cpu"] = {
+                    "interval_ms": interval_ms,
+                    "request_ms": round(self.samples * interval_ms, 1),
+                    "loop_samples": {"request": self.samples, "other": self.other_samples, "idle": self.idle_samples},
+                    "top_self": self._top(self.self_counts, interval_ms),
+                    "top_cumulative": self._top(self.cumulative_counts, interval_ms),
+                }
+        lag = sorted(self.lag)
+        data["loop_lag"] = {
+            "interval_ms": settings.PROFILING_LAG_INTERVAL_MS,
+            "probes": len(lag),
+            "mean_ms": round(sum(lag) / len(lag) * 1000, 2) if lag else None,
+            "p99_ms": round(lag[min(len(lag) - 1, int(len(lag) * 0.99))] * 1000, 2) if lag else None,
+            "max_ms": round(lag[-1] * 1000, 2) if lag else None,
+        }
+        if self.memory is not None:
+            data["memory"] = self.memory
+        return data
+
+    def collapsed(self) -> str:
+        with self._lock:
+            return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+
+class _Sampler:
+    """
+    Thread lấy mẫu stack của thread chạy event loop mỗi PROFILING_SAMPLE_INTERVAL_MS,
+    ghi mẫu cho profile nào sở hữu task đang chạy. Chỉ chạy khi có profile CPU đang mở.
+    """
+
+    def __init__(self):
+        self._profiles: set = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop: Optional[threading.Event] = None
+        self._loop = None
+        self._thread_id = None
+
+    def add(self, profile: RequestProfile):
+        with self._lock:
+            self._profiles.add(profile)
+            if self._thread is None:
+                self._loop = asyncio.get_running_loop()
+                self._thread_id = threading.get_ident()
+                self._stop = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(self._stop,), name="n1-profiler", daemon=True)
+                self._thread.start()
+
+    def remove(self, profile: RequestProfile):
+        with self._lock:
+            self._profiles.discard(profile)
+            if not self._profiles and self._thread is not None:
+                self._stop.set()
+                self._thread = None
+
+    def _run(self, stop: threading.Event):
+        interval = settings.PROFILING_SAMPLE_INTERVAL_MS / 1000
+        while not stop.wait(interval):
+            with self._lock:
+                profiles = list(self._profiles)
+            frame = sys._current_frames().get(self._thread_id)
+            task = asyncio.current_task(self._loop)
+            for profile in profiles:
+                if task is not None and task in profile.tasks:
+                    profile.add_sample(frame)
+                else:
+                    profile.add_loop_state(idle=task is None)
+
+
+class _MemTracer:
+    """Bật tracemalloc khi có profile `mem` đang mở, tắt khi profile cuối kết thúc."""
+
+    def __init__(self):
+        self._users = 0
+        self._owned = False
+
+    def acquire(self) -> tracemalloc.Snapshot:
+        if self._users == 0:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(settings.PROFILING_TRACEMALLOC_FRAMES)
+                self._owned = True
+            tracemalloc.reset_peak()
+        self._users += 1
+        return self._snapshot()
+
+    def release(self, start: tracemalloc.Snapshot) -> dict:
+        end = self._snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        top = [
+            {
+                "location": f"{_short_path(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+                "size_diff": stat.size_diff,
+                "count_diff": stat.count_diff,
+            }
+            for stat in end.compare_to(start, "lineno")[:settings.PROFILING_TOP_N]
+        ]
+        self._users -= 1
+        if self._users == 0 and self._owned:
+            tracemalloc.stop()
+            self._owned = False
+        return {"traced_current_bytes": current, "traced_peak_bytes": peak, "top": top}
+
+    @staticmethod
+    def _snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),        # Bộ đếm mẫu của chính profiler
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ))
+
+
+class RequestProfiler:
+    """
+    Profiling theo request, chỉ bật khi cấu hình PROFILING_ADMIN_TOKEN. Request được chọn khi:
+    header `X-Profile: cpu,mem` kèm `X-Admin-Token` hợp lệ, user nằm trong PROFILING_USERS,
+    hoặc lấy mẫu ngẫu nhiên theo PROFILING_SAMPLE_RATE.
+
+    Mỗi profile gồm: hàm tốn CPU nhất (lấy mẫu stack event loop, chỉ tính khi loop đang chạy task
+    của request), độ trễ event loop, và nếu bật `mem` thì chênh lệch tracemalloc đầu / cuối request.
+    tracemalloc và độ trễ loop là số liệu của cả process trong lúc request chạy, không tách riêng được.
+    Request không được chọn chỉ tốn một lần kiểm tra header.
+    """
+
+    def __init__(self):
+        self._reports: OrderedDict = OrderedDict()     # id -> RequestProfile đã xong
+        self._active: set = set()
+        self._sampler = _Sampler()
+        self._mem = _MemTracer()
+        self._prev_factory = None
+        self._factory_installed = False
+        self.profiled = 0
+        self.skipped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(settings.PROFILING_ADMIN_TOKEN)
+
+    def select(self, headers: dict, user_id: Optional[str] = None) -> Optional[tuple]:
+        """Trả về (kinds, trigger) nếu request cần profile, None nếu không."""
+        requested = headers.get(b"x-profile")
+        if requested is not None and verify_admin_token(headers.get(b"x-admin-token", b"").decode("latin-1")):
+            kinds = tuple(k for k in PROFILE_KINDS if k in requested.decode("latin-1").lower())
+            return kinds or tuple(settings.PROFILING_DEFAULT_KINDS), "header"
+        if user_id is not None and user_id in settings.PROFILING_USERS:
+            return tuple(settings.PROFILING_DEFAULT_KINDS), "user"
+        if settings.PROFILING_SAMPLE_RATE > 0 and random.random() < settings.PROFILING_SAMPLE_RATE:
+            return tuple(settings.PROFILING_DEFAULT_KINDS), "sample"
+        return None
+
+    def start(self, method: str, path: str, user_id: Optional[str], kinds: tuple, trigger: str) -> Optional[RequestProfile]:
+        if len(self._active) >= settings.PROFILING_MAX_CONCURRENT:
+            self.skipped += 1
+            return None
+        profile = RequestProfile(method, path, user_id, trigger, kinds)
+        self._active.add(profile)
+        self.profiled += 1
+        # Task probe độ trễ tạo trước khi gắn profile vào context để không bị tính là task của request
+        profile.lag_task = asyncio.create_task(self._measure_lag(profile))
+        if "cpu" in kinds:
+            self._install_task_factory()
+            profile.tasks.add(asyncio.current_task())
+            self._sampler.add(profile)
+        if "mem" in kinds:
+            profile.mem_start = self._mem.acquire()
+        return profile
+
+    def finish(self, profile: RequestProfile):
+        """Đồng bộ: gọi được trong `finally` kể cả khi request bị huỷ."""
+        profile.duration = time.perf_counter() - profile._t0
+        profile.lag_task.cancel()
+        if "cpu" in profile.kinds:
+            self._sampler.remove(profile)
+        if profile.mem_start is not None:
+            profile.memory = self._mem.release(profile.mem_start)
+            profile.mem_start = None
+        self._active.discard(profile)
+        if not any("cpu" in p.kinds for p in self._active):
+            self._uninstall_task_factory()
+        self._reports[profile.id] = profile
+        while len(self._reports) > settings.PROFILING_MAX_REPORTS:
+            self._reports.popitem(last=False)
+        logger.info(
+            "Profile %s: %s %s %.0fms (%s)", profile.id, profile.method, profile.path, profile.duration * 1000, profile.trigger,
+        )
+
+    @staticmethod
+    async def _measure_lag(profile: RequestProfile):
+        loop = asyncio.get_running_loop()
+        interval = settings.PROFILING_LAG_INTERVAL_MS / 1000
+        while len(profile.lag) < _MAX_LAG_PROBES:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            profile.lag.append(max(0.0, loop.time() - started - interval))
+
+    # Task factory chỉ cài khi có profile CPU đang mở: ghi nhận task con của request được profile
+    def _install_task_factory(self):
+        if self._factory_installed:
+            return
+        loop = asyncio.get_running_loop()
+        self._prev_factory = loop.get_task_factory()
+        loop.set_task_factory(self._task_factory)
+        self._factory_installed = True
+
+    def _uninstall_task_factory(self):
+        if not self._factory_installed:
+            return
+        loop = asyncio.get_running_loop()
+        if loop.get_task_factory() == self._task_factory:
+            loop.set_task_factory(self._prev_factory)
+        self._prev_factory = None
+        self._factory_installed = False
+
+    def _task_factory(self, loop, coro, **kwargs):
+        # Python 3.13+ truyền thêm name / eager_start (ngoài context): chuyển nguyên cho factory gốc / Task
+        if self._prev_factory is not None:
+            task = self._prev_factory(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        context = kwargs.get("context")
+        profile = context.get(_current_profile) if context is not None else _current_profile.get()
+        if profile is not None:
+            profile.tasks.add(task)
+        return task
+
+    def list(self) -> list:
+        return [profile.summary() for profile in reversed(self._reports.values())]
+
+    def get(self, profile_id: str) -> Optional[RequestProfile]:
+        return self._reports.get(profile_id)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "active": len(self._active),
+            "stored": len(self._reports),
+            "profiled": self.profiled,
+            "skipped": self.skipped,
+        }
+
+
+profiler = RequestProfiler()
+
+
+async def _peek_user_id(receive):
+    """Đọc trước body JSON để lấy `user_id`, trả về (receive phát lại body đã đọc, user_id)."""
+    messages = []
+    body = b""
+    while True:
+        message = await receive()
+        messages.append(message)
+        if message["type"] != "http.request":
+            break
+        body += message.get("body", b"")
+        if not message.get("more_body") or len(body) > _PEEK_MAX_BYTES:
+            break
+
+    async def replay():
+        if messages:
+            return messages.pop(0)
+        return await receive()
+
+    user_id = None
+    try:
+        data = json.loads(body)
+        if isinstance(data, dict) and isinstance(data.get("user_id"), str):
+            user_id = data["user_id"]
+    except ValueError:
+        pass
+    return replay, user_id
+
+
+class ProfilingMiddleware:
+    """ASGI middleware thuần (không bọc StreamingResponse), profile cả thời gian stream SSE tới khi xong."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not profiler.enabled:
+            return await self.app(scope, receive, send)
+        path = scope["path"]
+        if not path.startswith("/api/") or path.startswith("/api/ops/"):
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        selected = profiler.select(headers)
+        user_id = None
+        if selected is None and settings.PROFILING_USERS and scope["method"] == "POST":
+            receive, user_id = await _peek_user_id(receive)
+            selected = profiler.select(headers, user_id)
+        if selected is None:
+            return await self.app(scope, receive, send)
+        kinds, trigger = selected
+        profile = profiler.start(scope["method"], path, user_id, kinds, trigger)
+        if profile is None:
+            return await self.app(scope, receive, send)
+
+        async def send_profiled(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                message = {**message, "headers": [*message.get("headers", []), (b"x-profile-id", profile.id.encode())]}
+            elif message["type"] == "http.response.body":
+                profile.response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        token = _current_profile.set(profile)
+        try:
+            await self.app(scope, receive, send_profiled)
+        finally:
+            _current_profile.reset(token)
+            profiler.finish(profile)
@@ -0,0 +1,298 @@
+import asyncio
+import logging
+import math
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import httpx
+from fastapi import HTTPException
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Status code upstream được coi là lỗi tạm thời (retry được + tính vào breaker)
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+# Lỗi xảy ra trước khi request tới được upstream -> retry an toàn kể cả với POST
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Upstream {name} đang tạm ngắt (circuit open), thử lại sau {math.ceil(retry_after)}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Breaker 3 trạng thái: closed -> (N lỗi liên tiếp) -> open (fail-fast)
+    -> (hết BREAKER_OPEN_SECONDS) -> half_open (cho vài probe) -> closed / open.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        self.probe_started_at = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.last_error: Optional[str] = None
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + settings.BREAKER_OPEN_SECONDS - time.monotonic())
+
+    def is_open(self) -> bool:
+        return self.state == self.OPEN and self.retry_after() > 0
+
+    def before_call(self):
+        """Raise CircuitOpenError nếu đang fail-fast; ở half-open chỉ cho số probe giới hạn."""
+        if self.state == self.OPEN:
+            if self.retry_after() > 0:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, self.retry_after())
+            self.state = self.HALF_OPEN
+            self.probes_in_flight = 0
+        if self.state == self.HALF_OPEN:
+            now = time.monotonic()
+            # Probe bị huỷ giữa chừng (client ngắt kết nối) không báo kết quả: coi như hết hạn sau 1 chu kỳ
+            if now - self.probe_started_at > settings.BREAKER_OPEN_SECONDS:
+                self.probes_in_flight = 0
+            if self.probes_in_flight >= settings.BREAKER_HALF_OPEN_PROBES:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, settings.BREAKER_OPEN_SECONDS / 2)
+            self.probes_in_flight += 1
+            self.probe_started_at = now
+
+    def record_success(self):
+        self.successes += 1
+        self.consecutive_failures = 0
+        if self.state == self.HALF_OPEN:
+            logger.info("Upstream %s hoạt động lại, đóng circuit", self.name)
+        self.state = self.CLOSED
+        self.probes_in_flight = 0
+
+    def record_failure(self, error: str):
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_error = error
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= settings.BREAKER_FAILURE_THRESHOLD:
+            if self.state != self.OPEN:
+                logger.warning("Ngắt circuit %s sau %d lỗi liên tiếp: %s", self.name, self.consecutive_failures, error)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.probes_in_flight = 0
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.OPEN if self.is_open() else (self.HALF_OPEN if self.state != self.CLOSED else self.CLOSED),
+            "consecutive_failures": self.consecutive_failures,
+            "retry_after": round(self.retry_after(), 1) if self.state == self.OPEN else 0,
+            "successes": self.successes,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "last_error": self.last_error,
+        }
+
+
+class BreakerRegistry:
+    def __init__(self):
+        self._breakers: dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = self._breakers[name] = CircuitBreaker(name)
+        return breaker
+
+    def snapshot(self) -> dict:
+        return {name: breaker.snapshot() for name, breaker in sorted(self._breakers.items())}
+
+
+breakers = BreakerRegistry()
+
+
+def raise_if_open(breaker: CircuitBreaker):
+    """Fail-fast ở endpoint (trước khi xin slot / mở stream) khi upstream đang bị ngắt mạch."""
+    if breaker.is_open():
+        raise HTTPException(
+            status_code=503,
+            detail=f"Upstream {breaker.name} tạm thời không khả dụng, vui lòng thử lại sau",
+            headers={"Retry-After": str(max(1, math.ceil(breaker.retry_after())))},
+        )
+
+
+class StreamTimeouts:
+    """Timeout theo giai đoạn của một stream upstream (giây)."""
+
+    PHASES = ("connect", "first_event", "idle", "total")
+
+    def __init__(self, connect: float = 10.0, first_event: float = 30.0, idle: float = 60.0, total: float = 120.0):
+        self.connect = connect
+        self.first_event = first_event
+        self.idle = idle
+        self.total = total
+
+    def httpx_timeout(self) -> httpx.Timeout:
+        # Read timeout của socket chỉ là lưới an toàn; khoảng lặng giữa các event do StallWatch kiểm soát
+        return httpx.Timeout(
+            connect=self.connect, read=max(self.first_event, self.idle), write=self.connect, pool=self.first_event,
+        )
+
+
+class StreamStalled(Exception):
+    def __init__(self, name: str, phase: str, limit: float):
+        if phase == "total":
+            super().__init__(f"Upstream {name} chạy quá {limit:.0f}s (total)")
+        else:
+            super().__init__(f"Upstream {name} không phản hồi quá {limit:.0f}s ({phase})")
+        self.name = name
+        self.phase = phase
+        self.limit = limit
+
+
+class StallWatch:
+    """
+    Phát hiện stream bị treo: chờ event đầu tiên quá `first_event`, lặng quá `idle` giữa 2 event
+    có nội dung (caller gọi `activity()`; ping giữ kết nối không tính), hoặc chạy quá `total`.
+    Chỉ tính thời gian thực sự chờ upstream, thời gian consumer xử lý chậm (backpressure) không tính là lặng.
+    """
+
+    def __init__(self, name: str, timeouts: StreamTimeouts, started: float):
+        self.name = name
+        self.timeouts = timeouts
+        self.phase = "first_event"
+        self._budget = timeouts.first_event
+        self._waited = 0.0
+        self._total_deadline = started + timeouts.total     # Theo loop.time()
+
+    def activity(self):
+        self.phase = "idle"
+        self._budget = self.timeouts.idle
+        self._waited = 0.0
+
+    async def watch(self, events: AsyncIterator) -> AsyncIterator:
+        loop = asyncio.get_running_loop()
+        iterator = events.__aiter__()
+        while True:
+            now = loop.time()
+            phase_deadline = now + self._budget - self._waited
+            try:
+                # asyncio.timeout_at: không tạo task mới cho mỗi event như wait_for
+                async with asyncio.timeout_at(min(phase_deadline, self._total_deadline)):
+                    event = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            except TimeoutError:
+                if self._total_deadline <= phase_deadline:
+                    raise StreamStalled(self.name, "total", self.timeouts.total) from None
+                raise StreamStalled(self.name, self.phase, self._budget) from None
+            self._waited += loop.time() - now
+            yield event
+
+
+def backoff_delay(attempt: int, retry_after: Optional[str] = None) -> Optional[float]:
+    """Delay trước lần thử thứ `attempt` (0-based): full jitter, tôn trọng Retry-After nếu có."""
+    if retry_after and retry_after.isdigit():
+        delay = float(retry_after)
+        # Upstream bảo chờ quá lâu -> không retry, trả lỗi luôn
+        return delay if delay <= settings.UPSTREAM_RETRY_MAX_DELAY else None
+    cap = min(settings.UPSTREAM_RETRY_MAX_DELAY, settings.UPSTREAM_RETRY_BASE_DELAY * (2 ** attempt))
+    return random.uniform(0, cap)
+
+
+@asynccontextmanager
+async def open_stream(client: httpx.AsyncClient, breaker: CircuitBreaker, method: str, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+    """
+    Mở một streaming request có retry + breaker. Chỉ retry ở bước mở kết nối / nhận status,
+    tức là trước khi có byte nào được stream cho client. Response lỗi cuối cùng (non-200)
+    vẫn được trả về để caller xử lý như trước. Mọi lỗi transport trước khi có header
+    (kể cả ReadTimeout khi upstream nhận kết nối nhưng không trả lời) đều tính cho breaker,
+    nhưng chỉ lỗi kết nối mới được retry (request có thể đã tới upstream).
+    """
+    attempt = 0
+    while True:
+        breaker.before_call()
+        request = client.build_request(method, url, **kwargs)
+        try:
+            response = await client.send(request, stream=True)
+        except CONNECT_ERRORS as e:
+            breaker.record_failure(f"{type(e).__name__}: {e}")
+            delay = backoff_delay(attempt) if attempt < settings.UPSTREAM_RETRY_ATTEMPTS else None
+            if delay is None:
+                raise
+            logger.info("Retry %s %s sau %.2fs (%s)", breaker.name, url, delay, type(e).__name__)
+            attempt += 1
+            await asyncio.sleep(delay)
+            continue
+        except httpx.TransportError as e:
+            breaker.record_failure(f"{type(e).__name__}: {e}")
+            raise
+
+        if response.status_code in RETRYABLE_STATUS:
+            breaker.record_failure(f"HTTP {response.status_code}")
+            delay = (
+                backoff_delay(attempt, response.headers.get("Retry-After"))
+                if attempt < settings.UPSTREAM_RETRY_ATTEMPTS else None
+            )
+            if delay is not None:
+                await response.aclose()
+                logger.info("Retry %s %s sau %.2fs (HTTP %s)", breaker.name, url, delay, response.status_code)
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+        else:
+            breaker.record_success()
+
+        try:
+            yield response
+        finally:
+            await response.aclose()
+        return
+
+
+async def request_with_retry(
+    client: httpx.AsyncClient, breaker: CircuitBreaker, method: str, url: str,
+    idempotent: bool = True, **kwargs,
+) -> httpx.Response:
+    """
+    Request thường có retry + breaker. Request không idempotent (POST tạo job) chỉ được retry
+    khi chắc chắn upstream chưa xử lý: lỗi kết nối, 429, 503.
+    """
+    retry_status = RETRYABLE_STATUS if idempotent else {429, 503}
+    retry_errors = (httpx.TransportError,) if idempotent else CONNECT_ERRORS
+    attempt = 0
+    while True:
+        breaker.before_call()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except retry_errors as e:
+            breaker.record_failure(f"{type(e).__name__}: {e}")
+            delay = backoff_delay(attempt) if attempt < settings.UPSTREAM_RETRY_ATTEMPTS else None
+            if delay is None:
+                raise
+            attempt += 1
+            await asyncio.sleep(delay)
+            continue
+        except httpx.TransportError as e:
+            breaker.record_failure(f"{type(e).__name__}: {e}")
+            raise
+
+        if response.status_code in RETRYABLE_STATUS:
+            breaker.record_failure(f"HTTP {response.status_code}")
+            if response.status_code in retry_status and attempt < settings.UPSTREAM_RETRY_ATTEMPTS:
+                delay = backoff_delay(attempt, response.headers.get("Retry-After"))
+                if delay is not None:
+                    attempt += 1
+                    await asyncio.sleep(delay)
+                    continue
+        else:
+            breaker.record_success()
+        return response
@@ -0,0 +1,49 @@
+import asyncio
+import contextlib
+import sqlite3
+import threading
+
+
+class SQLiteDatabase:
+    """
+    File SQLite dùng chung giữa các worker trên cùng máy (WAL, mỗi thao tác một connection ngắn,
+    gọi trong asyncio.to_thread). Khởi tạo không đụng tới file: schema được tạo khi `open()`
+    (lifespan) hoặc ở lần kết nối đầu tiên, nên import module không mở DB.
+    """
+
+    def __init__(self, path: str, schema: tuple):
+        self.path = path
+        self._schema = schema
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def _ensure_schema(self, conn: sqlite3.Connection):
+        with self._lock:
+            if self._ready:
+                return
+            for statement in self._schema:
+                conn.execute(statement)
+            self._ready = True
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            if not self._ready:
+                self._ensure_schema(conn)
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    async def open(self):
+        """Tạo file + schema ngay khi khởi động (ngoài event loop) để lỗi cấu hình lộ ra sớm."""
+        await asyncio.to_thread(lambda: self.connect().close())
@@ -0,0 +1,156 @@
+import asyncio
+import json
+from typing import AsyncIterator, Callable, Optional
+
+from fastapi.responses import StreamingResponse
+
+from app.core.config import settings
+
+try:
+    import orjson
+except ImportError:  # orjson là tuỳ chọn, fallback về json chuẩn
+    orjson = None
+
+# Sentinel kết thúc stream, được encode thành `data: [DONE]`
+SSE_DONE = "[DONE]"
+DONE_FRAME = b"data: [DONE]\n\n"
+
+# Comment SSE (client bỏ qua): ack gửi ngay khi mở stream, keep-alive khi upstream im lặng
+ACK_COMMENT = b": ok\n\n"
+KEEPALIVE_COMMENT = b": keep-alive\n\n"
+
+# Không cho nginx / CDN buffer hay nén lại stream (nén, nếu bật, do server tự làm theo từng frame)
+SSE_HEADERS = {"Cache-Control": "no-cache, no-transform", "X-Accel-Buffering": "no"}
+
+
+def dumps(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def encode_frame(frame) -> bytes:
+    """Encode một frame (dict hoặc SSE_DONE) thành bytes `data: ...\\n\\n` gửi thẳng cho ASGI."""
+    if frame is SSE_DONE:
+        return DONE_FRAME
+    return b"data: " + dumps(frame) + b"\n\n"
+
+
+def scrub_conversation_id(frame: bytes, **extra) -> bytes:
+    """
+    Xoá conversation_id (hội thoại Dify tạo cho người gọi đầu tiên) khỏi frame trước khi phát cho người khác,
+    gắn thêm các field `extra`. Frame có thể có dòng `id:` phía trước (frame trong ring buffer của stream_hub).
+    """
+    if b'"conversation_id"' not in frame:
+        return frame
+    prefix, _, data = frame.partition(b"data:")
+    payload = json.loads(data.strip())
+    payload["conversation_id"] = ""
+    payload.update(extra)
+    return prefix + encode_frame(payload)
+
+
+# key_fn(frame) -> (merge_key, field) nếu frame gộp được, None nếu không
+CoalesceKeyFn = Callable[[object], Optional[tuple]]
+
+
+async def coalesce_frames(frames: AsyncIterator, key_fn: CoalesceKeyFn, window_ms: float, max_bytes: int) -> AsyncIterator:
+    """
+    Gộp các frame text liên tiếp có cùng key trong một cửa sổ thời gian `window_ms`
+    (hoặc tới khi đủ `max_bytes`). Frame khác loại sẽ đẩy phần đang giữ ra trước.
+    Upstream được đọc trong một task riêng để phần đang giữ vẫn được gửi đúng hạn
+    kể cả khi upstream im lặng.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=64)
+    end = object()
+
+    pump_error = None
+
+    async def pump():
+        nonlocal pump_error
+        try:
+            async for frame in frames:
+                await queue.put(frame)
+        except Exception as e:
+            pump_error = e
+        finally:
+            aclose = getattr(frames, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        await queue.put(end)
+
+    pump_task = asyncio.create_task(pump())
+
+    held = None         # Frame đầu tiên của nhóm đang gộp
+    held_key = None
+    held_field = None
+    parts = []
+    size = 0
+    deadline = 0.0
+
+    def flush():
+        nonlocal held, held_key, parts, size
+        frame = dict(held)
+        frame[held_field] = "".join(parts)
+        held, held_key, parts, size = None, None, [], 0
+        return frame
+
+    try:
+        while True:
+            if held is None:
+                item = await queue.get()
+            else:
+                try:
+                    item = await asyncio.wait_for(queue.get(), max(0.0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    yield flush()
+                    continue
+
+            if item is end:
+                break
+
+            merge = key_fn(item)
+            if held is not None and (merge is None or merge[0] != held_key):
+                yield flush()
+
+            if merge is None:
+                yield item
+                continue
+
+            if held is None:
+                held, (held_key, held_field) = item, merge
+                deadline = loop.time() + window_ms / 1000
+            text = item[held_field]
+            parts.append(text)
+            size += len(text.encode())
+            if size >= max_bytes:
+                yield flush()
+
+        if held is not None:
+            yield flush()
+        # Propagate lỗi của upstream (nếu có)
+        if pump_error is not None:
+            raise pump_error
+    finally:
+        if not pump_task.done():
+            pump_task.cancel()
+            await asyncio.gather(pump_task, return_exceptions=True)
+
+
+def maybe_coalesce(frames: AsyncIterator, coalesce_key: CoalesceKeyFn = None) -> AsyncIterator:
+    """Bọc `coalesce_frames` nếu bật SSE_COALESCE_WINDOW_MS, ngược lại trả nguyên stream."""
+    if coalesce_key is not None and settings.SSE_COALESCE_WINDOW_MS > 0:
+        return coalesce_frames(frames, coalesce_key, settings.SSE_COALESCE_WINDOW_MS, settings.SSE_COALESCE_MAX_BYTES)
+    return frames
+
+
+async def encode_stream(frames: AsyncIterator, coalesce_key: CoalesceKeyFn = None) -> AsyncIterator[bytes]:
+    """Encode stream frame sang bytes, gộp frame nếu bật SSE_COALESCE_WINDOW_MS."""
+    async for frame in maybe_coalesce(frames, coalesce_key):
+        yield encode_frame(frame)
+
+
+def sse_response(stream: AsyncIterator, headers: Optional[dict] = None) -> StreamingResponse:
+    """StreamingResponse `text/event-stream` kèm header chống buffer."""
+    return StreamingResponse(stream, media_type="text/event-stream", headers={**SSE_HEADERS, **(headers or {})})
@@ -0,0 +1,177 @@
+import json
+import logging
+import re
+from typing import AsyncIterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# Dò nhanh `event` / `task_id` ở đầu payload JSON mà không cần decode toàn bộ
+_EVENT_FIELD = re.compile(rb'"event"\s*:\s*"([^"\\]*)"')
+_TASK_ID_FIELD = re.compile(rb'"task_id"\s*:\s*"([^"\\]*)"')
+_SNIFF_WINDOW = 512
+_BOM = b"\xef\xbb\xbf"
+
+
+class SSEEvent:
+    __slots__ = ("event", "data", "id", "retry")
+
+    def __init__(self, event: str, data: bytes, id: Optional[str], retry: Optional[int]):
+        self.event = event      # Field `event:` của SSE (mặc định "message")
+        self.data = data        # Các dòng `data:` nối bằng '\n' (bytes, chưa decode)
+        self.id = id            # Last event ID tại thời điểm dispatch
+        self.retry = retry
+
+    def __repr__(self):
+        return f"SSEEvent(event={self.event!r}, id={self.id!r}, data={self.data[:80]!r})"
+
+
+class SSEReaderStats:
+    """Bộ đếm dùng chung cho mọi stream upstream (để vận hành theo dõi)."""
+
+    def __init__(self):
+        self.events = 0         # Số event SSE đã parse
+        self.decoded = 0        # Số event phải json.loads toàn bộ
+        self.skipped = 0        # Số event bỏ qua nhờ sniff (không cần decode)
+        self.malformed = 0      # Số event không decode / xử lý được
+
+    def snapshot(self) -> dict:
+        return {
+            "events": self.events,
+            "decoded": self.decoded,
+            "skipped": self.skipped,
+            "malformed": self.malformed,
+        }
+
+
+upstream_sse_stats = SSEReaderStats()
+
+
+class SSEReader:
+    """
+    Parser SSE incremental trên bytes (theo spec WHATWG):
+    dòng kết thúc bằng CRLF / LF / CR, hỗ trợ nhiều dòng `data:`, field `event:`, `id:`, `retry:`,
+    dòng comment bắt đầu bằng ':'. Event chỉ được dispatch khi gặp dòng trống và data khác rỗng;
+    BOM UTF-8 ở đầu stream bị bỏ qua.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._data_lines: list[bytes] = []
+        self._event_type = ""
+        self.last_event_id: Optional[str] = None
+        self.retry: Optional[int] = None
+        self._at_start = True   # Còn ở đầu stream: có thể gặp BOM
+
+    def feed(self, chunk: bytes) -> list[SSEEvent]:
+        self._buffer += chunk
+        if self._at_start:
+            # BOM có thể bị cắt qua nhiều chunk -> chờ đủ 3 byte mới quyết định
+            if len(self._buffer) < len(_BOM) and _BOM.startswith(self._buffer):
+                return []
+            if self._buffer.startswith(_BOM):
+                del self._buffer[:len(_BOM)]
+            self._at_start = False
+        events = []
+        start = 0
+        buffer = self._buffer
+        length = len(buffer)
+
+        # Vị trí '\r' chỉ tìm lại khi đã đi qua nó (tránh quét lại buffer ở mỗi dòng)
+        cr = buffer.find(b"\r")
+        while True:
+            lf = buffer.find(b"\n", start)
+            if cr != -1 and cr < start:
+                cr = buffer.find(b"\r", start)
+            if lf == -1 and cr == -1:
+                break
+            if cr != -1 and (lf == -1 or cr < lf):
+                # '\r' ở cuối buffer: chưa biết có phải CRLF không -> chờ chunk sau
+                if cr == length - 1:
+                    break
+                end, next_start = cr, cr + 2 if buffer[cr + 1] == 0x0A else cr + 1
+            else:
+                end, next_start = lf, lf + 1
+
+            event = self._process_line(bytes(buffer[start:end]))
+            if event is not None:
+                events.append(event)
+            start = next_start
+
+        if start:
+            del self._buffer[:start]
+        return events
+
+    def _process_line(self, line: bytes) -> Optional[SSEEvent]:
+        if not line:
+            return self._dispatch()
+        if line[0] == 0x3A:  # ':' -> comment
+            return None
+
+        field, sep, value = line.partition(b":")
+        if sep and value[:1] == b" ":
+            value = value[1:]
+
+        if field == b"data":
+            self._data_lines.append(value)
+        elif field == b"event":
+            self._event_type = value.decode("utf-8", "replace")
+        elif field == b"id":
+            if b"\x00" not in value:
+                self.last_event_id = value.decode("utf-8", "replace")
+        elif field == b"retry":
+            if value.isdigit():
+                self.retry = int(value)
+        # Field khác: bỏ qua theo spec
+        return None
+
+    def _dispatch(self) -> Optional[SSEEvent]:
+        data = b"\n".join(self._data_lines)
+        self._data_lines = []
+        event_type, self._event_type = self._event_type, ""
+        # Spec: data buffer rỗng (không có dòng `data:` hoặc chỉ có `data:` trống) -> không dispatch
+        if not data:
+            return None
+        return SSEEvent(
+            event=event_type or "message",
+            data=data,
+            id=self.last_event_id,
+            retry=self.retry,
+        )
+
+
+async def iter_sse_events(byte_stream: AsyncIterator[bytes]) -> AsyncIterator[SSEEvent]:
+    """Đọc stream bytes (vd. `response.aiter_bytes()`) và yield từng SSEEvent hoàn chỉnh."""
+    reader = SSEReader()
+    async for chunk in byte_stream:
+        for event in reader.feed(chunk):
+            upstream_sse_stats.events += 1
+            yield event
+
+
+def sniff(data: bytes) -> tuple[Optional[str], Optional[str]]:
+    """Lấy nhanh (event, task_id) từ đầu payload JSON. Trả về None cho field không tìm thấy."""
+    head = data[:_SNIFF_WINDOW]
+    event_match = _EVENT_FIELD.search(head)
+    task_match = _TASK_ID_FIELD.search(head)
+    return (
+        event_match.group(1).decode() if event_match else None,
+        task_match.group(1).decode() if task_match else None,
+    )
+
+
+def decode_json(event: SSEEvent) -> Optional[dict]:
+    """json.loads payload của event; frame lỗi được đếm + log thay vì bị nuốt im lặng."""
+    upstream_sse_stats.decoded += 1
+    try:
+        data = json.loads(event.data)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        record_malformed(event, "invalid JSON payload")
+        return None
+    return data
+
+
+def record_malformed(event: SSEEvent, reason: str):
+    upstream_sse_stats.malformed += 1
+    logger.warning("Bỏ qua SSE frame lỗi (%s): %r", reason, event.data[:200])
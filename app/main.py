@@ -1,8 +1,65 @@
+import asyncio
+import signal
+import threading
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from app.api import chat, report
+from app.api import chat, report, ops, metrics
+from app.core.config import settings
+from app.core.compression import SSECompressionMiddleware
+from app.core.http_clients import upstream_clients
+from app.core.profiling import ProfilingMiddleware
+from app.services.admission import admission
+from app.services.dify_backends import dify_backends
+from app.services.gamma_tracker import gamma_tracker
+from app.services.report_dedupe import generation_store
+from app.services.stream_hub import stream_hub
+from app.services.transcript_store import transcript_store
 
-app = FastAPI(title="N1s Assistant API")
+
+def _drain_on_exit_signal(loop: asyncio.AbstractEventLoop):
+    """
+    Uvicorn chờ các kết nối tối đa `timeout_graceful_shutdown` rồi mới chạy phần shutdown của lifespan.
+    Bắt đầu drain stream_hub ngay khi nhận SIGTERM / SIGINT (trước handler của uvicorn) để việc chờ
+    kết nối và chờ các run Dify dùng chung một deadline SERVER_GRACEFUL_TIMEOUT thay vì cộng dồn.
+    """
+    # Signal chỉ đăng ký được ở main thread (vd. TestClient chạy lifespan ở thread khác -> bỏ qua)
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        previous = signal.getsignal(sig)
+        if not callable(previous):
+            continue
+
+        def handler(signum, frame, previous=previous):
+            loop.call_soon_threadsafe(stream_hub.start_drain, settings.SERVER_GRACEFUL_TIMEOUT)
+            previous(signum, frame)
+
+        signal.signal(sig, handler)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Khởi tạo connection pool dùng chung cho Dify / Gamma
+    await upstream_clients.startup()
+    # Mở các file SQLite (tạo schema) lúc khởi động thay vì lúc import module
+    await admission.open()
+    await dify_backends.open()
+    if settings.GAMMA_DEDUPE_ENABLED:
+        await generation_store.open()
+    if settings.TRANSCRIPT_ENABLED:
+        await transcript_store.open()
+    _drain_on_exit_signal(asyncio.get_running_loop())
+    yield
+    # Drain: server đã ngừng nhận request mới, chờ các stream SSE đang chạy xong rồi mới đóng client upstream.
+    # Thường đã bắt đầu từ lúc nhận signal, ở đây chỉ chờ nốt phần còn lại của cùng deadline
+    await stream_hub.finish_drain(settings.SERVER_GRACEFUL_TIMEOUT)
+    await transcript_store.close()
+    await gamma_tracker.shutdown()
+    await upstream_clients.aclose()
+
+
+app = FastAPI(title="N1s Assistant API", lifespan=lifespan)
 
 # Cấu hình CORS
 app.add_middleware(
@@ -11,11 +68,18 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Stream-Id", "X-Cache", "X-Single-Flight", "X-Discussion-Id", "X-Profile-Id"],  # Cho phép JS đọc header để resume stream
 )
+# Nén stream SSE theo Accept-Encoding (chỉ chạy khi bật SSE_COMPRESSION_ENABLED)
+app.add_middleware(SSECompressionMiddleware)
+# Profiling theo request (chỉ chạy khi cấu hình PROFILING_ADMIN_TOKEN)
+app.add_middleware(ProfilingMiddleware)
 
 # Include Router
 app.include_router(chat.router, prefix="/api", tags=["Chat"])
 app.include_router(report.router, prefix="/api", tags=["Report"])
+app.include_router(ops.router, prefix="/api", tags=["Ops"])
+app.include_router(metrics.router, tags=["Ops"])
 
 # Health check
 @app.get("/")
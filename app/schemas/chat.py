@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import Optional, Dict
+from pydantic import BaseModel, Field
+from typing import Optional, Dict, List
 
 class ChatRequest(BaseModel):
     query: str
@@ -9,6 +9,18 @@ class ChatRequest(BaseModel):
     # target_persona: str  # "TECH", "IR", "DISCUSS"
     target_persona: Optional[str] = None
     mode: str = "response" # "response", "search", "thinking"
+    auto_report: bool = False   # /discuss: tự tạo report Gamma từ Insight
+
+class TalkTarget(BaseModel):
+    persona: str                # "TECH", "IR", ...
+    mode: str = "response"
+    conversation_id: str = ""   # Hội thoại cũ của riêng persona này
+
+class MultiTalkRequest(BaseModel):
+    query: str
+    user_id: str
+    inputs: Dict = {}
+    targets: List[TalkTarget] = Field(..., min_length=1)
 
 class ReportRequest(BaseModel):
     topic: str
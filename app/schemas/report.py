@@ -1,7 +1,21 @@
-from pydantic import BaseModel, Field
-from typing import Optional
+from pydantic import BaseModel, Field, model_validator
+from typing import List, Optional
 
 class ReportRequest(BaseModel):
-    content: str = Field(..., description="Nội dung thảo luận hoặc dàn ý thô cần tạo slide")
+    content: Optional[str] = Field(None, description="Nội dung thảo luận hoặc dàn ý thô cần tạo slide")
+    discussion_id: Optional[str] = Field(None, description="ID phiên /discuss đã lưu, dùng thay cho content")
     format: str = Field("presentation", description="presentation, document, social, webpage")
-    numCards: Optional[str] = None 
\ No newline at end of file
+    numCards: Optional[str] = None
+    force: bool = Field(False, description="Bỏ qua dedupe, luôn tạo generation mới")
+
+    @model_validator(mode="after")
+    def _content_or_discussion(self):
+        if (self.content is None) == (self.discussion_id is None):
+            raise ValueError("Cần đúng một trong hai trường `content` hoặc `discussion_id`")
+        return self
+
+class BatchReportRequest(BaseModel):
+    items: List[ReportRequest] = Field(..., min_length=1, description="Danh sách report cần tạo")
+
+class BatchStatusRequest(BaseModel):
+    generation_ids: List[str] = Field(..., min_length=1, description="Danh sách generation ID cần kiểm tra")
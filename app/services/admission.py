@@ -0,0 +1,344 @@
+import asyncio
+from abc import ABC, abstractmethod
+import logging
+import math
+import time
+import uuid
+from typing import Optional
+
+from fastapi import HTTPException
+from app.core.config import settings
+from app.core.sqlite import SQLiteDatabase
+
+logger = logging.getLogger(__name__)
+
+POOL_INTERACTIVE = "interactive"    # Chat ngắn /n1-talk
+POOL_WORKFLOW = "workflow"          # Workflow thảo luận dài /discuss
+
+# Khoảng thời gian kiểm tra lại slot khi chờ (backend dùng chung nhiều process không notify được)
+_POLL_INTERVAL = 0.2
+
+# Khoảng thời gian (giây) giữa 2 lần xoá bucket đã đầy lại (user không gửi request lâu hơn burst / rate)
+_BUCKET_PRUNE_INTERVAL = 60.0
+
+
+class AdmissionBackend(ABC):
+    """Interface lưu trạng thái admission. Backend dùng chung cho phép nhiều worker cùng áp một giới hạn."""
+
+    @abstractmethod
+    async def take_token(self, user_id: str, rate: float, burst: int) -> float:
+        """Lấy 1 token của user. Trả về 0 nếu thành công, ngược lại là số giây cần chờ."""
+
+    @abstractmethod
+    async def try_acquire(self, limits: dict, lease_id: str, ttl: float) -> bool:
+        """Giữ 1 slot cho mọi key trong `limits` (key -> giới hạn) nếu tất cả còn chỗ."""
+
+    @abstractmethod
+    async def release(self, keys: list, lease_id: str):
+        """Trả slot của `lease_id` trên các key."""
+
+    @abstractmethod
+    async def usage(self) -> dict:
+        """Số slot đang dùng theo key."""
+
+    async def open(self):
+        """Chuẩn bị storage khi khởi động (mặc định không cần)."""
+
+
+class InMemoryBackend(AdmissionBackend):
+    def __init__(self):
+        self._buckets: dict[str, tuple[float, float]] = {}     # user -> (tokens, updated_at)
+        self._leases: dict[str, dict[str, float]] = {}         # key -> {lease_id: expires_at}
+        self._last_prune = time.monotonic()
+
+    def _prune_buckets(self, now: float, rate: float, burst: int):
+        # Bucket đã đầy lại tương đương không có bucket: xoá để dict không lớn theo số user_id từng gặp
+        full = [
+            user_id for user_id, (tokens, updated) in self._buckets.items()
+            if tokens + (now - updated) * rate >= burst
+        ]
+        for user_id in full:
+            del self._buckets[user_id]
+
+    async def take_token(self, user_id, rate, burst):
+        now = time.monotonic()
+        if now - self._last_prune >= _BUCKET_PRUNE_INTERVAL:
+            self._last_prune = now
+            self._prune_buckets(now, rate, burst)
+        tokens, updated = self._buckets.get(user_id, (float(burst), now))
+        tokens = min(float(burst), tokens + (now - updated) * rate)
+        if tokens >= 1:
+            self._buckets[user_id] = (tokens - 1, now)
+            return 0.0
+        self._buckets[user_id] = (tokens, now)
+        return (1 - tokens) / rate
+
+    def _active(self, key: str, now: float) -> dict:
+        leases = self._leases.setdefault(key, {})
+        expired = [lease_id for lease_id, expires_at in leases.items() if expires_at < now]
+        for lease_id in expired:
+            del leases[lease_id]
+        return leases
+
+    async def try_acquire(self, limits, lease_id, ttl):
+        now = time.monotonic()
+        if any(len(self._active(key, now)) >= limit for key, limit in limits.items()):
+            return False
+        for key in limits:
+            self._leases[key][lease_id] = now + ttl
+        return True
+
+    async def release(self, keys, lease_id):
+        for key in keys:
+            self._leases.get(key, {}).pop(lease_id, None)
+
+    async def usage(self):
+        now = time.monotonic()
+        return {key: len(self._active(key, now)) for key in list(self._leases)}
+
+
+class SQLiteBackend(AdmissionBackend):
+    """Backend SQLite: các worker trên cùng máy dùng chung một file để áp giới hạn toàn cục."""
+
+    def __init__(self, path: str):
+        self.db = SQLiteDatabase(path, (
+            "CREATE TABLE IF NOT EXISTS buckets (user_id TEXT PRIMARY KEY, tokens REAL, updated_at REAL)",
+            "CREATE TABLE IF NOT EXISTS leases (lease_id TEXT, key TEXT, expires_at REAL, PRIMARY KEY (lease_id, key))",
+            "CREATE INDEX IF NOT EXISTS leases_key ON leases (key)",
+            "CREATE INDEX IF NOT EXISTS buckets_updated ON buckets (updated_at)",
+        ))
+        self._last_prune = 0.0
+
+    async def open(self):
+        await self.db.open()
+
+    def _take_token(self, user_id, rate, burst):
+        # Dùng wall clock vì nhiều process cùng đọc
+        now = time.time()
+        conn = self.db.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE user_id = ?", (user_id,)).fetchone()
+            tokens, updated = row if row else (float(burst), now)
+            tokens = min(float(burst), tokens + max(0.0, now - updated) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            conn.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (user_id, tokens, now))
+            if now - self._last_prune >= _BUCKET_PRUNE_INTERVAL:
+                # Không gửi request lâu hơn burst / rate -> bucket đã đầy lại, xoá cho bảng không lớn mãi
+                self._last_prune = now
+                conn.execute("DELETE FROM buckets WHERE updated_at < ?", (now - burst / rate,))
+            conn.execute("COMMIT")
+            return wait
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _try_acquire(self, limits, lease_id, ttl):
+        now = time.time()
+        conn = self.db.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM leases WHERE expires_at < ?", (now,))
+            for key, limit in limits.items():
+                (count,) = conn.execute("SELECT COUNT(*) FROM leases WHERE key = ?", (key,)).fetchone()
+                if count >= limit:
+                    conn.execute("ROLLBACK")
+                    return False
+            conn.executemany(
+                "INSERT INTO leases VALUES (?, ?, ?)",
+                [(lease_id, key, now + ttl) for key in limits],
+            )
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _release(self, keys, lease_id):
+        with self.db.connection() as conn:
+            conn.execute("DELETE FROM leases WHERE lease_id = ?", (lease_id,))
+
+    def _usage(self):
+        with self.db.connection() as conn:
+            rows = conn.execute(
+                "SELECT key, COUNT(*) FROM leases WHERE expires_at >= ? GROUP BY key", (time.time(),)
+            ).fetchall()
+        return dict(rows)
+
+    async def take_token(self, user_id, rate, burst):
+        return await asyncio.to_thread(self._take_token, user_id, rate, burst)
+
+    async def try_acquire(self, limits, lease_id, ttl):
+        return await asyncio.to_thread(self._try_acquire, limits, lease_id, ttl)
+
+    async def release(self, keys, lease_id):
+        await asyncio.to_thread(self._release, keys, lease_id)
+
+    async def usage(self):
+        return await asyncio.to_thread(self._usage)
+
+
+class Lease:
+    """Slot đã cấp cho một request; trả lại khi stream kết thúc (gọi nhiều lần vẫn an toàn)."""
+
+    def __init__(self, controller: "AdmissionController", keys: list, lease_id: str):
+        self._controller = controller
+        self.keys = keys
+        self.lease_id = lease_id
+        self.released = False
+
+    def release(self):
+        # Đồng bộ để gọi được trong `finally` của generator đang bị huỷ
+        if self.released:
+            return
+        self.released = True
+        self._controller._schedule_release(self)
+
+
+class AdmissionController:
+    def __init__(self, backend: AdmissionBackend):
+        self.backend = backend
+        self._waiters: dict[str, int] = {}
+        self._changed = asyncio.Event()
+        self._background_tasks: set = set()
+        self.in_use: dict = {}          # Số slot đang dùng lần đọc gần nhất (xem refresh_usage)
+        self.admitted = 0
+        self.rate_limited = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+
+    def _limits_for(self, pool: str, persona: Optional[str], mode: Optional[str]) -> dict:
+        limits = {}
+        if pool in settings.ADMISSION_POOL_LIMITS:
+            limits[f"pool:{pool}"] = int(settings.ADMISSION_POOL_LIMITS[pool])
+        if persona and persona in settings.ADMISSION_PERSONA_LIMITS:
+            limits[f"persona:{persona}"] = int(settings.ADMISSION_PERSONA_LIMITS[persona])
+        if mode and mode in settings.ADMISSION_MODE_LIMITS:
+            limits[f"mode:{mode}"] = int(settings.ADMISSION_MODE_LIMITS[mode])
+        return limits
+
+    async def admit(self, user_id: str, pool: str, persona: Optional[str] = None, mode: Optional[str] = None) -> Lease:
+        """
+        Kiểm tra rate limit của user rồi xin slot đồng thời.
+        Raise 429 (vượt rate limit) hoặc 503 (hết slot / hàng đợi đầy / chờ quá lâu) kèm `Retry-After`.
+        """
+        lease_id = uuid.uuid4().hex
+        if not settings.ADMISSION_ENABLED:
+            return Lease(self, [], lease_id)
+
+        await self.check_rate(user_id)
+
+        limits = self._limits_for(pool, persona, mode)
+        lease = Lease(self, list(limits), lease_id)
+        ttl = settings.ADMISSION_LEASE_TTL
+        if not limits or await self.backend.try_acquire(limits, lease_id, ttl):
+            self.admitted += 1
+            return lease
+
+        # Hết slot: xếp hàng chờ (giới hạn số người chờ + deadline)
+        if self._waiters.get(pool, 0) >= settings.ADMISSION_QUEUE_SIZE:
+            self.rejected_queue_full += 1
+            raise self._unavailable("Hệ thống đang quá tải, vui lòng thử lại sau")
+
+        self._waiters[pool] = self._waiters.get(pool, 0) + 1
+        deadline = time.monotonic() + settings.ADMISSION_QUEUE_TIMEOUT
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected_timeout += 1
+                    raise self._unavailable("Hết thời gian chờ slot xử lý, vui lòng thử lại sau")
+                changed = self._changed
+                try:
+                    await asyncio.wait_for(changed.wait(), min(remaining, _POLL_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+                if await self.backend.try_acquire(limits, lease_id, ttl):
+                    self.admitted += 1
+                    return lease
+        finally:
+            self._waiters[pool] -= 1
+
+    async def check_rate(self, user_id: str):
+        """Chỉ áp rate limit theo user (request không tốn slot upstream, vd. join một run đang chạy)."""
+        if not settings.ADMISSION_ENABLED:
+            return
+        wait = await self.backend.take_token(user_id, settings.ADMISSION_USER_RATE, settings.ADMISSION_USER_BURST)
+        if wait > 0:
+            self.rate_limited += 1
+            raise HTTPException(
+                status_code=429,
+                detail="Quá nhiều request, vui lòng thử lại sau",
+                headers={"Retry-After": str(math.ceil(wait))},
+            )
+
+    def _unavailable(self, detail: str) -> HTTPException:
+        retry_after = max(1, math.ceil(settings.ADMISSION_QUEUE_TIMEOUT / 2))
+        return HTTPException(status_code=503, detail=detail, headers={"Retry-After": str(retry_after)})
+
+    def _schedule_release(self, lease: Lease):
+        if not lease.keys:
+            return
+        task = asyncio.get_running_loop().create_task(self._release(lease))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _release(self, lease: Lease):
+        try:
+            await self.backend.release(lease.keys, lease.lease_id)
+        except Exception:
+            logger.exception("Không trả được slot admission %s (sẽ tự hết hạn)", lease.lease_id)
+        # Đánh thức các request đang chờ
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def open(self):
+        await self.backend.open()
+
+    async def refresh_usage(self) -> dict:
+        # Backend sqlite đọc file: chạy ngoài event loop, kết quả giữ lại cho metric đọc đồng bộ
+        self.in_use = await self.backend.usage()
+        return self.in_use
+
+    def snapshot(self) -> dict:
+        """Bộ đếm hiện tại, `in_use` là giá trị của lần refresh_usage gần nhất."""
+        return {
+            "enabled": settings.ADMISSION_ENABLED,
+            "backend": type(self.backend).__name__,
+            "in_use": self.in_use,
+            "waiting": dict(self._waiters),
+            "admitted": self.admitted,
+            "rate_limited": self.rate_limited,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+        }
+
+    async def stats(self) -> dict:
+        await self.refresh_usage()
+        return self.snapshot()
+
+
+async def hold_lease(stream, lease: Lease):
+    """Giữ slot trong suốt thời gian stream, trả lại khi stream kết thúc / bị huỷ."""
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        lease.release()
+
+
+def _build_backend() -> AdmissionBackend:
+    if settings.ADMISSION_BACKEND == "sqlite":
+        return SQLiteBackend(settings.ADMISSION_SQLITE_PATH)
+    return InMemoryBackend()
+
+
+admission = AdmissionController(_build_backend())
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import random
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from app.core.config import settings, DIFY_KEYS
+from app.core.resilience import CircuitBreaker, breakers
+from app.core.sqlite import SQLiteDatabase
+
+logger = logging.getLogger(__name__)
+
+# Khoảng thời gian (giây) giữa 2 lần dọn map conversation -> backend theo TTL / số dòng
+_PRUNE_INTERVAL = 60.0
+
+
+class DifyBackend:
+    """Một app Dify (base URL + API key) trong pool của một persona / mode."""
+
+    def __init__(self, name: str, base_url: str, api_key: str, weight: float = 1.0):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.weight = max(float(weight), 0.0)
+        # Breaker riêng từng backend = passive health check: lỗi liên tiếp -> bị loại khỏi routing
+        self.breaker: CircuitBreaker = breakers.get(name)
+        self.outstanding = 0        # Số stream đang chạy trên backend này
+        self.requests = 0
+
+    def available(self) -> bool:
+        return self.weight > 0 and not self.breaker.is_open()
+
+    def snapshot(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "state": self.breaker.state,
+        }
+
+
+class BackendPool:
+    def __init__(self, name: str, backends: list):
+        self.name = name
+        self.backends = backends
+
+    def choose(self) -> DifyBackend:
+        candidates = [b for b in self.backends if b.available()]
+        if not candidates:
+            # Mọi backend đang bị ngắt mạch: trả backend sắp mở lại sớm nhất, endpoint sẽ fail-fast 503
+            return min(self.backends, key=lambda b: b.breaker.retry_after())
+        if len(candidates) == 1:
+            return candidates[0]
+        if settings.DIFY_ROUTING == "weighted":
+            return random.choices(candidates, weights=[b.weight for b in candidates])[0]
+        # least_outstanding: ít stream đang chạy nhất so với trọng số, hoà thì chọn ngẫu nhiên
+        best = min(b.outstanding / b.weight for b in candidates)
+        return random.choice([b for b in candidates if b.outstanding / b.weight == best])
+
+
+class DifyBackendRouter:
+    """
+    Chọn backend Dify cho từng request theo persona / mode.
+
+    Pool gồm key mặc định trong DIFY_KEYS (trên DIFY_API_URL) cộng các backend khai báo thêm trong
+    DIFY_BACKENDS. Hội thoại dính với backend đã tạo ra nó (conversation_id chỉ tồn tại trên app Dify đó).
+
+    Map conversation -> tên backend lưu trong SQLite (DIFY_STICKY_DB_PATH) dùng chung mọi worker và giữ được
+    qua restart, có cache LRU trong process phía trước (map không đổi nên cache không bao giờ cũ).
+    Chỉ pool có từ 2 backend mới cần map này. conversation_id không có trong map (hết TTL / bị dọn)
+    được gửi về backend mặc định.
+    """
+
+    def __init__(self):
+        self._pools: dict[str, BackendPool] = {}
+        self._sticky: OrderedDict = OrderedDict()      # Cache: conversation_id -> tên backend
+        self._last_prune = 0.0
+        self.db = SQLiteDatabase(settings.DIFY_STICKY_DB_PATH, (
+            "CREATE TABLE IF NOT EXISTS sticky (conversation_id TEXT PRIMARY KEY, backend TEXT, updated_at REAL)",
+            "CREATE INDEX IF NOT EXISTS sticky_updated ON sticky (updated_at)",
+        ))
+        self._build()
+
+    def _build(self):
+        for persona, modes in DIFY_KEYS.items():
+            for mode, key in modes.items():
+                name = f"{persona}/{mode}"
+                backends = []
+                if key:
+                    # Giữ tên breaker cũ cho backend mặc định
+                    backends.append(DifyBackend(f"dify:{name}", settings.DIFY_API_URL, key))
+                extra = settings.DIFY_BACKENDS.get(name) or (
+                    settings.DIFY_BACKENDS.get(persona) if mode == "default" else None
+                ) or []
+                for i, item in enumerate(extra, start=len(backends)):
+                    backends.append(DifyBackend(
+                        f"dify:{name}#{i}", item.get("url") or settings.DIFY_API_URL, item["key"], item.get("weight", 1.0),
+                    ))
+                if backends:
+                    self._pools[name] = BackendPool(name, backends)
+        # Backend thuộc pool nhiều backend: chỉ các backend này cần ghi nhớ hội thoại
+        self._multi = {b.name for pool in self._pools.values() if len(pool.backends) > 1 for b in pool.backends}
+
+    async def open(self):
+        if self._multi:
+            await self.db.open()
+
+    def _pool(self, persona: str, mode: Optional[str]) -> Optional[BackendPool]:
+        # Mode không có trong DIFY_KEYS của persona thì dùng default / response
+        modes = DIFY_KEYS.get(persona)
+        if not modes:
+            return None
+        if mode in modes:
+            return self._pools.get(f"{persona}/{mode}")
+        return self._pools.get(f"{persona}/default") or self._pools.get(f"{persona}/response")
+
+    async def pick(self, persona: str, mode: Optional[str], conversation_id: str = "") -> Optional[DifyBackend]:
+        pool = self._pool(persona, mode)
+        if pool is None:
+            return None
+        if not conversation_id:
+            return pool.choose()
+        if len(pool.backends) == 1:
+            return pool.backends[0]
+        name = await self._lookup(conversation_id)
+        for backend in pool.backends:
+            if backend.name == name:
+                return backend
+        return pool.backends[0]
+
+    async def _lookup(self, conversation_id: str) -> Optional[str]:
+        name = self._sticky.get(conversation_id)
+        if name is not None:
+            self._sticky.move_to_end(conversation_id)
+            return name
+        try:
+            name = await asyncio.to_thread(self._get, conversation_id)
+        except sqlite3.Error:
+            logger.exception("Không đọc được backend của conversation %s", conversation_id)
+            return None
+        if name is not None:
+            self._cache(conversation_id, name)
+        return name
+
+    def _cache(self, conversation_id: str, name: str):
+        self._sticky[conversation_id] = name
+        self._sticky.move_to_end(conversation_id)
+        while len(self._sticky) > settings.DIFY_STICKY_CACHE_SIZE:
+            self._sticky.popitem(last=False)
+
+    async def remember(self, conversation_id: Optional[str], backend: DifyBackend):
+        """Ghi backend đã tạo ra hội thoại (gọi ở message_end, trước khi client nhận được conversation_id)."""
+        if not conversation_id or backend.name not in self._multi:
+            return
+        self._cache(conversation_id, backend.name)
+        try:
+            await asyncio.to_thread(self._put, conversation_id, backend.name)
+        except sqlite3.Error:
+            logger.exception("Không lưu được backend của conversation %s", conversation_id)
+
+    def _get(self, conversation_id: str) -> Optional[str]:
+        with self.db.connection() as conn:
+            row = conn.execute(
+                "SELECT backend FROM sticky WHERE conversation_id = ? AND updated_at >= ?",
+                (conversation_id, time.time() - settings.DIFY_STICKY_TTL),
+            ).fetchone()
+        return row[0] if row else None
+
+    def _put(self, conversation_id: str, name: str):
+        now = time.time()
+        with self.db.connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO sticky VALUES (?, ?, ?)", (conversation_id, name, now))
+            if now - self._last_prune >= _PRUNE_INTERVAL:
+                self._last_prune = now
+                conn.execute("DELETE FROM sticky WHERE updated_at < ?", (now - settings.DIFY_STICKY_TTL,))
+                conn.execute(
+                    "DELETE FROM sticky WHERE conversation_id IN "
+                    "(SELECT conversation_id FROM sticky ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                    (settings.DIFY_STICKY_MAX_CONVERSATIONS,),
+                )
+
+    def find(self, api_key: str) -> Optional[DifyBackend]:
+        for pool in self._pools.values():
+            for backend in pool.backends:
+                if backend.api_key == api_key:
+                    return backend
+        return None
+
+    def backends(self) -> list:
+        return [b for pool in self._pools.values() for b in pool.backends]
+
+    def stats(self) -> dict:
+        return {
+            "routing": settings.DIFY_ROUTING,
+            "sticky_cached": len(self._sticky),
+            "pools": {
+                name: {b.name: b.snapshot() for b in pool.backends}
+                for name, pool in self._pools.items()
+            },
+        }
+
+
+dify_backends = DifyBackendRouter()
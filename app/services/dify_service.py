@@ -1,45 +1,293 @@
-import re, json
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Optional
+
 import httpx
 from app.core.config import settings, DIFY_KEYS
+from app.core.http_clients import get_dify_client
+from app.core.metrics import Counter, Histogram
+from app.core.resilience import (
+    CircuitBreaker, CircuitOpenError, StallWatch, StreamStalled, StreamTimeouts, breakers, open_stream,
+)
+from app.core.sse import SSE_DONE, encode_frame, encode_stream
+from app.core.sse_reader import decode_json, iter_sse_events, record_malformed, sniff, upstream_sse_stats
+from app.services.dify_backends import DifyBackend, dify_backends
+from app.services.discuss_report import report_result, start_report
+from app.services.insight_parser import (  # process_* giữ lại để tương thích import cũ
+    INSIGHT_MARKER, InsightParser, format_insight_response, process_highlights, process_links,  # noqa: F401
+)
+
+# Các event Dify cần decode, các event khác (ping, workflow_started, node_retry...) bỏ qua
+CHAT_EVENTS = {"message", "agent_message", "message_end"}
+DISCUSS_EVENTS = {"node_started", "text_chunk", "message", "node_finished", "message_end"}
+# Event chỉ có ý nghĩa khi task_id đang được theo dõi
+DISCUSS_TASK_EVENTS = {"text_chunk", "message", "node_finished"}
+
+# Tên endpoint dùng làm label metric theo loại run
+ENDPOINT_BY_KIND = {"chat": "n1-talk", "discuss": "discuss", "multi": "n1-talk-multi"}
+
+logger = logging.getLogger(__name__)
+
+STREAM_LABELS = ("endpoint", "persona", "mode")
+DIFY_TTFB = Histogram(
+    "n1_dify_ttfb_seconds", "Thời gian từ lúc gửi request tới event SSE đầu tiên của Dify", STREAM_LABELS,
+)
+DIFY_STREAM_DURATION = Histogram(
+    "n1_dify_stream_duration_seconds", "Thời lượng một stream Dify theo kết quả", STREAM_LABELS + ("outcome",),
+)
+DIFY_TOKENS_PER_SECOND = Histogram(
+    "n1_dify_tokens_per_second", "Tốc độ sinh token (completion_tokens / thời gian từ text đầu tiên tới message_end)",
+    STREAM_LABELS, buckets=(5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500),
+)
+DIFY_COMPLETION_TOKENS = Counter("n1_dify_completion_tokens_total", "Tổng completion token Dify báo về", STREAM_LABELS)
+DIFY_TEXT_CHUNKS = Counter("n1_dify_text_chunks_total", "Số chunk text nhận từ Dify", STREAM_LABELS)
+DIFY_STREAM_STALLS = Counter(
+    "n1_dify_stream_stalls_total",
+    "Số stream Dify bị cắt do quá timeout theo giai đoạn (connect / first_event = upstream chết, "
+    "idle / total = model chậm hoặc treo giữa chừng)",
+    STREAM_LABELS + ("phase",),
+)
+DISCUSS_AGENT_DURATION = Histogram(
+    "n1_discuss_agent_duration_seconds", "Thời gian từng agent thảo luận (node_started -> node_finished)", ("agent",),
+)
+
+
+class DifyRun:
+    """Thông tin một lượt chạy Dify đang stream (dùng để huỷ upstream khi client ngắt kết nối)."""
+
+    def __init__(self, api_key: str, user: str, kind: str, persona: str = None, mode: str = None, backend: DifyBackend = None):
+        self.api_key = api_key
+        self.user = user
+        self.kind = kind                # "chat" | "discuss"
+        self.persona = persona          # Dùng làm label metric
+        self.mode = mode
+        self.backend = backend          # Backend trong pool của persona / mode (None = DIFY_API_URL)
+        self.base_url = backend.base_url if backend is not None else settings.DIFY_API_URL
+        self.task_id = None             # Lấy từ event đầu tiên có task_id
+        self.started_at = time.monotonic()
+        self.finished = False           # Đã nhận message_end
+        self.stop_requested = False     # Đã gọi stop-generation (tránh gọi 2 lần)
+        self.recorder = None            # DiscussionRecorder: lưu transcript (chỉ /discuss)
+
+    def track(self, task_id):
+        if task_id and self.task_id is None:
+            self.task_id = task_id
+
+
+class StreamMetrics:
+    """
+    Đo một stream Dify. Chỉ cập nhật metric ở các mốc (event đầu tiên, message_end, kết thúc),
+    trong vòng lặp chunk chỉ tăng biến đếm cục bộ nên bật được ở production.
+    """
 
-def get_api_key(persona: str, mode: str):
-    persona_config = DIFY_KEYS.get(persona)
-    if not persona_config:
-        return None
-    if mode in persona_config:
-        return persona_config[mode]
-    return persona_config.get("default") or persona_config.get("response")
+    def __init__(self, endpoint: str, run: "DifyRun" = None):
+        # Chỉ nhận giá trị có trong DIFY_KEYS để label không phình theo input của user
+        persona = run.persona if run is not None and run.persona in DIFY_KEYS else "unknown"
+        mode = run.mode if run is not None and run.mode in DIFY_KEYS.get(persona, {}) else "default"
+        self.labels = (endpoint, persona, mode)
+        self.started = time.perf_counter()
+        self.first_event_at = None
+        self.first_text_at = None
+        self.text_chunks = 0
+        self.outcome = "cancelled"      # Đổi thành completed / error khi biết kết quả
+
+    def first_event(self):
+        self.first_event_at = time.perf_counter()
+        DIFY_TTFB.labels(*self.labels).observe(self.first_event_at - self.started)
+
+    def text(self):
+        if self.first_text_at is None:
+            self.first_text_at = time.perf_counter()
+        self.text_chunks += 1
+
+    def message_end(self, data_json: dict):
+        self.outcome = "completed"
+        usage = (data_json.get("metadata") or {}).get("usage") or {}
+        tokens = usage.get("completion_tokens")
+        if isinstance(tokens, int) and tokens > 0:
+            DIFY_COMPLETION_TOKENS.labels(*self.labels).inc(tokens)
+            if self.first_text_at is not None:
+                elapsed = time.perf_counter() - self.first_text_at
+                if elapsed > 0:
+                    DIFY_TOKENS_PER_SECOND.labels(*self.labels).observe(tokens / elapsed)
+
+    def stalled(self, phase: str):
+        self.outcome = "stalled"
+        DIFY_STREAM_STALLS.labels(*self.labels, phase).inc()
+
+    def finish(self):
+        # Đồng bộ: gọi trong `finally` của generator (kể cả khi bị huỷ)
+        DIFY_STREAM_DURATION.labels(*self.labels, self.outcome).observe(time.perf_counter() - self.started)
+        if self.text_chunks:
+            DIFY_TEXT_CHUNKS.labels(*self.labels).inc(self.text_chunks)
+
+
+async def pick_backend(persona: str, mode: str, conversation_id: str = "") -> Optional[DifyBackend]:
+    """
+    Chọn backend (base URL + key) trong pool của persona / mode: hội thoại cũ về đúng backend đã tạo ra nó,
+    request mới theo DIFY_ROUTING, bỏ qua backend đang bị ngắt mạch.
+    """
+    return await dify_backends.pick(persona, mode, conversation_id)
+
+
+def dify_breaker(api_key: str) -> CircuitBreaker:
+    """Breaker riêng cho từng API key (mỗi key là một app Dify). Tên lấy theo persona/mode, không lộ key."""
+    backend = dify_backends.find(api_key)
+    if backend is not None:
+        return backend.breaker
+    for persona, modes in DIFY_KEYS.items():
+        for mode, key in modes.items():
+            if key and key == api_key:
+                return breakers.get(f"dify:{persona}/{mode}")
+    return breakers.get(f"dify:{hashlib.sha256(api_key.encode()).hexdigest()[:8]}")
+
+
+def stream_timeouts(run: "DifyRun" = None) -> StreamTimeouts:
+    """Timeout theo endpoint, override theo persona rồi persona/mode (DIFY_STREAM_TIMEOUT_OVERRIDES)."""
+    kind = "discuss" if run is not None and run.kind == "discuss" else "chat"
+    values = dict(settings.DIFY_STREAM_TIMEOUTS.get(kind, {}))
+    if run is not None and run.persona:
+        for key in (run.persona, f"{run.persona}/{run.mode}"):
+            values.update(settings.DIFY_STREAM_TIMEOUT_OVERRIDES.get(key, {}))
+    return StreamTimeouts(**{k: float(v) for k, v in values.items() if k in StreamTimeouts.PHASES})
+
+
+def _stall_phase(e: Exception, opened: bool):
+    """Giai đoạn bị timeout, None nếu không phải lỗi timeout."""
+    if isinstance(e, StreamStalled):
+        return e.phase
+    if isinstance(e, (httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return "connect"
+    if isinstance(e, httpx.ReadTimeout):
+        return "idle" if opened else "first_event"
+    return None
+
+
+def _upstream_error(e: Exception, breaker: CircuitBreaker, opened: bool, metrics: "StreamMetrics" = None) -> dict:
+    if isinstance(e, CircuitOpenError):
+        return {'error': str(e), 'retry_after': round(e.retry_after, 1)}
+    # Lỗi sau khi đã mở stream (đứt giữa chừng) cũng tính cho breaker;
+    # lỗi transport trước khi có header (connect, ReadTimeout...) đã được open_stream ghi nhận
+    if opened:
+        breaker.record_failure(f"{type(e).__name__}: {e}")
+    phase = _stall_phase(e, opened)
+    if phase is not None and metrics is not None:
+        metrics.stalled(phase)
+        # `partial`: client đã nhận một phần câu trả lời trước khi stream bị cắt
+        return {'error': str(e) or f"Upstream timeout ({phase})", 'code': 'upstream_stalled', 'phase': phase,
+                'partial': metrics.text_chunks > 0}
+    return {'error': str(e)}
+
+
+async def dify_stream_generator(payload, api_key, run: DifyRun = None):
+    async for chunk in encode_stream(_dify_chat_frames(payload, api_key, run), coalesce_key=_chat_coalesce_key):
+        yield chunk
+
+
+async def dify_discuss_stream_generator(payload, api_key, run: DifyRun = None, auto_report: bool = False):
+    async for chunk in encode_stream(_dify_discuss_frames(payload, api_key, run, auto_report), coalesce_key=_discuss_coalesce_key):
+        yield chunk
+
+
+async def stop_dify_task(run: DifyRun):
+    """Gọi API stop-generation của Dify để dừng task đang chạy (giải phóng LLM / workflow)."""
+    if not run.task_id or run.finished:
+        return
+    headers = {
+        "Authorization": f"Bearer {run.api_key}",
+        "Content-Type": "application/json"
+    }
+    client = get_dify_client(run.base_url)
+    try:
+        response = await client.post(
+            f"{run.base_url}/chat-messages/{run.task_id}/stop",
+            headers=headers, json={"user": run.user}, timeout=10.0,
+        )
+        if response.status_code != 200:
+            logger.warning("Stop Dify task %s trả về %s: %s", run.task_id, response.status_code, response.text)
+    except Exception as e:
+        logger.warning("Stop Dify task %s thất bại: %s", run.task_id, e)
 
-async def dify_stream_generator(payload, api_key):
+
+def _chat_coalesce_key(frame):
+    # Chỉ gộp các frame text của /n1-talk
+    if isinstance(frame, dict) and "text" in frame:
+        return ("text", "text")
+    return None
+
+
+def _discuss_coalesce_key(frame):
+    # Chỉ gộp các chunk `content` dạng text liên tiếp của cùng một bot
+    if isinstance(frame, dict) and frame.get("event") == "content" and isinstance(frame.get("payload"), str):
+        return (frame["bot_id"], "payload")
+    return None
+
+
+async def _dify_chat_frames(payload, api_key, run: DifyRun = None):
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
     }
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        try:
-            async with client.stream("POST", f"{settings.DIFY_API_URL}/chat-messages", headers=headers, json=payload) as response:
-                if response.status_code != 200:
-                    error_text = await response.aread()
-                    yield f"data: {json.dumps({'error': error_text.decode()})}\n\n"
-                    return
-                async for line in response.aiter_lines():
-                    if line.startswith("data:"):
-                        data_str = line[5:].strip()
-                        if not data_str: continue 
-                        try:
-                            data_json = json.loads(data_str)
-                            event = data_json.get("event")
-                            if event in ["message", "agent_message"]:
-                                yield f"data: {json.dumps({'text': data_json.get('answer', '')})}\n\n"
-                            elif event == "message_end":
-                                yield f"data: {json.dumps({'conversation_id': data_json.get('conversation_id'), 'is_finished': True})}\n\n"
-                                yield "data: [DONE]\n\n"
-                        except: continue
-        except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
-
-
-async def dify_discuss_stream_generator(payload, api_key):
+    backend = run.backend if run is not None else None
+    base_url = backend.base_url if backend is not None else settings.DIFY_API_URL
+    client = get_dify_client(base_url)
+    breaker = backend.breaker if backend is not None else dify_breaker(api_key)
+    opened = False
+    metrics = StreamMetrics(ENDPOINT_BY_KIND.get(run.kind, "n1-talk") if run is not None else "n1-talk", run)
+    timeouts = stream_timeouts(run)
+    watch = StallWatch(breaker.name, timeouts, asyncio.get_running_loop().time())
+    if backend is not None:
+        backend.outstanding += 1
+        backend.requests += 1
+    try:
+        # Retry (backoff + jitter) chỉ xảy ra trong open_stream, trước khi yield frame nào cho client
+        async with open_stream(client, breaker, "POST", f"{base_url}/chat-messages", headers=headers, json=payload, timeout=timeouts.httpx_timeout()) as response:
+            opened = True
+            if response.status_code != 200:
+                metrics.outcome = "error"
+                error_text = await response.aread()
+                yield {'error': error_text.decode()}
+                return
+            async for sse in watch.watch(iter_sse_events(response.aiter_bytes())):
+                if metrics.first_event_at is None:
+                    metrics.first_event()
+                # Sniff event trước, chỉ decode JSON các event cần dùng
+                event, task_id = sniff(sse.data)
+                if event != "ping":
+                    watch.activity()
+                if run is not None:
+                    run.track(task_id)
+                if event is not None and event not in CHAT_EVENTS:
+                    upstream_sse_stats.skipped += 1
+                    continue
+                data_json = decode_json(sse)
+                if data_json is None:
+                    continue
+                event = data_json.get("event")
+                if event in ["message", "agent_message"]:
+                    metrics.text()
+                    yield {'text': data_json.get('answer', '')}
+                elif event == "message_end":
+                    if run is not None:
+                        run.finished = True
+                    metrics.message_end(data_json)
+                    if backend is not None:
+                        # Lượt sau của hội thoại này phải về đúng backend đã tạo ra nó
+                        await dify_backends.remember(data_json.get('conversation_id'), backend)
+                    yield {'conversation_id': data_json.get('conversation_id'), 'is_finished': True}
+                    yield SSE_DONE
+    except Exception as e:
+        metrics.outcome = "error"
+        yield _upstream_error(e, breaker, opened, metrics)
+    finally:
+        metrics.finish()
+        if backend is not None:
+            backend.outstanding -= 1
+
+
+async def _dify_discuss_frames(payload, api_key, run: DifyRun = None, auto_report: bool = False):
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
@@ -60,91 +308,189 @@ async def dify_discuss_stream_generator(payload, api_key):
     # Dictionary map task_id -> bot_key (để dùng cho event done)
     active_tasks_map = {} 
 
-    async with httpx.AsyncClient(timeout=300.0) as client:
-        try:
-            async with client.stream("POST", f"{settings.DIFY_API_URL}/chat-messages", headers=headers, json=payload) as response:
-                if response.status_code != 200:
-                    error_text = await response.aread()
-                    yield f"data: {json.dumps({'error': error_text.decode()})}\n\n"
-                    return
-
-                async for line in response.aiter_lines():
-                    if not line.startswith("data:"): continue
-                    data_str = line[5:].strip()
-                    if not data_str or data_str == "[DONE]": continue
-
-                    try:
-                        data_json = json.loads(data_str)
-                        event = data_json.get("event")
-                        task_id = data_json.get("task_id")
+    # Parser incremental cho Insight (task_id -> InsightParser)
+    insight_parsers = {}
+
+    # Thời điểm bắt đầu của agent đang chạy (bot_key -> perf_counter)
+    agent_started = {}
+
+    # Job tạo report Gamma từ Insight (auto_report)
+    report_task = None
+
+    # Lưu transcript từng bot + Insight (ghi nền, không chặn stream)
+    recorder = run.recorder if run is not None else None
+
+    backend = run.backend if run is not None else None
+    base_url = backend.base_url if backend is not None else settings.DIFY_API_URL
+    client = get_dify_client(base_url)
+    breaker = backend.breaker if backend is not None else dify_breaker(api_key)
+    opened = False
+    metrics = StreamMetrics("discuss", run)
+    timeouts = stream_timeouts(run)
+    watch = StallWatch(breaker.name, timeouts, asyncio.get_running_loop().time())
+    if backend is not None:
+        backend.outstanding += 1
+        backend.requests += 1
+    try:
+        async with open_stream(client, breaker, "POST", f"{base_url}/chat-messages", headers=headers, json=payload, timeout=timeouts.httpx_timeout()) as response:
+            opened = True
+            if response.status_code != 200:
+                metrics.outcome = "error"
+                error_text = await response.aread()
+                yield {'error': error_text.decode()}
+                return
+
+            async for sse in watch.watch(iter_sse_events(response.aiter_bytes())):
+                if metrics.first_event_at is None:
+                    metrics.first_event()
+                if sse.data == b"[DONE]": continue
+
+                # Sniff event / task_id: bỏ qua payload lớn (node_started / node_finished
+                # của các node không nằm trong BOT_MAPPING) mà không cần json.loads
+                event, task_id = sniff(sse.data)
+                # Node không liên quan vẫn tính là workflow đang chạy, chỉ ping là không
+                if event != "ping":
+                    watch.activity()
+                if run is not None:
+                    run.track(task_id)
+                if event is not None and (
+                    event not in DISCUSS_EVENTS
+                    or (event in DISCUSS_TASK_EVENTS and task_id is not None and task_id not in active_tasks_map)
+                ):
+                    upstream_sse_stats.skipped += 1
+                    continue
+
+                data_json = decode_json(sse)
+                if data_json is None:
+                    continue
+
+                try:
+                    event = data_json.get("event")
+                    task_id = data_json.get("task_id")
+                    
+                    # KHI BOT BẮT ĐẦU
+                    if event == "node_started":
+                        node_data = data_json.get("data", {})
+                        title = node_data.get("title")
                         
-                        # KHI BOT BẮT ĐẦU
-                        if event == "node_started":
-                            node_data = data_json.get("data", {})
-                            title = node_data.get("title")
+                        if title in BOT_MAPPING:
+                            bot_key = BOT_MAPPING[title]
+                            active_tasks_map[task_id] = bot_key
+                            agent_started[bot_key] = time.perf_counter()
+                            yield build_frame(bot_key, "start", None)
+
+                    # KHI STREAM TEXT (Hiệu ứng gõ chữ)
+                    elif event == "text_chunk" or event == "message":
+                        if task_id in active_tasks_map:
+                            bot_key = active_tasks_map[task_id]
+                            text = data_json.get("data", {}).get("text", "")
+                            
+                            if text:
+                                metrics.text()
+                                # Đánh dấu là task này ĐÃ stream
+                                streamed_tasks.add(task_id) 
+                                if recorder is not None:
+                                    recorder.text(bot_key, text)
+                                if bot_key == 'Answer Summary':
+                                    # Insight: gửi delta từng section ngay khi section đó hoàn chỉnh
+                                    parser = insight_parsers.setdefault(task_id, InsightParser())
+                                    for delta in parser.feed(text):
+                                        yield build_frame(bot_key, "delta", delta)
+                                else:
+                                    yield build_frame(bot_key, "content", text)
+
+                    # KHI BOT HOÀN TẤT
+                    elif event == "node_finished":
+                        if task_id in active_tasks_map:
+                            bot_key = active_tasks_map[task_id]
                             
-                            if title in BOT_MAPPING:
-                                bot_key = BOT_MAPPING[title]
-                                active_tasks_map[task_id] = bot_key
-                                yield format_sse(bot_key, "start", None)
-
-                        # KHI STREAM TEXT (Hiệu ứng gõ chữ)
-                        elif event == "text_chunk" or event == "message":
-                            if task_id in active_tasks_map:
-                                bot_key = active_tasks_map[task_id]
-                                text = data_json.get("data", {}).get("text", "")
-                                
-                                if text:
-                                    # Đánh dấu là task này ĐÃ stream
-                                    streamed_tasks.add(task_id) 
-                                    yield format_sse(bot_key, "content", text)
-
-                        # KHI BOT HOÀN TẤT
-                        elif event == "node_finished":
-                            if task_id in active_tasks_map:
-                                bot_key = active_tasks_map[task_id]
-                                
-                                # Chỉ gửi nội dung full NẾU chưa từng gửi chunk nào (Fallback)
-                                # Giúp tránh lỗi hiển thị 2 lần văn bản
-                                if task_id not in streamed_tasks:
-                                    node_data = data_json.get("data", {})
-                                    outputs = node_data.get("outputs", {})
-
-                                    # Lấy output, answer hoặc text tùy node
+                            # Chỉ gửi nội dung full NẾU chưa từng gửi chunk nào (Fallback)
+                            # Giúp tránh lỗi hiển thị 2 lần văn bản
+                            if task_id not in streamed_tasks:
+                                node_data = data_json.get("data", {})
+                                outputs = node_data.get("outputs", {})
+
+                                # Lấy output, answer hoặc text tùy node
+                                if bot_key == 'Answer Summary':
+                                    content = outputs.get("answer")
+                                else:
+                                    content = outputs.get("output") or outputs.get("text")
+                     
+                                if content:
+                                    if recorder is not None:
+                                        recorder.text(bot_key, content)
                                     if bot_key == 'Answer Summary':
-                                        content = outputs.get("answer")
+                                        insight_parsers.setdefault(task_id, InsightParser()).feed(content)
                                     else:
-                                        content = outputs.get("output") or outputs.get("text")
-                         
-                                    if content:
-                                        yield format_sse(bot_key, "content", content)
-                                
-                                # Báo hiệu kết thúc bot này
-                                yield format_sse(bot_key, "done", None)
-                                
-                                # Dọn dẹp
-                                active_tasks_map.pop(task_id, None)
-                                if task_id in streamed_tasks:
-                                    streamed_tasks.remove(task_id)
-
-                        # KẾT THÚC TOÀN BỘ
-                        elif event == "message_end":
-                            yield "data: [DONE]\n\n"
-
-                    except Exception:
-                        continue
-                        
-        except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                                        yield build_frame(bot_key, "content", content)
+
+                            # Insight: gửi một object tổng hợp cuối cùng
+                            parser = insight_parsers.pop(task_id, None)
+                            if parser is not None:
+                                insight = parser.finish()
+                                if recorder is not None:
+                                    recorder.insight(insight)
+                                yield build_frame(bot_key, "content", insight)
+                                # Tạo report ngay, không chờ client gửi lại Insight qua /create-report
+                                if auto_report and report_task is None:
+                                    report_task = start_report(insight)
+                                    yield build_frame("Report", "start", None)
+                            
+                            started = agent_started.pop(bot_key, None)
+                            if started is not None:
+                                DISCUSS_AGENT_DURATION.labels(bot_key).observe(time.perf_counter() - started)
+
+                            if recorder is not None:
+                                recorder.bot_done(bot_key)
+
+                            # Báo hiệu kết thúc bot này
+                            yield build_frame(bot_key, "done", None)
+                            
+                            # Dọn dẹp
+                            active_tasks_map.pop(task_id, None)
+                            if task_id in streamed_tasks:
+                                streamed_tasks.remove(task_id)
+
+                    # KẾT THÚC TOÀN BỘ
+                    elif event == "message_end":
+                        if run is not None:
+                            run.finished = True
+                        metrics.message_end(data_json)
+                        if backend is not None:
+                            await dify_backends.remember(data_json.get("conversation_id"), backend)
+                        if report_task is not None:
+                            result = await report_result(report_task, settings.DISCUSS_AUTO_REPORT_WAIT)
+                            yield build_frame("Report", "content", result)
+                            yield build_frame("Report", "done", None)
+                        yield SSE_DONE
+
+                except (AttributeError, TypeError) as e:
+                    # Payload sai cấu trúc (vd. "data": null): đếm + log thay vì nuốt im lặng
+                    record_malformed(sse, f"unexpected payload shape: {e}")
+                    continue
+                    
+    except Exception as e:
+        metrics.outcome = "error"
+        yield _upstream_error(e, breaker, opened, metrics)
+    finally:
+        metrics.finish()
+        if backend is not None:
+            backend.outstanding -= 1
+        if recorder is not None:
+            recorder.finish(metrics.outcome)
 
 
 # Helper function để format JSON chuẩn cho FE
 def format_sse(bot_id, event_type, payload):
+    return encode_frame(build_frame(bot_id, event_type, payload))
+
+
+def build_frame(bot_id, event_type, payload):
     # Xử lý Insight
     if bot_id == 'Answer Summary':
         bot_id = 'Insight'
-        if event_type == 'content':
-            payload = format_insight_response(payload.split("[N1s Insight]\n\n", 1)[-1].strip()) # Cắt và xử lý Insight
+        if event_type == 'content' and isinstance(payload, str):
+            payload = format_insight_response(payload.split(INSIGHT_MARKER, 1)[-1].strip()) # Cắt và xử lý Insight
 
     # Trả về json
     data = {
@@ -152,150 +498,8 @@ def format_sse(bot_id, event_type, payload):
         "event": event_type,   # Ví dụ: "start", "content", "done"
         "payload": payload     # Ví dụ: "Xin chào..."
     }
-    return f"data: {json.dumps(data)}\n\n"
+    return data
 
-def format_insight_response(raw_payload):
-    """
-    Hàm xử lý payload đa định dạng (unstructured) để format thành JSON tiêu chuẩn.
-    Chiến lược: Tìm keyword tiêu đề để cắt block, sau đó xử lý mềm dẻo từng dòng.
-    """
-    # CẮT KHỐI VĂN BẢN (SECTION SLICING)
-    # Tìm header Summary (chứa 'サマリ')
-    idx_summary = -1
-    match_sum = re.search(r"(?:^|\n)\s*(?:【)?.*サマリ.*(?:】)?", raw_payload)
-    if match_sum: idx_summary = match_sum.start()
-
-    # Tìm header Highlights (chứa 'ハイライト' hoặc '重要発言')
-    idx_high = -1
-    match_high = re.search(r"(?:^|\n)\s*(?:【)?.*(?:ハイライト|重要発言).*(?:】)?", raw_payload)
-    if match_high: idx_high = match_high.start()
-
-    # Tìm header Reference (chứa '参考' hoặc 'URL')
-    idx_ref = -1
-    match_ref = re.search(r"(?:^|\n)\s*(?:【)?.*(?:参考|URL).*(?:】)?", raw_payload)
-    if match_ref: idx_ref = match_ref.start()
-
-    # Hàm cắt text dựa trên vị trí index
-    def get_section_text(start_idx, next_indices):
-        if start_idx == -1: return ""
-        # Tìm index kế tiếp gần nhất lớn hơn start_idx
-        valid_next = [i for i in next_indices if i > start_idx]
-        end_idx = min(valid_next) if valid_next else len(raw_payload)
-        
-        # Lấy text, bỏ dòng header đầu tiên (tiêu đề section)
-        text_block = raw_payload[start_idx:end_idx].strip()
-        # Xóa dòng đầu tiên (là dòng chứa tiêu đề như 【全体サマリ】)
-        first_newline = text_block.find('\n')
-        if first_newline != -1:
-            return text_block[first_newline+1:].strip()
-        return text_block
-
-    # Lấy nội dung thô từng phần
-    indices = [idx_summary, idx_high, idx_ref, len(raw_payload)]
-    raw_summary = get_section_text(idx_summary, indices)
-    raw_highlights = get_section_text(idx_high, indices)
-    raw_links = get_section_text(idx_ref, indices)
-
-    # XỬ LÝ SUMMARY
-    summary_content = raw_summary
-
-    # XỬ LÝ HIGHLIGHTS
-    highlights = process_highlights(raw_highlights)
-
-    # XỬ LÝ REFERENCE LINKS 
-    reference_links = process_links(raw_links)
-
-    # Construct Final JSON Structure
-    response_structure = {
-        "summary": {
-            "title": "サマリ",
-            "content": summary_content
-        },
-        "highlights": highlights,
-        "reference_links": reference_links
-    }
-    return response_structure
-
-def process_links(raw_links):
-    reference_links = []
-    
-    if raw_links:
-        # Regex tìm URL và Tách chuỗi
-        url_pattern = r"(https?://[^\s]+)"
-        parts = re.split(url_pattern, raw_links)
-        
-        # parts[0] là text rác trước link 1.
-        # Loop từ 1, bước nhảy 2 (Lấy cặp URL, Description)
-        if len(parts) > 1:
-            current_id = 1
-            for i in range(1, len(parts), 2):                
-                url = parts[i].strip()
-                
-                raw_desc = parts[i+1] if i+1 < len(parts) else ""                       # raw_desc là phần text nằm SAU URL hiện tại
-                clean_desc = re.sub(r"[\n\r]", " ", raw_desc)                           # Gộp dòng thành 1 dòng duy nhất
-                clean_desc = re.sub(r"\s+[\d\.\-]+\s*$", "", clean_desc)                # Xóa số thứ tự của item tiếp theo
-                clean_desc = re.sub(r"^[ \t\-\d\.]+[:：]?\s*", "", clean_desc.strip())  # Xóa ký tự rác ở đầu chuỗi
-                clean_desc = clean_desc.strip(" 　（()）")                              # Xóa cả ngoặc tròn fullwidth （） và halfwidth ()
-
-                # Tách title từ description
-                description = clean_desc
-                title = ""
-                
-                delimiters = ["：", "・", "。"]
-                
-                # Tìm delimiter xuất hiện sớm nhất
-                positions = [
-                    (d, clean_desc.find(d))
-                    for d in delimiters
-                    if clean_desc.find(d) != -1
-                ]
-
-                if not positions:
-                    title = clean_desc
-                else:
-                    delimiter, pos = min(positions, key=lambda x: x[1])
-                    title = clean_desc[:pos].strip()
-                    
-                title = title.lstrip("（(").strip() # Clean đề phòng còn rác
-
-                if url: 
-                    reference_links.append({
-                        "id": current_id,
-                        "title": title,       
-                        "description": description, 
-                        "url": url
-                    })
-                    current_id += 1
-                    
-    return reference_links
-
-def process_highlights(raw_highlights):
-    highlights = []
-    if raw_highlights:
-        # Tách dòng, lọc dòng trống
-        lines = [line.strip() for line in raw_highlights.split('\n') if line.strip()]
-        
-        count_id = 1
-        for line in lines:
-            # Bỏ ký tự đầu dòng như "1.", "-", "・"
-            clean_line = re.sub(r"^[\d\.\-・\s]+", "", line)
-            
-            # Regex tìm Quote và Author 
-            quote_match = re.search(r"(?:「)?(.*?)(?:」)?\s*[（\(](.*?)[）\)]", clean_line)
-            
-            if quote_match:
-                quote = quote_match.group(1).strip()
-                author_name = quote_match.group(2).strip()
-                
-                # Nếu quote quá ngắn (do lỗi parse), bỏ qua
-                if len(quote) > 1: 
-                    highlights.append({
-                        "id": count_id,
-                        "quote": quote,
-                        "author_name": author_name
-                    })
-                    count_id += 1
-    return highlights
 
 # # --- TEST ---
 # input_data = {
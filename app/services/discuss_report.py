@@ -0,0 +1,51 @@
+import asyncio
+import logging
+
+from fastapi import HTTPException
+from app.schemas.report import ReportRequest
+from app.services.gamma_service import create_gamma_presentation
+from app.services.gamma_tracker import gamma_tracker
+from app.services.insight_parser import render_insight_report
+
+logger = logging.getLogger(__name__)
+
+# Giữ reference tới các job tạo report chạy nền (client có thể ngắt kết nối trước khi job xong)
+_background_tasks: set = set()
+
+
+async def _create_report(insight: dict) -> dict:
+    content = render_insight_report(insight)
+    if not content:
+        return {"error": "Insight rỗng, không tạo report"}
+    try:
+        result = await create_gamma_presentation(ReportRequest(content=content))
+    except HTTPException as e:
+        logger.warning("Tạo report tự động thất bại (%s): %s", e.status_code, e.detail)
+        return {"error": e.detail, "status_code": e.status_code}
+
+    generation_id = result.get("generationId") if isinstance(result, dict) else None
+    if not generation_id:
+        return {"error": "Gamma không trả về generationId"}
+    # Backend tự poll, client chỉ cần /status/{id} hoặc /status/{id}/events
+    gamma_tracker.register(generation_id)
+    return {
+        "generation_id": generation_id,
+        "status": result.get("status", "pending"),
+        "deduplicated": bool(result.get("deduplicated")),
+    }
+
+
+def start_report(insight: dict) -> asyncio.Task:
+    """Bắt đầu tạo report Gamma từ Insight ngay khi node Answer Summary kết thúc (chạy nền)."""
+    task = asyncio.create_task(_create_report(insight))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def report_result(task: asyncio.Task, timeout: float) -> dict:
+    """Chờ kết quả tạo report tối đa `timeout` giây (job vẫn chạy tiếp nếu hết hạn)."""
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), timeout)
+    except asyncio.TimeoutError:
+        return {"error": "Gamma chưa trả về generationId", "status": "submitting"}
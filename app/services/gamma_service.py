@@ -1,9 +1,92 @@
+import asyncio
+import logging
+import math
+import time
+
 import httpx
 from fastapi import HTTPException
 from app.core.config import settings
+from app.core.http_clients import get_gamma_client
+from app.core.metrics import Histogram
+from app.core.resilience import CircuitOpenError, breakers, request_with_retry
 from app.schemas.report import ReportRequest
+from app.services.insight_parser import render_insight_report
+from app.services.report_dedupe import generation_store, make_payload_key
+from app.services.transcript_store import transcript_store
+
+logger = logging.getLogger(__name__)
+
+GAMMA_API_URL = f"{settings.GAMMA_API_URL}/generations"
+
+# Một breaker cho Gamma (chỉ dùng một API key)
+gamma_breaker = breakers.get("gamma")
+
+GAMMA_REQUEST_DURATION = Histogram(
+    "n1_gamma_request_duration_seconds", "Độ trễ gọi API Gamma (gồm cả retry)", ("operation", "status"),
+)
+GAMMA_GENERATION_DURATION = Histogram(
+    "n1_gamma_generation_seconds", "Thời gian từ lúc tạo generation tới khi Gamma trả trạng thái cuối", ("status",),
+    buckets=(5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600, 900),
+)
+
+
+# Các request tạo generation đang chạy theo khoá payload (double-click đồng thời dùng chung một request)
+_pending_creates: dict[str, asyncio.Task] = {}
+
+
+async def _timed_request(operation: str, client: httpx.AsyncClient, method: str, url: str, **kwargs) -> httpx.Response:
+    started = time.perf_counter()
+    status = "error"
+    try:
+        response = await request_with_retry(client, gamma_breaker, method, url, **kwargs)
+        status = str(response.status_code)
+        return response
+    finally:
+        GAMMA_REQUEST_DURATION.labels(operation, status).observe(time.perf_counter() - started)
+
+
+def _upstream_exception(e: Exception) -> HTTPException:
+    """Map lỗi kết nối / breaker sang status code có ý nghĩa thay vì 500 chung chung."""
+    if isinstance(e, CircuitOpenError):
+        return HTTPException(
+            status_code=503, detail=str(e),
+            headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))},
+        )
+    if isinstance(e, httpx.TimeoutException):
+        return HTTPException(status_code=504, detail=f"Gamma timeout: {e}")
+    return HTTPException(status_code=502, detail=f"Không kết nối được Gamma: {e}")
+
+
+def _error_response(response: httpx.Response) -> HTTPException:
+    # Giữ nguyên status code thật của Gamma (400, 401, 429...) + Retry-After nếu có
+    retry_after = response.headers.get("Retry-After")
+    return HTTPException(
+        status_code=response.status_code,
+        detail=response.text,
+        headers={"Retry-After": retry_after} if retry_after else None,
+    )
+
+
+async def _discussion_content(discussion_id: str) -> str:
+    """Dựng nội dung report từ transcript đã lưu: Insight trước, sau đó là phát biểu của từng bot."""
+    discussion = await transcript_store.get(discussion_id)
+    if discussion is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy phiên thảo luận (hoặc đã hết hạn lưu)")
+    if discussion["status"] == "running":
+        raise HTTPException(status_code=409, detail="Phiên thảo luận chưa kết thúc")
+
+    parts = []
+    if discussion["insight"]:
+        parts.append(render_insight_report(discussion["insight"]))
+    for message in discussion["messages"]:
+        # Text thô của Answer Summary đã có trong Insight
+        if message["bot_id"] != "Answer Summary":
+            parts.append(f"## {message['bot_id']}\n\n{message['text']}")
+    content = "\n\n".join(p for p in parts if p)
+    if not content:
+        raise HTTPException(status_code=422, detail="Phiên thảo luận không có nội dung")
+    return content
 
-GAMMA_API_URL = "https://public-api.gamma.app/v1.0/generations"
 
 async def create_gamma_presentation(request: ReportRequest):
     api_key = settings.GAMMA_API_KEY
@@ -11,13 +94,17 @@ async def create_gamma_presentation(request: ReportRequest):
     if not api_key:
         raise HTTPException(status_code=500, detail="Missing GAMMA_API_KEY")
 
+    content = request.content
+    if request.discussion_id is not None:
+        content = await _discussion_content(request.discussion_id)
+
     headers = {
         "Content-Type": "application/json",
         "X-API-KEY": api_key
     }
 
     payload = {
-        "inputText": request.content, # Nội dung thảo luận
+        "inputText": content,         # Nội dung thảo luận
         "textMode": "preserve",       # Không thay đổi nội dung prompt (generate, condense)
         "format": request.format,     # Mặc định là presentation
         "cardSplit": "auto",          # Tự động chia slide
@@ -25,7 +112,7 @@ async def create_gamma_presentation(request: ReportRequest):
         "exportAs": "pptx",
         
         # Hướng dẫn bổ sung để AI biết đây là báo cáo tổng hợp
-        "additionalInstructions": f"Create a professional summary report about '{request.content}'. Focus on key insights, decisions, and action items from the discussion.",
+        "additionalInstructions": f"Create a professional summary report about '{content}'. Focus on key insights, decisions, and action items from the discussion.",
         
         "textOptions": {
             "language": "en" 
@@ -38,20 +125,64 @@ async def create_gamma_presentation(request: ReportRequest):
         }
     }
 
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        try:
-            response = await client.post(GAMMA_API_URL, json=payload, headers=headers)
-            
-            if response.status_code == 200:
-                data = response.json()
-                # Trả về URL của file Gamma vừa tạo
-                return data 
-            else:
-                raise HTTPException(status_code=response.status_code, detail=response.text)
-                
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
-        
+    if not settings.GAMMA_DEDUPE_ENABLED or request.force:
+        return await _submit_generation(payload, headers)
+
+    # Payload giống hệt một generation gần đây -> trả lại generation đó, không tạo mới
+    key = make_payload_key(payload)
+    entry = await generation_store.get(key)
+    if entry is not None:
+        data = {"generationId": entry["generation_id"], "status": entry["status"], "deduplicated": True}
+        if entry["result"]:
+            data.update(entry["result"])
+        return data
+
+    # Request tạo chạy trong task riêng: client đầu tiên ngắt kết nối không huỷ request của các client đang chờ
+    task = _pending_creates.get(key)
+    if task is not None:
+        data = await asyncio.shield(task)
+        return {**data, "deduplicated": True}
+
+    task = asyncio.create_task(_create_and_remember(key, payload, headers))
+    _pending_creates[key] = task
+    task.add_done_callback(lambda t: _forget_pending(key, t))
+    return await asyncio.shield(task)
+
+
+def _forget_pending(key: str, task: asyncio.Task):
+    if _pending_creates.get(key) is task:
+        del _pending_creates[key]
+    if not task.cancelled():
+        task.exception()  # Đánh dấu đã xử lý nếu mọi client đã ngắt kết nối
+
+
+async def _create_and_remember(key: str, payload: dict, headers: dict):
+    data = await _submit_generation(payload, headers)
+    generation_id = data.get("generationId") if isinstance(data, dict) else None
+    if generation_id:
+        await generation_store.put(key, generation_id)
+    return data
+
+
+async def _submit_generation(payload: dict, headers: dict):
+    client = get_gamma_client()
+    try:
+        # POST tạo generation không idempotent: chỉ retry khi chắc chắn Gamma chưa nhận job
+        response = await _timed_request(
+            "create", client, "POST", GAMMA_API_URL,
+            idempotent=False, json=payload, headers=headers, timeout=60.0,
+        )
+    except (CircuitOpenError, httpx.HTTPError) as e:
+        raise _upstream_exception(e)
+
+    if response.status_code == 200:
+        data = response.json()
+        # Trả về URL của file Gamma vừa tạo
+        return data
+    raise _error_response(response)
+
+
+
 async def get_generation_status(generation_id: str, api_key: str = None):
     """
     Gọi Gamma để kiểm tra xem quá trình tạo slide đã xong chưa.
@@ -65,17 +196,59 @@ async def get_generation_status(generation_id: str, api_key: str = None):
         "X-API-KEY": real_key
     }
     
-    url = f"https://public-api.gamma.app/v1.0/generations/{generation_id}"
-
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(url, headers=headers)
-            
-            if response.status_code == 200:
-                return response.json() # Trả về status (pending/completed) và url (nếu xong)
-            elif response.status_code == 404:
-                raise HTTPException(status_code=404, detail="Generation ID not found")
-            else:
-                raise HTTPException(status_code=response.status_code, detail=response.text)
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+    url = f"{GAMMA_API_URL}/{generation_id}"
+
+    client = get_gamma_client()
+    try:
+        response = await _timed_request("status", client, "GET", url, headers=headers, timeout=30.0)
+    except (CircuitOpenError, httpx.HTTPError) as e:
+        raise _upstream_exception(e)
+
+    if response.status_code == 200:
+        return response.json() # Trả về status (pending/completed) và url (nếu xong)
+    elif response.status_code == 404:
+        raise HTTPException(status_code=404, detail="Generation ID not found")
+    # Giữ nguyên status code thật của Gamma (429...) cho caller / job tracker
+    raise _error_response(response)
+
+
+async def create_gamma_presentations(requests: list[ReportRequest]) -> list[dict]:
+    """
+    Tạo nhiều generation song song (tối đa GAMMA_BATCH_CONCURRENCY request cùng lúc).
+    Khi Gamma trả 429, mọi worker cùng dừng tới hết Retry-After rồi mới gửi tiếp,
+    thay vì tiếp tục bắn request làm rate limit kéo dài. Lỗi của từng item không làm hỏng cả batch.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(settings.GAMMA_BATCH_CONCURRENCY)
+    resume_at = 0.0
+
+    async def submit(index: int, request: ReportRequest) -> dict:
+        nonlocal resume_at
+        async with semaphore:
+            attempt = 0
+            while True:
+                pause = resume_at - loop.time()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                try:
+                    data = await create_gamma_presentation(request)
+                except HTTPException as e:
+                    if e.status_code == 429 and attempt < settings.GAMMA_BATCH_429_RETRIES:
+                        retry_after = (e.headers or {}).get("Retry-After", "")
+                        delay = float(retry_after) if retry_after.isdigit() else 2.0 ** attempt
+                        resume_at = max(resume_at, loop.time() + delay)
+                        attempt += 1
+                        continue
+                    return {"index": index, "status": "error", "error": {"status_code": e.status_code, "detail": e.detail}}
+                except Exception as e:
+                    # Lỗi không lường trước (response không phải JSON...) chỉ hỏng item này, không mất các item đã tạo
+                    logger.exception("Tạo generation cho item %d của batch lỗi", index)
+                    return {"index": index, "status": "error", "error": {"status_code": 500, "detail": str(e)}}
+                return {
+                    "index": index,
+                    "status": "success",
+                    "generationId": data.get("generationId") if isinstance(data, dict) else None,
+                    "data": data,
+                }
+
+    return await asyncio.gather(*(submit(i, r) for i, r in enumerate(requests)))
@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import math
+import time
+from typing import Optional
+
+from fastapi import HTTPException
+from app.core.config import settings
+from app.services.gamma_service import GAMMA_GENERATION_DURATION, get_generation_status
+from app.services.report_dedupe import generation_store
+
+logger = logging.getLogger(__name__)
+
+# Các trạng thái kết thúc của Gamma, sau đó kết quả không đổi nữa
+TERMINAL_STATUSES = {"completed", "failed", "error"}
+
+
+class GammaJob:
+    def __init__(self, generation_id: str):
+        self.generation_id = generation_id
+        self.created_at = time.monotonic()
+        self.updated_at: Optional[float] = None
+        self.data: Optional[dict] = None        # Response mới nhất từ Gamma
+        self.error: Optional[HTTPException] = None
+        self._changed = asyncio.Event()
+
+    @property
+    def status(self) -> Optional[str]:
+        if self.error is not None:
+            return "error"
+        return (self.data or {}).get("status")
+
+    @property
+    def finished(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+    def update(self, data: dict = None, error: HTTPException = None):
+        if self.finished:
+            # Kết quả cuối cùng là immutable
+            return
+        self.data, self.error = (data, None) if error is None else (self.data, error)
+        self.updated_at = time.monotonic()
+        # Đánh thức các client đang chờ rồi tạo event mới cho lần thay đổi tiếp theo
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_changed(self, timeout: Optional[float]) -> bool:
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def wait_first(self, timeout: float):
+        # Chờ kết quả poll đầu tiên (job vừa được đăng ký)
+        if self.updated_at is None:
+            await self.wait_changed(timeout)
+
+    async def wait_finished(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        while not self.finished:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await self.wait_changed(remaining)
+
+    def snapshot(self) -> dict:
+        if self.error is not None:
+            return {"generationId": self.generation_id, "status": "error", "error": self.error.detail}
+        return self.data or {"generationId": self.generation_id, "status": "pending"}
+
+
+class GammaJobTracker:
+    """
+    Poll Gamma phía server: mỗi generation chỉ có 1 task poll (backoff tăng dần),
+    mọi client đọc chung trạng thái đã cache thay vì tự gọi Gamma.
+
+    `register` dùng cho generation do chính service tạo. ID client gửi tới đi qua `lookup`:
+    gọi Gamma một lần, chỉ poll nền khi ID tồn tại và chưa xong, tối đa GAMMA_JOB_MAX_ACTIVE job.
+    """
+
+    def __init__(self):
+        self._jobs: dict[str, GammaJob] = {}
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._lookups: dict[str, asyncio.Task] = {}
+
+    def get(self, generation_id: str) -> Optional[GammaJob]:
+        return self._jobs.get(generation_id)
+
+    def register(self, generation_id: str) -> GammaJob:
+        job = self._jobs.get(generation_id)
+        if job is not None:
+            return job
+        self._prune()
+        job = GammaJob(generation_id)
+        self._track(job)
+        return job
+
+    def _track(self, job: GammaJob):
+        self._jobs[job.generation_id] = job
+        task = asyncio.create_task(self._poll(job))
+        self._tasks[job.generation_id] = task
+        task.add_done_callback(lambda _t, gid=job.generation_id: self._tasks.pop(gid, None))
+
+    async def lookup(self, generation_id: str) -> GammaJob:
+        """
+        Job của một generation_id do client gửi tới. ID không tồn tại trả về job lỗi 404 (không lưu, không poll).
+        Raise HTTPException khi Gamma lỗi (429 / 5xx) hoặc đã đủ GAMMA_JOB_MAX_ACTIVE job đang poll (503).
+        """
+        job = self._jobs.get(generation_id)
+        if job is not None:
+            return job
+        # Nhiều client hỏi cùng một ID mới -> dùng chung một lần gọi Gamma
+        task = self._lookups.get(generation_id)
+        if task is None:
+            task = asyncio.create_task(self._lookup(generation_id))
+            self._lookups[generation_id] = task
+            task.add_done_callback(lambda _t, gid=generation_id: self._lookups.pop(gid, None))
+        return await asyncio.shield(task)
+
+    async def _lookup(self, generation_id: str) -> GammaJob:
+        if len(self._tasks) >= settings.GAMMA_JOB_MAX_ACTIVE:
+            raise HTTPException(
+                status_code=503, detail="Đang theo dõi quá nhiều generation, vui lòng thử lại sau",
+                headers={"Retry-After": str(math.ceil(settings.GAMMA_POLL_MAX_INTERVAL))},
+            )
+        job = GammaJob(generation_id)
+        try:
+            job.update(data=await get_generation_status(generation_id))
+        except HTTPException as e:
+            if e.status_code != 404:
+                raise
+            job.update(error=e)
+            return job
+        existing = self._jobs.get(generation_id)
+        if existing is not None:
+            return existing
+        self._prune()
+        if job.finished:
+            self._jobs[generation_id] = job
+            await generation_store.complete(generation_id, job.status, job.snapshot())
+        else:
+            self._track(job)
+        return job
+
+    async def _poll(self, job: GammaJob):
+        try:
+            await self._poll_until_finished(job)
+        finally:
+            if job.finished:
+                status = job.status if job.error is None else f"error_{job.error.status_code}"
+                GAMMA_GENERATION_DURATION.labels(status).observe(time.monotonic() - job.created_at)
+        # Lưu link export để request trùng nội dung nhận kết quả ngay (generation lỗi sẽ bị xoá khỏi store)
+        if job.finished:
+            await generation_store.complete(job.generation_id, job.status, job.snapshot())
+
+    async def _poll_until_finished(self, job: GammaJob):
+        interval = settings.GAMMA_POLL_INITIAL_INTERVAL
+        deadline = job.created_at + settings.GAMMA_POLL_TIMEOUT
+        if job.updated_at is not None:
+            # Job từ lookup() đã có kết quả lần gọi đầu
+            await asyncio.sleep(interval)
+
+        while not job.finished:
+            delay = interval
+            try:
+                job.update(data=await get_generation_status(job.generation_id))
+            except HTTPException as e:
+                if e.status_code == 404:
+                    job.update(error=e)
+                    break
+                if e.status_code == 429:
+                    retry_after = (e.headers or {}).get("Retry-After", "")
+                    delay = float(retry_after) if retry_after.isdigit() else interval * 2
+                logger.warning("Poll Gamma %s lỗi %s: %s", job.generation_id, e.status_code, e.detail)
+                interval = min(interval * 2, settings.GAMMA_POLL_MAX_INTERVAL)
+            except Exception:
+                logger.exception("Poll Gamma %s lỗi không xác định", job.generation_id)
+                interval = min(interval * 2, settings.GAMMA_POLL_MAX_INTERVAL)
+
+            if job.finished:
+                break
+            if time.monotonic() + delay > deadline:
+                job.update(error=HTTPException(status_code=504, detail="Gamma generation timed out"))
+                break
+
+            await asyncio.sleep(delay)
+            interval = min(interval * settings.GAMMA_POLL_BACKOFF, settings.GAMMA_POLL_MAX_INTERVAL)
+
+    def _prune(self):
+        now = time.monotonic()
+        expired = [
+            gid for gid, job in self._jobs.items()
+            if job.finished and now - (job.updated_at or job.created_at) > settings.GAMMA_JOB_TTL
+        ]
+        for gid in expired:
+            self._jobs.pop(gid, None)
+
+        # Vượt giới hạn: bỏ các job đã xong cũ nhất trước
+        overflow = len(self._jobs) - settings.GAMMA_JOB_MAX_ENTRIES + 1
+        if overflow > 0:
+            finished = sorted(
+                (job for job in self._jobs.values() if job.finished),
+                key=lambda j: j.updated_at or j.created_at,
+            )
+            for job in finished[:overflow]:
+                self._jobs.pop(job.generation_id, None)
+
+    async def shutdown(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+gamma_tracker = GammaJobTracker()
@@ -0,0 +1,284 @@
+import re
+
+INSIGHT_MARKER = "[N1s Insight]\n\n"
+INSIGHT_MARKER_LINE = "[N1s Insight]"
+
+# Pattern biên dịch sẵn một lần (trước đây compile lại trong mỗi lần gọi)
+_SUMMARY_HEADER = re.compile(r"(?:^|\n)\s*(?:【)?.*サマリ.*(?:】)?")
+_HIGHLIGHT_HEADER = re.compile(r"(?:^|\n)\s*(?:【)?.*(?:ハイライト|重要発言).*(?:】)?")
+_REFERENCE_HEADER = re.compile(r"(?:^|\n)\s*(?:【)?.*(?:参考|URL).*(?:】)?")
+
+# Keyword nhận diện dòng tiêu đề của từng section (dùng cho parser incremental)
+_SECTION_KEYWORDS = (
+    ("summary", re.compile(r"サマリ")),
+    ("highlights", re.compile(r"ハイライト|重要発言")),
+    ("reference_links", re.compile(r"参考|URL")),
+)
+
+_URL_SPLIT = re.compile(r"(https?://[^\s]+)")
+_LINE_BREAKS = re.compile(r"[\n\r]")
+_TRAILING_ITEM_NUMBER = re.compile(r"\s+[\d\.\-]+\s*$")
+_LEADING_JUNK = re.compile(r"^[ \t\-\d\.]+[:：]?\s*")
+_BULLET_PREFIX = re.compile(r"^[\d\.\-・\s]+")
+_QUOTE_AUTHOR = re.compile(r"(?:「)?(.*?)(?:」)?\s*[（\(](.*?)[）\)]")
+
+
+def format_insight_response(raw_payload):
+    """
+    Hàm xử lý payload đa định dạng (unstructured) để format thành JSON tiêu chuẩn.
+    Chiến lược: Tìm keyword tiêu đề để cắt block, sau đó xử lý mềm dẻo từng dòng.
+    """
+    # CẮT KHỐI VĂN BẢN (SECTION SLICING)
+    # Tìm header Summary (chứa 'サマリ')
+    idx_summary = -1
+    match_sum = _SUMMARY_HEADER.search(raw_payload)
+    if match_sum: idx_summary = match_sum.start()
+
+    # Tìm header Highlights (chứa 'ハイライト' hoặc '重要発言')
+    idx_high = -1
+    match_high = _HIGHLIGHT_HEADER.search(raw_payload)
+    if match_high: idx_high = match_high.start()
+
+    # Tìm header Reference (chứa '参考' hoặc 'URL')
+    idx_ref = -1
+    match_ref = _REFERENCE_HEADER.search(raw_payload)
+    if match_ref: idx_ref = match_ref.start()
+
+    # Hàm cắt text dựa trên vị trí index
+    def get_section_text(start_idx, next_indices):
+        if start_idx == -1: return ""
+        # Tìm index kế tiếp gần nhất lớn hơn start_idx
+        valid_next = [i for i in next_indices if i > start_idx]
+        end_idx = min(valid_next) if valid_next else len(raw_payload)
+        
+        # Lấy text, bỏ dòng header đầu tiên (tiêu đề section)
+        text_block = raw_payload[start_idx:end_idx].strip()
+        # Xóa dòng đầu tiên (là dòng chứa tiêu đề như 【全体サマリ】)
+        first_newline = text_block.find('\n')
+        if first_newline != -1:
+            return text_block[first_newline+1:].strip()
+        return text_block
+
+    # Lấy nội dung thô từng phần
+    indices = [idx_summary, idx_high, idx_ref, len(raw_payload)]
+    raw_summary = get_section_text(idx_summary, indices)
+    raw_highlights = get_section_text(idx_high, indices)
+    raw_links = get_section_text(idx_ref, indices)
+
+    # XỬ LÝ SUMMARY
+    summary_content = raw_summary
+
+    # XỬ LÝ HIGHLIGHTS
+    highlights = process_highlights(raw_highlights)
+
+    # XỬ LÝ REFERENCE LINKS 
+    reference_links = process_links(raw_links)
+
+    # Construct Final JSON Structure
+    response_structure = {
+        "summary": {
+            "title": "サマリ",
+            "content": summary_content
+        },
+        "highlights": highlights,
+        "reference_links": reference_links
+    }
+    return response_structure
+
+def render_insight_report(insight: dict) -> str:
+    """Dựng lại object Insight (đã parse) thành text markdown làm `inputText` cho Gamma."""
+    lines = []
+    summary = (insight.get("summary") or {}).get("content")
+    if summary:
+        lines += ["# サマリ", "", summary, ""]
+    highlights = insight.get("highlights") or []
+    if highlights:
+        lines += ["# キーハイライト（重要発言）", ""]
+        lines += [f"- 「{h['quote']}」（{h['author_name']}）" for h in highlights]
+        lines.append("")
+    links = insight.get("reference_links") or []
+    if links:
+        lines += ["# 参考URL・資料リンク", ""]
+        lines += [f"- {link['title'] or link['url']}: {link['url']}" for link in links]
+    return "\n".join(lines).strip()
+
+def process_links(raw_links):
+    reference_links = []
+    
+    if raw_links:
+        # Regex tìm URL và Tách chuỗi
+        parts = _URL_SPLIT.split(raw_links)
+        
+        # parts[0] là text rác trước link 1.
+        # Loop từ 1, bước nhảy 2 (Lấy cặp URL, Description)
+        if len(parts) > 1:
+            current_id = 1
+            for i in range(1, len(parts), 2):                
+                url = parts[i].strip()
+                
+                raw_desc = parts[i+1] if i+1 < len(parts) else ""                       # raw_desc là phần text nằm SAU URL hiện tại
+                clean_desc = _LINE_BREAKS.sub(" ", raw_desc)                            # Gộp dòng thành 1 dòng duy nhất
+                clean_desc = _TRAILING_ITEM_NUMBER.sub("", clean_desc)                  # Xóa số thứ tự của item tiếp theo
+                clean_desc = _LEADING_JUNK.sub("", clean_desc.strip())                  # Xóa ký tự rác ở đầu chuỗi
+                clean_desc = clean_desc.strip(" 　（()）")                              # Xóa cả ngoặc tròn fullwidth （） và halfwidth ()
+
+                # Tách title từ description
+                description = clean_desc
+                title = ""
+                
+                delimiters = ["：", "・", "。"]
+                
+                # Tìm delimiter xuất hiện sớm nhất
+                positions = [
+                    (d, clean_desc.find(d))
+                    for d in delimiters
+                    if clean_desc.find(d) != -1
+                ]
+
+                if not positions:
+                    title = clean_desc
+                else:
+                    delimiter, pos = min(positions, key=lambda x: x[1])
+                    title = clean_desc[:pos].strip()
+                    
+                title = title.lstrip("（(").strip() # Clean đề phòng còn rác
+
+                if url: 
+                    reference_links.append({
+                        "id": current_id,
+                        "title": title,       
+                        "description": description, 
+                        "url": url
+                    })
+                    current_id += 1
+                    
+    return reference_links
+
+def process_highlights(raw_highlights):
+    highlights = []
+    if raw_highlights:
+        # Tách dòng, lọc dòng trống
+        lines = [line.strip() for line in raw_highlights.split('\n') if line.strip()]
+        
+        count_id = 1
+        for line in lines:
+            # Bỏ ký tự đầu dòng như "1.", "-", "・"
+            clean_line = _BULLET_PREFIX.sub("", line)
+            
+            # Regex tìm Quote và Author 
+            quote_match = _QUOTE_AUTHOR.search(clean_line)
+            
+            if quote_match:
+                quote = quote_match.group(1).strip()
+                author_name = quote_match.group(2).strip()
+                
+                # Nếu quote quá ngắn (do lỗi parse), bỏ qua
+                if len(quote) > 1: 
+                    highlights.append({
+                        "id": count_id,
+                        "quote": quote,
+                        "author_name": author_name
+                    })
+                    count_id += 1
+    return highlights
+
+def _section_payload(name, raw_text):
+    if name == "summary":
+        return {"title": "サマリ", "content": raw_text}
+    if name == "highlights":
+        return process_highlights(raw_text)
+    return process_links(raw_text)
+
+
+class InsightParser:
+    """
+    Parser incremental cho block Insight của node 'Answer Summary'.
+
+    Nhận từng chunk khi stream tới, chỉ xử lý các dòng vừa hoàn chỉnh (mỗi dòng
+    được quét đúng một lần), và trả về delta của một section ngay khi biết chắc
+    section đó đã kết thúc (gặp tiêu đề section kế tiếp). `finish()` trả về object
+    đầy đủ, cho kết quả giống hệt `format_insight_response` trên toàn bộ text.
+    """
+
+    def __init__(self):
+        self._partial = []          # Các mảnh của dòng chưa kết thúc bằng '\n'
+        self._lines = []            # Các dòng hoàn chỉnh (tính từ sau marker Insight)
+        self._marker_found = False
+        self._marker_pending = False
+        self._reset_sections()
+
+    def _reset_sections(self):
+        self._headers = {}          # section -> index dòng tiêu đề
+        self._open = []             # Section đã thấy tiêu đề nhưng chưa biết điểm kết thúc
+        self._sections = {}         # section -> payload đã xử lý
+
+    def feed(self, chunk: str) -> list:
+        """Nạp thêm một chunk, trả về danh sách delta (dict) của các section vừa chốt."""
+        if not chunk:
+            return []
+        if "\n" not in chunk:
+            self._partial.append(chunk)
+            return []
+
+        pieces = chunk.split("\n")
+        self._partial.append(pieces[0])
+        completed = ["".join(self._partial)] + pieces[1:-1]
+        self._partial = [pieces[-1]] if pieces[-1] else []
+
+        deltas = []
+        for line in completed:
+            deltas.extend(self._on_line(line))
+        return deltas
+
+    def _on_line(self, line: str) -> list:
+        # Marker "[N1s Insight]\n\n": bỏ toàn bộ phần phía trước (chỉ tính lần xuất hiện đầu tiên)
+        if not self._marker_found:
+            if self._marker_pending and line == "":
+                self._marker_found = True
+                self._marker_pending = False
+                self._lines = []
+                self._reset_sections()
+                return []
+            self._marker_pending = line.endswith(INSIGHT_MARKER_LINE)
+
+        index = len(self._lines)
+        self._lines.append(line)
+
+        new_sections = [
+            name for name, pattern in _SECTION_KEYWORDS
+            if name not in self._headers and pattern.search(line)
+        ]
+        if not new_sections:
+            return []
+
+        # Tiêu đề mới -> các section đang mở kết thúc tại dòng này
+        deltas = self._close_open_sections(index)
+        for name in new_sections:
+            self._headers[name] = index
+            self._open.append(name)
+        return deltas
+
+    def _close_open_sections(self, end: int) -> list:
+        deltas = []
+        for name in self._open:
+            block = "\n".join(self._lines[self._headers[name]:end]).strip()
+            # Bỏ dòng tiêu đề (giống get_section_text của format_insight_response)
+            first_newline = block.find("\n")
+            raw_text = block[first_newline + 1:].strip() if first_newline != -1 else block
+            payload = _section_payload(name, raw_text)
+            self._sections[name] = payload
+            deltas.append({name: payload})
+        self._open = []
+        return deltas
+
+    def finish(self) -> dict:
+        """Chốt dòng cuối và các section còn mở, trả về object Insight hoàn chỉnh."""
+        if self._partial:
+            self._on_line("".join(self._partial))
+            self._partial = []
+        self._close_open_sections(len(self._lines))
+        return {
+            "summary": self._sections.get("summary", {"title": "サマリ", "content": ""}),
+            "highlights": self._sections.get("highlights", []),
+            "reference_links": self._sections.get("reference_links", []),
+        }
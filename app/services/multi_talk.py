@@ -0,0 +1,82 @@
+import asyncio
+import logging
+from typing import AsyncIterator
+
+from app.core.sse import SSE_DONE, encode_stream
+from app.services.admission import Lease
+from app.services.dify_service import DifyRun, _dify_chat_frames, _discuss_coalesce_key, build_frame
+from app.services.stream_guard import cancel_run
+
+logger = logging.getLogger(__name__)
+
+
+class TalkTargetRun:
+    """Một persona trong request /n1-talk/multi: payload Dify + run + slot admission riêng."""
+
+    def __init__(self, bot_id: str, payload: dict, api_key: str, run: DifyRun, lease: Lease):
+        self.bot_id = bot_id
+        self.payload = payload
+        self.api_key = api_key
+        self.run = run
+        self.lease = lease
+
+
+async def _run_target(target: TalkTargetRun, queue: asyncio.Queue):
+    """Stream một persona vào queue chung. Lỗi chỉ ảnh hưởng persona này (frame `error` rồi `done`)."""
+    status = "error"
+    conversation_id = None
+    await queue.put(build_frame(target.bot_id, "start", None))
+    try:
+        async for frame in _dify_chat_frames(target.payload, target.api_key, target.run):
+            if frame is SSE_DONE:
+                continue
+            if "text" in frame:
+                await queue.put(build_frame(target.bot_id, "content", frame["text"]))
+            elif "error" in frame:
+                await queue.put(build_frame(target.bot_id, "error", frame["error"]))
+            elif frame.get("is_finished"):
+                status = "completed"
+                conversation_id = frame.get("conversation_id")
+    except Exception as e:
+        logger.exception("Persona %s lỗi không xác định", target.bot_id)
+        await queue.put(build_frame(target.bot_id, "error", str(e)))
+    finally:
+        target.lease.release()
+    await queue.put(build_frame(target.bot_id, "done", {"status": status, "conversation_id": conversation_id}))
+
+
+async def _multi_talk_frames(targets: list) -> AsyncIterator:
+    queue: asyncio.Queue = asyncio.Queue()
+    end = object()
+
+    async def supervise():
+        # TaskGroup: mọi persona bị huỷ cùng nhau khi client ngắt kết nối
+        try:
+            async with asyncio.TaskGroup() as group:
+                for target in targets:
+                    group.create_task(_run_target(target, queue))
+        finally:
+            queue.put_nowait(end)
+
+    # Chạy TaskGroup trong task riêng thay vì yield bên trong nó (yield trong TaskGroup của
+    # async generator làm lệch cancel scope), generator chỉ đọc queue chung
+    supervisor = asyncio.create_task(supervise())
+    try:
+        while True:
+            frame = await queue.get()
+            if frame is end:
+                break
+            yield frame
+        yield SSE_DONE
+    finally:
+        # Đồng bộ: có thể đang bị Starlette huỷ
+        supervisor.cancel()
+        for target in targets:
+            target.lease.release()
+            if not target.run.finished:
+                cancel_run(target.run, "client ngắt kết nối")
+
+
+async def dify_multi_stream_generator(targets: list) -> AsyncIterator[bytes]:
+    async for chunk in encode_stream(_multi_talk_frames(targets), coalesce_key=_discuss_coalesce_key):
+        yield chunk
@@ -0,0 +1,100 @@
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from typing import Optional
+
+from app.core.config import settings
+from app.core.sqlite import SQLiteDatabase
+
+logger = logging.getLogger(__name__)
+
+
+def make_payload_key(payload: dict) -> str:
+    """Hash nội dung payload Gamma (đã chuẩn hoá thứ tự key) làm khoá dedupe."""
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS generations ("
+    "key TEXT PRIMARY KEY, generation_id TEXT, created_at REAL, status TEXT, result TEXT)",
+    "CREATE INDEX IF NOT EXISTS generations_id ON generations (generation_id)",
+)
+
+
+class GenerationStore:
+    """
+    Lưu các generation Gamma gần đây theo hash payload (SQLite, giữ được qua restart).
+    Request giống hệt trong TTL dùng lại generation cũ thay vì tạo mới (tốn thời gian + phí).
+    """
+
+    def __init__(self, path: str):
+        self.db = SQLiteDatabase(path, _SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    async def open(self):
+        await self.db.open()
+
+    def _get(self, key: str) -> Optional[dict]:
+        with self.db.connection() as conn:
+            row = conn.execute(
+                "SELECT generation_id, created_at, status, result FROM generations WHERE key = ? AND created_at >= ?",
+                (key, time.time() - settings.GAMMA_DEDUPE_TTL),
+            ).fetchone()
+        if row is None:
+            return None
+        generation_id, created_at, status, result = row
+        return {
+            "generation_id": generation_id,
+            "created_at": created_at,
+            "status": status,
+            "result": json.loads(result) if result else None,
+        }
+
+    def _put(self, key: str, generation_id: str):
+        now = time.time()
+        with self.db.connection() as conn:
+            conn.execute("DELETE FROM generations WHERE created_at < ?", (now - settings.GAMMA_DEDUPE_TTL,))
+            conn.execute(
+                "INSERT OR REPLACE INTO generations VALUES (?, ?, ?, 'pending', NULL)",
+                (key, generation_id, now),
+            )
+
+    def _complete(self, generation_id: str, status: str, result: dict):
+        with self.db.connection() as conn:
+            if status == "completed":
+                conn.execute(
+                    "UPDATE generations SET status = ?, result = ? WHERE generation_id = ?",
+                    (status, json.dumps(result, ensure_ascii=False), generation_id),
+                )
+            else:
+                # Generation lỗi không được dùng lại, lần sau tạo mới
+                conn.execute("DELETE FROM generations WHERE generation_id = ?", (generation_id,))
+
+    async def get(self, key: str) -> Optional[dict]:
+        entry = await asyncio.to_thread(self._get, key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    async def put(self, key: str, generation_id: str):
+        await asyncio.to_thread(self._put, key, generation_id)
+
+    async def complete(self, generation_id: str, status: str, result: dict):
+        """Ghi kết quả cuối (link export) khi job tracker thấy generation kết thúc."""
+        try:
+            await asyncio.to_thread(self._complete, generation_id, status, result)
+        except sqlite3.Error:
+            logger.exception("Không lưu được kết quả generation %s", generation_id)
+
+    def stats(self) -> dict:
+        return {"enabled": settings.GAMMA_DEDUPE_ENABLED, "hits": self.hits, "misses": self.misses}
+
+
+generation_store = GenerationStore(settings.GAMMA_DEDUPE_DB_PATH)
@@ -0,0 +1,111 @@
+import asyncio
+import hashlib
+import json
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import AsyncIterator, Optional
+
+from app.core.config import settings
+from app.core.sse import DONE_FRAME, scrub_conversation_id
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def make_cache_key(
+    persona: Optional[str], mode: Optional[str], query: str, inputs: Optional[dict], user_id: Optional[str] = None,
+) -> str:
+    """
+    Hash chuẩn hoá (NFKC, gộp khoảng trắng, không phân biệt hoa thường) của một query stateless.
+    `user_id`: giới hạn khoá trong một user (None = dùng chung mọi user).
+    """
+    normalized_query = _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", query)).strip().casefold()
+    raw = json.dumps(
+        [persona or "", mode or "", normalized_query, inputs or {}, user_id or ""],
+        ensure_ascii=False, sort_keys=True, separators=(",", ":"),
+    )
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class ResponseCache:
+    """LRU + TTL + giới hạn tổng dung lượng (byte) cho các SSE frame của /n1-talk."""
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple[float, list[bytes], int]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[list[bytes]]:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, frames: list[bytes]):
+        size = sum(len(f) for f in frames)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, frames, size)
+        self._bytes += size
+        self.stores += 1
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": settings.N1_TALK_CACHE_ENABLED,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+        }
+
+    async def record(self, key: str, stream: AsyncIterator) -> AsyncIterator:
+        """Stream nguyên vẹn cho client, đồng thời lưu lại nếu câu trả lời hoàn chỉnh (có [DONE], không lỗi)."""
+        frames = []
+        completed = True
+        async for frame in stream:
+            if frame.startswith(b'data: {"error"'):
+                completed = False
+            frames.append(frame)
+            yield frame
+        if completed and frames and frames[-1] == DONE_FRAME:
+            self.put(key, [scrub_conversation_id(f, cached=True) for f in frames])
+
+    async def replay(self, frames: list[bytes]) -> AsyncIterator[bytes]:
+        delay = settings.N1_TALK_CACHE_REPLAY_DELAY_MS / 1000
+        for frame in frames:
+            if delay:
+                await asyncio.sleep(delay)
+            yield frame
+
+
+response_cache = ResponseCache(
+    max_entries=settings.N1_TALK_CACHE_MAX_ENTRIES,
+    max_bytes=settings.N1_TALK_CACHE_MAX_BYTES,
+    ttl=settings.N1_TALK_CACHE_TTL,
+)
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+from typing import AsyncIterator
+
+from fastapi import Request
+from app.core.config import settings
+from app.core.sse import ACK_COMMENT, KEEPALIVE_COMMENT
+from app.services.dify_service import DifyRun, stop_dify_task
+
+logger = logging.getLogger(__name__)
+
+# Thời lượng trung bình (EMA) của các run hoàn tất theo loại, để ước tính thời gian upstream tiết kiệm được
+_run_duration_ema: dict[str, float] = {}
+_EMA_ALPHA = 0.2
+
+# Giữ reference tới các task stop chạy nền (tránh bị GC giữa chừng)
+_background_tasks: set = set()
+
+
+def record_duration(kind: str, seconds: float):
+    previous = _run_duration_ema.get(kind)
+    _run_duration_ema[kind] = seconds if previous is None else previous + _EMA_ALPHA * (seconds - previous)
+
+
+def cancel_run(run: DifyRun, reason: str):
+    """Gọi stop-generation của Dify chạy nền (đồng bộ, gọi được trong `finally` / callback)."""
+    if run.stop_requested:
+        return
+    run.stop_requested = True
+    elapsed = time.monotonic() - run.started_at
+    expected = _run_duration_ema.get(run.kind)
+    saved = f"~{max(expected - elapsed, 0.0):.1f}s" if expected is not None else "không rõ"
+    logger.info(
+        "Huỷ Dify %s (task_id=%s, user=%s) do %s sau %.1fs, ước tính tiết kiệm %s upstream",
+        run.kind, run.task_id, run.user, reason, elapsed, saved,
+    )
+    task = asyncio.create_task(stop_dify_task(run))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def guard_disconnect(http_request: Request, stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Đọc stream trong task riêng và theo dõi kết nối của client.
+    Khi client ngắt kết nối: huỷ task đọc ngay (không chờ tới frame kế tiếp mới phát hiện).
+    Upstream không bị huỷ ở đây, xem `BroadcastRun` (app/services/stream_hub.py).
+
+    Gửi comment ack ngay khi bắt đầu và comment keep-alive trong các khoảng upstream im lặng
+    (vd. giữa 2 agent của /discuss) để proxy không buffer / cắt kết nối. Frame `[DONE]` không đổi.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=64)
+    end = object()
+
+    async def pump():
+        try:
+            async for chunk in stream:
+                await queue.put(chunk)
+        except Exception:
+            logger.exception("Stream lỗi không xác định")
+        finally:
+            await stream.aclose()
+        await queue.put(end)
+
+    async def watch():
+        while not await http_request.is_disconnected():
+            await asyncio.sleep(settings.STREAM_DISCONNECT_POLL_INTERVAL)
+
+    pump_task = asyncio.create_task(pump())
+    watch_task = asyncio.create_task(watch())
+    get_task = None
+    heartbeat = settings.SSE_HEARTBEAT_INTERVAL or None
+    try:
+        if settings.SSE_ACK_ENABLED:
+            yield ACK_COMMENT
+        while True:
+            if get_task is None:
+                get_task = asyncio.ensure_future(queue.get())
+            await asyncio.wait({get_task, watch_task}, timeout=heartbeat, return_when=asyncio.FIRST_COMPLETED)
+            if get_task.done():
+                item = get_task.result()
+                get_task = None
+                if item is end:
+                    break
+                yield item
+            elif watch_task.done():
+                # Client đã ngắt kết nối
+                break
+            else:
+                yield KEEPALIVE_COMMENT
+    finally:
+        # Không await trong finally: khi Starlette huỷ response (cancel scope của anyio),
+        # mọi await ở đây sẽ bị huỷ tiếp trước khi kịp dọn dẹp
+        if get_task is not None:
+            get_task.cancel()
+        watch_task.cancel()
+        pump_task.cancel()
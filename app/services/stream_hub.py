@@ -0,0 +1,268 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import deque
+from typing import AsyncIterator, Optional
+
+from app.core.config import settings
+from app.core.sse import encode_frame, scrub_conversation_id
+from app.services.dify_service import ENDPOINT_BY_KIND, DifyRun
+from app.services.stream_guard import cancel_run, record_duration
+
+logger = logging.getLogger(__name__)
+
+
+class StreamGone(Exception):
+    """Offset client yêu cầu đã bị đẩy khỏi ring buffer, không resume được."""
+
+
+class BroadcastRun:
+    """
+    Một lượt chạy Dify được stream độc lập với kết nối của client:
+    task producer đọc upstream và ghi từng frame (kèm `id:` tăng dần) vào ring buffer,
+    mỗi client là một cursor đọc buffer đó. Client rớt mạng có thể nối lại bằng Last-Event-ID.
+    """
+
+    def __init__(self, run: DifyRun, stream: AsyncIterator[bytes], key: Optional[str] = None):
+        self.stream_id = uuid.uuid4().hex
+        self.run = run
+        self.key = key                      # Khoá single-flight (None = không cho join)
+        self._frames: deque = deque()       # Các frame (đã có `id:`) còn giữ trong buffer
+        self.first_seq = 0                  # id của frame cũ nhất còn trong buffer
+        self.next_seq = 0
+        self.bytes = 0
+        self.done = False
+        self.finished_at: Optional[float] = None
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self._grace_handle: Optional[asyncio.TimerHandle] = None
+        self._task = asyncio.create_task(self._produce(stream))
+
+    async def _produce(self, stream: AsyncIterator[bytes]):
+        try:
+            async for chunk in stream:
+                self._append(chunk)
+        except Exception:
+            logger.exception("Stream Dify %s (%s) lỗi không xác định", self.run.kind, self.stream_id)
+        finally:
+            await stream.aclose()
+            self.done = True
+            self.finished_at = time.monotonic()
+            if self.run.finished:
+                record_duration(self.run.kind, self.finished_at - self.run.started_at)
+            else:
+                # Upstream bị cắt (treo quá timeout, đứt kết nối...): task trên Dify có thể vẫn chạy
+                cancel_run(self.run, "stream upstream kết thúc bất thường")
+            self._notify()
+            stream_hub._on_done(self)
+
+    def _append(self, chunk: bytes):
+        self._frames.append(b"id: %d\n" % self.next_seq + chunk)
+        self.next_seq += 1
+        self.bytes += len(self._frames[-1])
+        while len(self._frames) > settings.STREAM_BUFFER_MAX_FRAMES or self.bytes > settings.STREAM_BUFFER_MAX_BYTES:
+            self.bytes -= len(self._frames.popleft())
+            self.first_seq += 1
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def check_resume(self, last_event_id: Optional[int]):
+        if last_event_id is not None and last_event_id + 1 < self.first_seq:
+            raise StreamGone(self.stream_id)
+
+    async def subscribe(self, last_event_id: Optional[int] = None, scrub: bool = False) -> AsyncIterator[bytes]:
+        """
+        Đọc các frame sau `last_event_id` (None = từ đầu), rồi tiếp tục theo live tail.
+        `scrub`: client không phải người tạo run (join single-flight) -> không nhận conversation_id của người tạo.
+        """
+        cursor = 0 if last_event_id is None else last_event_id + 1
+        self._attach()
+        try:
+            while True:
+                while cursor < self.next_seq:
+                    if cursor < self.first_seq:
+                        # Client đọc quá chậm, phần chưa đọc đã bị đẩy khỏi buffer
+                        yield encode_frame({'error': 'Stream bị mất dữ liệu do client đọc quá chậm'})
+                        return
+                    frame = self._frames[cursor - self.first_seq]
+                    cursor += 1
+                    yield scrub_conversation_id(frame, single_flight=True) if scrub else frame
+                if self.done:
+                    return
+                await self._changed.wait()
+        finally:
+            self._detach()
+
+    def _attach(self):
+        self.subscribers += 1
+        if self._grace_handle is not None:
+            self._grace_handle.cancel()
+            self._grace_handle = None
+
+    def _detach(self):
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.done:
+            # Giữ run thêm một khoảng để client kịp nối lại, sau đó mới huỷ upstream
+            self._grace_handle = asyncio.get_running_loop().call_later(
+                settings.STREAM_DETACH_GRACE, self._abandon
+            )
+
+    def _abandon(self):
+        self._grace_handle = None
+        if self.subscribers == 0 and not self.done:
+            self.abort("client ngắt kết nối")
+
+    def abort(self, reason: str):
+        if not self.run.finished:
+            cancel_run(self.run, reason)
+        self._task.cancel()
+
+
+class StreamHub:
+    """Registry các BroadcastRun theo stream_id, giới hạn TTL + số lượng + tổng dung lượng buffer."""
+
+    def __init__(self):
+        self._runs: dict[str, BroadcastRun] = {}
+        self._inflight: dict[str, BroadcastRun] = {}   # Khoá single-flight -> run đang chạy
+        self._drained = asyncio.Event()
+        self._drain_task: Optional[asyncio.Task] = None
+        # Stream đi thẳng tới client, không qua BroadcastRun (vd. /n1-talk/multi): task -> (endpoint, số run Dify)
+        self._direct: dict[asyncio.Task, tuple] = {}
+        self._stopping: set = set()         # Task bị drain huỷ khi hết hạn
+        self.started = 0
+        self.resumed = 0
+        self.joined = 0                     # Số request dùng chung run có sẵn = số run Dify tiết kiệm được
+
+    def start(self, run: DifyRun, stream: AsyncIterator[bytes], key: Optional[str] = None) -> BroadcastRun:
+        self._prune()
+        broadcast = BroadcastRun(run, stream, key)
+        self._runs[broadcast.stream_id] = broadcast
+        if key is not None:
+            self._inflight[key] = broadcast
+        self._drained.clear()
+        self.started += 1
+        return broadcast
+
+    def join(self, key: str) -> Optional[BroadcastRun]:
+        """
+        Run đang chạy với cùng khoá. Người vào sau đọc lại từ frame đầu tiên rồi theo live tail,
+        nên chỉ join được khi buffer còn đủ từ đầu và run chưa bị huỷ.
+        """
+        broadcast = self._inflight.get(key)
+        if broadcast is None or broadcast.done or broadcast.first_seq > 0 or broadcast.run.stop_requested:
+            return None
+        self.joined += 1
+        return broadcast
+
+    def get(self, stream_id: str) -> Optional[BroadcastRun]:
+        self._prune()
+        return self._runs.get(stream_id)
+
+    def live(self) -> list:
+        return [b for b in self._runs.values() if not b.done]
+
+    async def track(self, kind: str, stream: AsyncIterator[bytes], runs: int = 1) -> AsyncIterator[bytes]:
+        """
+        Đếm một stream không đi qua BroadcastRun (không resume được) vào metric theo endpoint và drain:
+        khi tắt server, drain chờ cả stream này, hết hạn thì huỷ việc đọc stream (finally của stream
+        trả slot + stop run trên Dify) và kết thúc response bình thường.
+        """
+        task = asyncio.current_task()
+        self._direct[task] = (ENDPOINT_BY_KIND.get(kind, kind), runs)
+        self._drained.clear()
+        try:
+            async for chunk in stream:
+                yield chunk
+        except asyncio.CancelledError:
+            if task not in self._stopping:
+                raise
+            task.uncancel()
+        finally:
+            self._direct.pop(task, None)
+            self._stopping.discard(task)
+            self._check_drained()
+
+    def _on_done(self, broadcast: BroadcastRun):
+        if broadcast.key is not None and self._inflight.get(broadcast.key) is broadcast:
+            del self._inflight[broadcast.key]
+        self._check_drained()
+
+    def _check_drained(self):
+        if not self.live() and not self._direct:
+            self._drained.set()
+
+    def _prune(self):
+        now = time.monotonic()
+        for stream_id, b in list(self._runs.items()):
+            if b.done and now - b.finished_at > settings.STREAM_RESUME_TTL:
+                del self._runs[stream_id]
+
+        # Vượt giới hạn: bỏ các run đã xong cũ nhất trước (run đang chạy đã bị giới hạn bởi admission)
+        finished = sorted((b for b in self._runs.values() if b.done), key=lambda b: b.finished_at)
+        total = sum(b.bytes for b in self._runs.values())
+        while finished and (len(self._runs) >= settings.STREAM_RESUME_MAX_RUNS or total > settings.STREAM_RESUME_MAX_BYTES):
+            b = finished.pop(0)
+            total -= b.bytes
+            del self._runs[b.stream_id]
+
+    def start_drain(self, timeout: float) -> asyncio.Task:
+        """Bắt đầu drain nếu chưa chạy. Gọi lại trả về task đang chạy: deadline tính từ lần gọi đầu tiên."""
+        if self._drain_task is None:
+            self._drain_task = asyncio.get_running_loop().create_task(self.drain(timeout))
+        return self._drain_task
+
+    async def finish_drain(self, timeout: float):
+        """Chờ drain đã bắt đầu (hoặc bắt đầu ngay với `timeout` nếu chưa)."""
+        try:
+            await self.start_drain(timeout)
+        finally:
+            self._drain_task = None
+
+    async def drain(self, timeout: float):
+        """Chờ các run đang chạy kết thúc (tối đa `timeout` giây), phần còn lại bị huỷ + stop trên Dify."""
+        live = self.live()
+        if not live and not self._direct:
+            return
+        logger.info("Đang chờ %d stream kết thúc trước khi tắt (tối đa %.0fs)", len(live) + len(self._direct), timeout)
+        try:
+            await asyncio.wait_for(self._drained.wait(), timeout)
+        except asyncio.TimeoutError:
+            live = self.live()
+            direct = list(self._direct)
+            logger.warning("Hết thời gian drain, huỷ %d stream còn lại", len(live) + len(direct))
+            for b in live:
+                b.abort("server tắt")
+            for task in direct:
+                self._stopping.add(task)
+                task.cancel()
+            await asyncio.gather(*(b._task for b in live), *direct, return_exceptions=True)
+
+    def by_endpoint(self) -> dict:
+        """endpoint -> (số run đang chạy, số client đang đọc stream)."""
+        result = {}
+        for b in self._runs.values():
+            endpoint = ENDPOINT_BY_KIND.get(b.run.kind, b.run.kind)
+            live, subscribers = result.get(endpoint, (0, 0))
+            result[endpoint] = (live + (0 if b.done else 1), subscribers + b.subscribers)
+        for endpoint, runs in self._direct.values():
+            live, subscribers = result.get(endpoint, (0, 0))
+            result[endpoint] = (live + runs, subscribers + 1)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "runs": len(self._runs),
+            "live": len(self.live()),
+            "subscribers": sum(b.subscribers for b in self._runs.values()),
+            "buffer_bytes": sum(b.bytes for b in self._runs.values()),
+            "started": self.started,
+            "resumed": self.resumed,
+            "single_flight_joined": self.joined,
+        }
+
+
+stream_hub = StreamHub()
@@ -0,0 +1,247 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+import uuid
+from collections import deque
+from typing import Optional
+
+from app.core.config import settings
+from app.core.sqlite import SQLiteDatabase
+
+logger = logging.getLogger(__name__)
+
+# Khoảng thời gian (giây) giữa 2 lần dọn dữ liệu theo TTL / dung lượng
+_PRUNE_INTERVAL = 60.0
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS discussions ("
+    "id TEXT PRIMARY KEY, user_id TEXT, query TEXT, status TEXT, "
+    "created_at REAL, finished_at REAL, insight TEXT, bytes INTEGER)",
+    "CREATE INDEX IF NOT EXISTS discussions_created ON discussions (created_at)",
+    "CREATE TABLE IF NOT EXISTS messages ("
+    "discussion_id TEXT, seq INTEGER, bot_id TEXT, text TEXT, PRIMARY KEY (discussion_id, seq))",
+)
+
+
+class TranscriptStore:
+    """
+    Lưu transcript từng bot + Insight của mỗi phiên /discuss (SQLite, giữ được qua restart)
+    để `/create-report` nhận `discussion_id` thay vì client upload lại toàn bộ nội dung.
+
+    Vòng lặp stream chỉ đẩy thao tác vào hàng đợi (đồng bộ, không await, gọi được trong `finally`);
+    writer chạy nền gom batch ghi trong một transaction. Hàng đợi đầy thì bỏ các message mới (đếm `dropped`)
+    thay vì làm chậm stream; start / insight / finish luôn được nhận để phiên không bị kẹt ở `running`.
+    Phiên vẫn `running` quá TRANSCRIPT_RUNNING_MAX_AGE (worker chết giữa chừng) được đọc ra là `interrupted`.
+    Dữ liệu cũ bị xoá theo TTL, số phiên và tổng dung lượng.
+    """
+
+    def __init__(self, path: str):
+        self.db = SQLiteDatabase(path, _SCHEMA)
+        self._queue: deque = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._flushed: Optional[asyncio.Condition] = None
+        self._enqueued = 0          # Số thao tác đã nhận (kể cả bị bỏ), dùng cho flush()
+        self._processed = 0
+        self._last_prune = 0.0
+        self.written = 0
+        self.dropped = 0
+
+    async def open(self):
+        await self.db.open()
+
+    # --- Phía stream: đồng bộ, không bao giờ chờ I/O ---
+
+    def _submit(self, op: tuple):
+        self._enqueued += 1
+        if op[0] == "message" and len(self._queue) >= settings.TRANSCRIPT_QUEUE_MAX:
+            self.dropped += 1
+            self._processed += 1
+            return
+        self._queue.append(op)
+        self._ensure_writer()
+        if len(self._queue) >= settings.TRANSCRIPT_BATCH_SIZE:
+            self._wakeup.set()
+
+    def _ensure_writer(self):
+        if self._writer is None or self._writer.done():
+            self._wakeup = asyncio.Event()
+            self._flushed = asyncio.Condition()
+            self._writer = asyncio.create_task(self._write_loop())
+
+    def recorder(self, user_id: str, query: str) -> "DiscussionRecorder":
+        return DiscussionRecorder(self, uuid.uuid4().hex, user_id, query)
+
+    # --- Writer nền ---
+
+    async def _write_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), settings.TRANSCRIPT_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self._write_pending()
+
+    async def _write_pending(self):
+        while self._queue:
+            batch = []
+            while self._queue and len(batch) < settings.TRANSCRIPT_BATCH_SIZE:
+                batch.append(self._queue.popleft())
+            try:
+                await asyncio.to_thread(self._write_batch, batch)
+                self.written += len(batch)
+            except sqlite3.Error:
+                self.dropped += len(batch)
+                logger.exception("Không ghi được %d thao tác transcript", len(batch))
+            self._processed += len(batch)
+            async with self._flushed:
+                self._flushed.notify_all()
+
+    def _write_batch(self, batch: list):
+        now = time.time()
+        with self.db.connection() as conn:
+            conn.execute("BEGIN")
+            for op, discussion_id, *args in batch:
+                if op == "start":
+                    user_id, query, created_at = args
+                    conn.execute(
+                        "INSERT OR REPLACE INTO discussions VALUES (?, ?, ?, 'running', ?, NULL, NULL, ?)",
+                        (discussion_id, user_id, query, created_at, len(query.encode())),
+                    )
+                elif op == "message":
+                    seq, bot_id, text = args
+                    conn.execute("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)", (discussion_id, seq, bot_id, text))
+                    conn.execute(
+                        "UPDATE discussions SET bytes = bytes + ? WHERE id = ?", (len(text.encode()), discussion_id),
+                    )
+                elif op == "insight":
+                    (insight,) = args
+                    raw = json.dumps(insight, ensure_ascii=False)
+                    conn.execute(
+                        "UPDATE discussions SET insight = ?, bytes = bytes + ? WHERE id = ?",
+                        (raw, len(raw.encode()), discussion_id),
+                    )
+                elif op == "finish":
+                    status, finished_at = args
+                    conn.execute(
+                        "UPDATE discussions SET status = ?, finished_at = ? WHERE id = ?", (status, finished_at, discussion_id),
+                    )
+            conn.execute("COMMIT")
+            if now - self._last_prune >= _PRUNE_INTERVAL:
+                self._last_prune = now
+                self._prune(conn, now)
+
+    def _prune(self, conn, now: float):
+        conn.execute("DELETE FROM discussions WHERE created_at < ?", (now - settings.TRANSCRIPT_TTL,))
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM discussions").fetchone()
+        if count > settings.TRANSCRIPT_MAX_DISCUSSIONS or total > settings.TRANSCRIPT_MAX_BYTES:
+            # Xoá các phiên cũ nhất tới khi về dưới giới hạn
+            doomed = []
+            for discussion_id, size in conn.execute("SELECT id, bytes FROM discussions ORDER BY created_at"):
+                if count <= settings.TRANSCRIPT_MAX_DISCUSSIONS and total <= settings.TRANSCRIPT_MAX_BYTES:
+                    break
+                doomed.append((discussion_id,))
+                count -= 1
+                total -= size or 0
+            conn.executemany("DELETE FROM discussions WHERE id = ?", doomed)
+        conn.execute("DELETE FROM messages WHERE discussion_id NOT IN (SELECT id FROM discussions)")
+
+    async def flush(self):
+        """Chờ mọi thao tác đã nhận tới thời điểm gọi được ghi xong."""
+        if self._writer is None or self._writer.done():
+            if self._queue:
+                await self._write_pending()
+            return
+        target = self._enqueued
+        self._wakeup.set()
+        async with self._flushed:
+            await self._flushed.wait_for(lambda: self._processed >= target)
+
+    async def close(self):
+        """Ghi nốt hàng đợi khi tắt server."""
+        if self._writer is not None:
+            self._writer.cancel()
+            await asyncio.gather(self._writer, return_exceptions=True)
+            self._writer = None
+        if self._queue:
+            await self._write_pending()
+
+    # --- Đọc ---
+
+    def _get(self, discussion_id: str) -> Optional[dict]:
+        with self.db.connection() as conn:
+            row = conn.execute(
+                "SELECT user_id, query, status, created_at, finished_at, insight FROM discussions WHERE id = ?",
+                (discussion_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            messages = conn.execute(
+                "SELECT bot_id, text FROM messages WHERE discussion_id = ? ORDER BY seq", (discussion_id,),
+            ).fetchall()
+        user_id, query, status, created_at, finished_at, insight = row
+        if status == "running" and time.time() - created_at > settings.TRANSCRIPT_RUNNING_MAX_AGE:
+            # Không bao giờ nhận được finish (worker chết giữa chừng): trả phần đã lưu
+            status = "interrupted"
+        return {
+            "discussion_id": discussion_id,
+            "user_id": user_id,
+            "query": query,
+            "status": status,
+            "created_at": created_at,
+            "finished_at": finished_at,
+            "insight": json.loads(insight) if insight else None,
+            "messages": [{"bot_id": bot_id, "text": text} for bot_id, text in messages],
+        }
+
+    async def get(self, discussion_id: str) -> Optional[dict]:
+        # Client thường gọi /create-report ngay sau [DONE]: ghi nốt phần còn trong hàng đợi trước khi đọc
+        await self.flush()
+        return await asyncio.to_thread(self._get, discussion_id)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": settings.TRANSCRIPT_ENABLED,
+            "queued": len(self._queue),
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+
+class DiscussionRecorder:
+    """Gom text của từng bot trong một phiên /discuss, đẩy vào store khi mỗi bot kết thúc."""
+
+    def __init__(self, store: TranscriptStore, discussion_id: str, user_id: str, query: str):
+        self.store = store
+        self.discussion_id = discussion_id
+        self._parts: dict[str, list] = {}
+        self._seq = 0
+        self.finished = False
+        store._submit(("start", discussion_id, user_id, query, time.time()))
+
+    def text(self, bot_id: str, text: str):
+        self._parts.setdefault(bot_id, []).append(text)
+
+    def bot_done(self, bot_id: str):
+        parts = self._parts.pop(bot_id, None)
+        if parts:
+            self._seq += 1
+            self.store._submit(("message", self.discussion_id, self._seq, bot_id, "".join(parts)))
+
+    def insight(self, insight: dict):
+        self.store._submit(("insight", self.discussion_id, insight))
+
+    def finish(self, status: str):
+        if self.finished:
+            return
+        self.finished = True
+        # Bot đang nói dở khi stream kết thúc (lỗi / huỷ) vẫn được lưu phần đã nhận
+        for bot_id in list(self._parts):
+            self.bot_done(bot_id)
+        self.store._submit(("finish", self.discussion_id, status, time.time()))
+
+
+transcript_store = TranscriptStore(settings.TRANSCRIPT_DB_PATH)
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import logging
+from typing import Optional
+
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect
+from pydantic import ValidationError
+
+from app.core.config import settings
+from app.core.resilience import raise_if_open
+from app.core.sse import SSE_DONE, dumps, maybe_coalesce
+from app.schemas.chat import ChatRequest
+from app.services.admission import POOL_INTERACTIVE, POOL_WORKFLOW, admission
+from app.services.dify_service import (
+    DifyRun, _chat_coalesce_key, _dify_chat_frames, _dify_discuss_frames, _discuss_coalesce_key,
+    pick_backend,
+)
+from app.services.stream_guard import cancel_run
+from app.services.transcript_store import transcript_store
+
+logger = logging.getLogger(__name__)
+
+# Mã đóng WebSocket khi client nhận quá chậm (1008 = policy violation)
+_CLOSE_SLOW_CLIENT = 1008
+
+
+class SessionStats:
+    def __init__(self):
+        self.sessions = 0           # Kết nối đang mở
+        self.inflight = 0           # Request đang chạy trên mọi kết nối
+        self.requests = 0
+        self.cancelled = 0
+        self.slow_client_closed = 0
+
+
+session_stats = SessionStats()
+
+
+class ChatSession:
+    """
+    Một kết nối WebSocket dùng cho nhiều lượt chat / discuss, mỗi request có `id` do client đặt.
+
+    Flow control: mọi stream của kết nối ghi vào một hàng đợi gửi giới hạn (WS_SEND_QUEUE_SIZE).
+    Client đọc chậm -> hàng đợi đầy -> các stream dừng đọc Dify (backpressure về tận upstream)
+    thay vì server buffer vô hạn. Client không nhận gì quá WS_SEND_TIMEOUT thì bị đóng kết nối.
+    """
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self._outbox: asyncio.Queue = asyncio.Queue(maxsize=settings.WS_SEND_QUEUE_SIZE)
+        self._requests: dict[str, asyncio.Task] = {}
+
+    async def serve(self):
+        await self.websocket.accept()
+        session_stats.sessions += 1
+        receiver = asyncio.create_task(self._receive_loop())
+        sender = asyncio.create_task(self._send_loop())
+        try:
+            done, _ = await asyncio.wait({receiver, sender}, return_when=asyncio.FIRST_COMPLETED)
+            if sender in done and isinstance(sender.exception(), asyncio.TimeoutError):
+                session_stats.slow_client_closed += 1
+                logger.warning("Đóng WebSocket: client không nhận dữ liệu quá %.0fs", settings.WS_SEND_TIMEOUT)
+                try:
+                    await asyncio.wait_for(self.websocket.close(code=_CLOSE_SLOW_CLIENT), 1.0)
+                except Exception:
+                    pass
+        finally:
+            session_stats.sessions -= 1
+            receiver.cancel()
+            sender.cancel()
+            for task in list(self._requests.values()):
+                task.cancel()
+
+    async def _receive_loop(self):
+        try:
+            while True:
+                raw = await self.websocket.receive_text()
+                try:
+                    message = json.loads(raw)
+                except ValueError:
+                    await self._send(None, "error", status=400, detail="Message không phải JSON")
+                    continue
+                if not isinstance(message, dict):
+                    await self._send(None, "error", status=400, detail="Message phải là JSON object")
+                    continue
+                await self._handle(message)
+        except WebSocketDisconnect:
+            pass
+
+    async def _send_loop(self):
+        while True:
+            message = await self._outbox.get()
+            await asyncio.wait_for(self.websocket.send_text(message), settings.WS_SEND_TIMEOUT)
+
+    async def _send(self, request_id: Optional[str], type: str, **fields):
+        message = {"id": request_id, "type": type, **fields}
+        await self._outbox.put(dumps(message).decode())
+
+    async def _handle(self, message: dict):
+        type = message.get("type")
+        request_id = message.get("id")
+        if type == "ping":
+            await self._send(request_id, "pong")
+            return
+        if not isinstance(request_id, str) or not request_id:
+            await self._send(None, "error", status=400, detail="Thiếu `id` của request")
+            return
+
+        if type == "cancel":
+            task = self._requests.get(request_id)
+            if task is not None:
+                task.cancel()
+            return
+
+        if type not in ("chat", "discuss"):
+            await self._send(request_id, "error", status=400, detail=f"Loại message không hỗ trợ: {type}")
+            return
+        if request_id in self._requests:
+            await self._send(request_id, "error", status=409, detail="Request id đang được sử dụng")
+            return
+        if len(self._requests) >= settings.WS_MAX_INFLIGHT:
+            await self._send(
+                request_id, "error", status=429,
+                detail=f"Tối đa {settings.WS_MAX_INFLIGHT} request đồng thời trên một kết nối",
+            )
+            return
+        try:
+            request = ChatRequest.model_validate(message)
+        except ValidationError as e:
+            await self._send(request_id, "error", status=422, detail=e.errors(include_url=False, include_context=False))
+            return
+
+        task = asyncio.create_task(self._run_request(type, request_id, request))
+        self._requests[request_id] = task
+        session_stats.requests += 1
+        session_stats.inflight += 1
+
+    async def _open(self, type: str, request: ChatRequest):
+        """Chọn key + kiểm tra breaker / admission như endpoint HTTP tương ứng. Raise HTTPException."""
+        if type == "chat":
+            backend = await pick_backend(request.target_persona, request.mode, request.conversation_id)
+            if not backend:
+                raise HTTPException(status_code=400, detail=f"Cấu hình lỗi cho {request.target_persona}")
+            raise_if_open(backend.breaker)
+            lease = await admission.admit(request.user_id, POOL_INTERACTIVE, request.target_persona, request.mode)
+            run = DifyRun(backend.api_key, request.user_id, kind="chat", persona=request.target_persona, mode=request.mode, backend=backend)
+        else:
+            backend = await pick_backend("DISCUSS", "default", request.conversation_id)
+            if not backend:
+                raise HTTPException(status_code=500, detail="Chưa cấu hình DIFY_KEY_DISCUSS")
+            raise_if_open(backend.breaker)
+            lease = await admission.admit(request.user_id, POOL_WORKFLOW, "DISCUSS")
+            run = DifyRun(backend.api_key, request.user_id, kind="discuss", persona="DISCUSS", backend=backend)
+            if settings.TRANSCRIPT_ENABLED:
+                run.recorder = transcript_store.recorder(request.user_id, request.query)
+        return backend.api_key, lease, run
+
+    async def _run_request(self, type: str, request_id: str, request: ChatRequest):
+        lease = run = None
+        try:
+            try:
+                api_key, lease, run = await self._open(type, request)
+            except HTTPException as e:
+                retry_after = (e.headers or {}).get("Retry-After")
+                await self._send(request_id, "error", status=e.status_code, detail=e.detail, retry_after=retry_after)
+                return
+
+            payload = {
+                "inputs": request.inputs or {},
+                "query": request.query,
+                "response_mode": "streaming",
+                "conversation_id": request.conversation_id,
+                "user": request.user_id,
+                "auto_generate_name": False
+            }
+            if type == "chat":
+                frames = maybe_coalesce(_dify_chat_frames(payload, api_key, run), _chat_coalesce_key)
+            else:
+                frames = maybe_coalesce(_dify_discuss_frames(payload, api_key, run, request.auto_report), _discuss_coalesce_key)
+
+            if run.recorder is not None:
+                await self._send(request_id, "start", discussion_id=run.recorder.discussion_id)
+            else:
+                await self._send(request_id, "start")
+            try:
+                async for frame in frames:
+                    if frame is SSE_DONE:
+                        continue
+                    # Frame giống hệt `data:` của SSE, bọc thêm id request
+                    await self._send(request_id, "frame", data=frame)
+            finally:
+                await frames.aclose()
+            await self._send(request_id, "done")
+        except asyncio.CancelledError:
+            session_stats.cancelled += 1
+            # Client huỷ riêng request này (kết nối vẫn mở) -> báo lại, không chờ nếu hàng đợi đầy
+            try:
+                self._outbox.put_nowait(dumps({"id": request_id, "type": "cancelled"}).decode())
+            except asyncio.QueueFull:
+                pass
+            raise
+        except Exception as e:
+            logger.exception("Request WebSocket %s lỗi không xác định", request_id)
+            await self._send(request_id, "error", status=500, detail=str(e))
+        finally:
+            session_stats.inflight -= 1
+            self._requests.pop(request_id, None)
+            if lease is not None:
+                lease.release()
+            if run is not None and not run.finished:
+                cancel_run(run, "client huỷ request qua WebSocket")
@@ -0,0 +1,91 @@
+"""
+Microbenchmark: parser Insight incremental so với format_insight_response.
+
+Chạy: python -m benchmarks.insight_parser_bench [--sections 200] [--chunk 8]
+
+- one-shot:    format_insight_response trên toàn bộ text (1 lần, sau khi stream xong)
+- per-chunk:   format_insight_response trên buffer tích luỹ sau mỗi chunk
+               (cách "đúng" nếu muốn cập nhật Insight khi đang stream -> O(n^2))
+- incremental: InsightParser.feed() từng chunk + finish()
+"""
+import argparse
+import time
+
+from app.services.insight_parser import INSIGHT_MARKER, InsightParser, format_insight_response
+
+
+def build_payload(sections: int) -> str:
+    summary = "\n\n".join(
+        f"市場ニーズやビジネス価値として既存事業の非連続成長を生み出す領域 {i}。" for i in range(sections)
+    )
+    highlights = "\n".join(
+        f"- 「現場の痛みを直接解消できるソリューションこそ価値がある {i}」（CEO 釜持）" for i in range(sections)
+    )
+    links = "\n\n".join(
+        f"{i + 1}. https://example.com/articles/{i}  \n　（生成AIによる経済効果とROI向上策：参考資料 {i}）"
+        for i in range(sections)
+    )
+    return (
+        f"前置き\n{INSIGHT_MARKER}【全体サマリ】\n{summary}\n\n"
+        f"【キーハイライト（重要発言）】\n\n{highlights}\n\n"
+        f"【参考URL・資料リンク】\n\n{links}\n"
+    )
+
+
+def chunked(text: str, size: int) -> list:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def one_shot(text: str, chunks: list):
+    return format_insight_response(text.split(INSIGHT_MARKER, 1)[-1].strip())
+
+
+def per_chunk(text: str, chunks: list):
+    buffer = ""
+    result = None
+    for chunk in chunks:
+        buffer += chunk
+        result = format_insight_response(buffer.split(INSIGHT_MARKER, 1)[-1].strip())
+    return result
+
+
+def incremental(text: str, chunks: list):
+    parser = InsightParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.finish()
+
+
+def bench(func, text: str, chunks: list, repeat: int):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(text, chunks)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--sections", type=int, nargs="+", default=[10, 50, 200])
+    arg_parser.add_argument("--chunk", type=int, default=8, help="Số ký tự mỗi chunk (giống text_chunk của Dify)")
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    args = arg_parser.parse_args()
+
+    print(f"{'sections':>8} {'chars':>8} {'chunks':>7} {'one-shot':>11} {'per-chunk':>11} {'incremental':>12}")
+    for sections in args.sections:
+        text = build_payload(sections)
+        chunks = chunked(text, args.chunk)
+        t_one, expected = bench(one_shot, text, chunks, args.repeat)
+        t_per, _ = bench(per_chunk, text, chunks, 1)
+        t_inc, result = bench(incremental, text, chunks, args.repeat)
+        assert result == expected, "InsightParser cho kết quả khác format_insight_response"
+        print(
+            f"{sections:>8} {len(text):>8} {len(chunks):>7} "
+            f"{t_one * 1000:>9.2f}ms {t_per * 1000:>9.2f}ms {t_inc * 1000:>10.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
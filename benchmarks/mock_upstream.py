@@ -0,0 +1,249 @@
+"""
+Server giả lập Dify + Gamma để đo hiệu năng / test local mà không gọi API thật.
+
+Chạy: python -m benchmarks.mock_upstream [--port 9100] [--token-rate 50] [--jitter-ms 5] [--error-rate 0.0]
+
+Trỏ app vào mock:
+    DIFY_API_URL=http://127.0.0.1:9100/v1
+    GAMMA_API_URL=http://127.0.0.1:9100/v1.0
+    DIFY_KEY_DISCUSS=mock-discuss        # Key có chữ "discuss" -> trace workflow thảo luận
+    DIFY_KEY_TECH_RESPONSE=mock-chat     # Key khác -> trace chat thường
+
+- POST /v1/chat-messages: phát trace SSE tổng hợp (tiếng Nhật) hoặc trace ghi lại (`--chat-trace` / `--workflow-trace`,
+  file chứa các dòng `data: {...}` lấy từ Dify thật), text_chunk / message được phát theo `--token-rate` + jitter.
+- POST /v1/chat-messages/{task_id}/stop: huỷ run đang phát.
+- POST /v1.0/generations, GET /v1.0/generations/{id}: Gamma giả, job xong sau `--gamma-seconds`.
+- Lỗi giả lập: `--error-rate` (HTTP 503 lúc mở stream), `--drop-rate` (đứt stream giữa chừng),
+  `--gamma-429-rate` (Gamma trả 429 + Retry-After).
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from typing import Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+BOT_TITLES = ["経営者", "事業開発エキスパート", "AI・DXテクニカルエキスパート", "Facilitator"]
+
+SENTENCES = [
+    "市場ニーズやビジネス価値としては、単なる効率化ではなく既存事業の非連続成長を生み出す領域が重要です。",
+    "現場の未解決課題を直接解消するソリューションに集中投資すべきだと考えます。",
+    "収益性やROIの観点では、既存アセット×AIによるバリューアップが有効です。",
+    "マイクロサービス＋APIファースト設計により拡張性と現場適応速度を確保します。",
+    "PoC疲れや運用負荷などのリスク管理にも注意が必要です。",
+]
+
+INSIGHT_TEXT = (
+    "[N1s Insight]\n\n【全体サマリ】\n"
+    + "".join(SENTENCES)
+    + "\n\n【キーハイライト（重要発言）】\n\n"
+    + "- 「単なる効率化ではなく、現場の痛みを直接解消できるソリューションこそ価値がある」（CEO）\n"
+    + "- 「まず顧客に聞き、小さく売り、執念深く改善し続けること」（事業開発）\n"
+    + "\n【参考URL・資料リンク】\n\n"
+    + "1. https://example.com/generative-ai-roi  \n　（生成AIによる経済効果とROI向上策）\n\n"
+    + "2. https://example.com/ai-trends  \n　（AIトレンドと業界特化型AI）\n"
+)
+
+
+class MockConfig:
+    token_rate = 50.0           # token / giây cho mỗi stream (0 = không giới hạn)
+    jitter_ms = 5.0
+    error_rate = 0.0
+    drop_rate = 0.0
+    tokens_per_agent = 120
+    gamma_seconds = 5.0
+    gamma_429_rate = 0.0
+    chat_trace: Optional[list] = None
+    workflow_trace: Optional[list] = None
+
+
+config = MockConfig()
+app = FastAPI(title="Mock Dify / Gamma")
+
+_stopped: set = set()
+_generations: dict = {}
+stats = {"streams": 0, "stops": 0, "errors": 0, "drops": 0, "gamma_creates": 0, "gamma_polls": 0}
+
+
+def _tokens(count: int) -> list:
+    """Cắt text tiếng Nhật thành các "token" 2-4 ký tự giống text_chunk của Dify."""
+    text = "".join(random.choice(SENTENCES) for _ in range(count // 20 + 1))
+    tokens, i = [], 0
+    while i < len(text) and len(tokens) < count:
+        size = random.randint(2, 4)
+        tokens.append(text[i:i + size])
+        i += size
+    return tokens
+
+
+def _chunk(text: str, size: int = 3) -> list:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def _event(event: str, task_id: str, **fields) -> dict:
+    return {"event": event, "task_id": task_id, "message_id": task_id, "created_at": int(time.time()), **fields}
+
+
+def synthetic_chat(task_id: str) -> list:
+    tokens = _tokens(config.tokens_per_agent)
+    events = [_event("message", task_id, answer=token) for token in tokens]
+    events.append(_event(
+        "message_end", task_id, conversation_id=str(uuid.uuid4()),
+        metadata={"usage": {"completion_tokens": len(tokens), "prompt_tokens": 200}},
+    ))
+    return events
+
+
+def synthetic_workflow(task_id: str) -> list:
+    """Trace giống workflow thảo luận: node không liên quan + 4 agent + Answer Summary."""
+    big_inputs = {"sys.query": "今年のAI開発戦略", "context": "x" * 4000}
+    events = [_event("workflow_started", task_id, data={"id": task_id})]
+    total_tokens = 0
+    nodes = [("Knowledge Retrieval", None)] + [(title, _tokens(config.tokens_per_agent)) for title in BOT_TITLES]
+    nodes.append(("Answer Summary", _chunk(INSIGHT_TEXT)))
+    for title, tokens in nodes:
+        node = {"title": title, "node_id": str(uuid.uuid4()), "inputs": big_inputs}
+        events.append(_event("node_started", task_id, data=node))
+        for token in tokens or []:
+            events.append(_event("text_chunk", task_id, data={"text": token, "from_variable_selector": ["llm", "text"]}))
+        text = "".join(tokens or [])
+        total_tokens += len(tokens or [])
+        events.append(_event("node_finished", task_id, data={**node, "outputs": {"text": text, "answer": text}}))
+        events.append({"event": "ping"})
+    events.append(_event(
+        "message_end", task_id, conversation_id=str(uuid.uuid4()),
+        metadata={"usage": {"completion_tokens": total_tokens, "prompt_tokens": 2000}},
+    ))
+    return events
+
+
+def load_trace(path: str) -> list:
+    """Đọc trace ghi lại từ Dify (mỗi event một dòng `data: {...}`)."""
+    events = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("data:"):
+                events.append(json.loads(line[5:]))
+    return events
+
+
+def _with_task_id(events: list, task_id: str) -> list:
+    return [{**e, "task_id": task_id} if "task_id" in e else e for e in events]
+
+
+async def _pace():
+    if config.token_rate > 0:
+        delay = 1 / config.token_rate + random.uniform(0, config.jitter_ms / 1000)
+        await asyncio.sleep(delay)
+    else:
+        await asyncio.sleep(0)
+
+
+@app.post("/v1/chat-messages")
+async def chat_messages(request: Request):
+    if random.random() < config.error_rate:
+        stats["errors"] += 1
+        return JSONResponse({"code": "unavailable", "message": "mock upstream error"}, status_code=503)
+
+    auth = request.headers.get("authorization", "")
+    task_id = str(uuid.uuid4())
+    if "discuss" in auth:
+        events = _with_task_id(config.workflow_trace, task_id) if config.workflow_trace else synthetic_workflow(task_id)
+    else:
+        events = _with_task_id(config.chat_trace, task_id) if config.chat_trace else synthetic_chat(task_id)
+    drop_at = random.randrange(len(events)) if random.random() < config.drop_rate else None
+    stats["streams"] += 1
+
+    async def stream():
+        for i, event in enumerate(events):
+            if task_id in _stopped:
+                _stopped.discard(task_id)
+                return
+            if i == drop_at:
+                stats["drops"] += 1
+                raise RuntimeError("mock: đứt stream giữa chừng")
+            if event.get("event") in ("message", "text_chunk"):
+                await _pace()
+            yield b"data: " + json.dumps(event, ensure_ascii=False).encode() + b"\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+@app.post("/v1/chat-messages/{task_id}/stop")
+async def stop(task_id: str):
+    _stopped.add(task_id)
+    stats["stops"] += 1
+    return {"result": "success"}
+
+
+@app.post("/v1.0/generations")
+async def create_generation(request: Request):
+    if random.random() < config.gamma_429_rate:
+        return JSONResponse({"message": "rate limited"}, status_code=429, headers={"Retry-After": "1"})
+    await request.json()
+    generation_id = uuid.uuid4().hex[:20]
+    _generations[generation_id] = time.monotonic()
+    stats["gamma_creates"] += 1
+    return {"generationId": generation_id}
+
+
+@app.get("/v1.0/generations/{generation_id}")
+async def get_generation(generation_id: str):
+    stats["gamma_polls"] += 1
+    if random.random() < config.gamma_429_rate:
+        return JSONResponse({"message": "rate limited"}, status_code=429, headers={"Retry-After": "1"})
+    created = _generations.get(generation_id)
+    if created is None:
+        return JSONResponse({"message": "not found"}, status_code=404)
+    if time.monotonic() - created < config.gamma_seconds:
+        return {"generationId": generation_id, "status": "pending"}
+    return {
+        "generationId": generation_id,
+        "status": "completed",
+        "gammaUrl": f"https://gamma.app/docs/{generation_id}",
+        "exportUrl": f"https://assets.gamma.app/export/{generation_id}.pptx",
+    }
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--token-rate", type=float, default=config.token_rate, help="Token / giây mỗi stream, 0 = nhanh nhất có thể")
+    parser.add_argument("--jitter-ms", type=float, default=config.jitter_ms)
+    parser.add_argument("--tokens-per-agent", type=int, default=config.tokens_per_agent)
+    parser.add_argument("--error-rate", type=float, default=config.error_rate)
+    parser.add_argument("--drop-rate", type=float, default=config.drop_rate)
+    parser.add_argument("--gamma-seconds", type=float, default=config.gamma_seconds)
+    parser.add_argument("--gamma-429-rate", type=float, default=config.gamma_429_rate)
+    parser.add_argument("--chat-trace", help="File trace chat ghi lại từ Dify")
+    parser.add_argument("--workflow-trace", help="File trace workflow thảo luận ghi lại từ Dify")
+    args = parser.parse_args()
+
+    config.token_rate = args.token_rate
+    config.jitter_ms = args.jitter_ms
+    config.tokens_per_agent = args.tokens_per_agent
+    config.error_rate = args.error_rate
+    config.drop_rate = args.drop_rate
+    config.gamma_seconds = args.gamma_seconds
+    config.gamma_429_rate = args.gamma_429_rate
+    config.chat_trace = load_trace(args.chat_trace) if args.chat_trace else None
+    config.workflow_trace = load_trace(args.workflow_trace) if args.workflow_trace else None
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Microbenchmark: chi phí CPU + tỉ lệ nén của SSECompressionMiddleware (flush sau mỗi chunk) trên stream /discuss.
+
+Chạy: python -m benchmarks.sse_compression_bench [--tokens-per-agent 120] [--batch 1 4 16] [--repeat 5]
+
+Stream giả lập giống frame gửi cho client: 4 agent (start / content 2-4 ký tự tiếng Nhật / done),
+frame Insight JSON, `data: [DONE]`, mỗi frame có `id:`. `--batch N`: gộp N frame / chunk (giống SSE_COALESCE_WINDOW_MS).
+
+- ratio:      byte sau nén / byte gốc khi flush sau mỗi chunk (cách middleware chạy)
+- ratio-1shot: nén cả stream một lần (không flush) -> giới hạn dưới, cho thấy phần byte mất do flush
+- us/chunk:   CPU time trung bình để nén một chunk (tốt nhất trong --repeat lần)
+- MB/s:       byte gốc xử lý được mỗi giây CPU
+Encoding đo được tuỳ thư viện đã cài (gzip luôn có; br cần brotli, zstd cần zstandard).
+
+Trước khi đo, `check_middleware` chạy stream qua SSECompressionMiddleware với cấu hình mặc định và assert:
+header + ack được gửi ngay (không bị giữ lại), một câu /n1-talk ngắn được gửi nguyên (không phình),
+stream /discuss đầy đủ thì được nén.
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from app.core.compression import _ENCODERS, SSECompressionMiddleware, new_encoder
+from app.core.config import settings
+from app.core.sse import ACK_COMMENT, SSE_DONE, encode_frame
+from app.services.insight_parser import format_insight_response
+from benchmarks.mock_upstream import BOT_TITLES, INSIGHT_TEXT, _tokens, config
+
+
+def build_frames(tokens_per_agent: int) -> list:
+    config.tokens_per_agent = tokens_per_agent
+    frames = []
+    for title in BOT_TITLES:
+        frames.append({"bot_id": title, "event": "start", "payload": None})
+        frames += [{"bot_id": title, "event": "content", "payload": token} for token in _tokens(tokens_per_agent)]
+        frames.append({"bot_id": title, "event": "done", "payload": None})
+    insight = format_insight_response(INSIGHT_TEXT.split("[N1s Insight]", 1)[-1].strip())
+    frames.append({"bot_id": "Insight", "event": "content", "payload": insight})
+    frames.append(SSE_DONE)
+    return [b"id: %d\n" % i + encode_frame(frame) for i, frame in enumerate(frames)]
+
+
+def batched(frames: list, size: int) -> list:
+    return [b"".join(frames[i:i + size]) for i in range(0, len(frames), size)]
+
+
+def compress_stream(encoding: str, chunks: list) -> int:
+    encoder = new_encoder(encoding)
+    total = 0
+    for chunk in chunks:
+        total += len(encoder.compress(chunk))
+    return total + len(encoder.finish())
+
+
+def one_shot(encoding: str, chunks: list) -> int:
+    # Cả stream là một chunk: không có flush giữa các frame
+    return compress_stream(encoding, [b"".join(chunks)])
+
+
+def bench(encoding: str, chunks: list, repeat: int):
+    best = float("inf")
+    size = 0
+    for _ in range(repeat):
+        start = time.process_time()
+        size = compress_stream(encoding, chunks)
+        best = min(best, time.process_time() - start)
+    return best, size
+
+
+async def run_middleware(encoding: str, path: str, chunks: list):
+    """
+    Chạy chunks qua SSECompressionMiddleware như một response SSE.
+    Trả về (content-encoding, byte gửi đi, số message đã gửi trước khi app gửi chunk thứ 2).
+    """
+    sent = []
+    before_second = None
+
+    async def app(scope, receive, send):
+        nonlocal before_second
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/event-stream")]})
+        for i, chunk in enumerate(chunks):
+            if i == 1:
+                before_second = len(sent)
+            await send({"type": "http.response.body", "body": chunk, "more_body": i < len(chunks) - 1})
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "path": path, "headers": [(b"accept-encoding", encoding.encode())]}
+    await SSECompressionMiddleware(app)(scope, None, send)
+    headers = dict(sent[0]["headers"])
+    return headers.get(b"content-encoding"), sum(len(m.get("body", b"")) for m in sent[1:]), before_second
+
+
+def check_middleware(frames: list):
+    small = [ACK_COMMENT, encode_frame({"text": "こんにちは"}), encode_frame(SSE_DONE)]
+    settings.SSE_COMPRESSION_ENABLED = True
+    for encoding in _ENCODERS:
+        content_encoding, size, _ = asyncio.run(run_middleware(encoding, "/api/n1-talk", small))
+        assert content_encoding is None and size == sum(map(len, small)), (encoding, content_encoding, size)
+        content_encoding, size, before_second = asyncio.run(run_middleware(encoding, "/api/discuss", [ACK_COMMENT, *frames]))
+        assert content_encoding == encoding.encode() and size < sum(map(len, frames)), (encoding, content_encoding, size)
+        # Header + ack đã tới client trước khi app gửi frame tiếp theo
+        assert before_second == 2, (encoding, before_second)
+    print("middleware check ok: ack gửi ngay, /n1-talk ngắn gửi nguyên, stream /discuss được nén")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--tokens-per-agent", type=int, default=120)
+    arg_parser.add_argument("--batch", type=int, nargs="+", default=[1, 4, 16], help="Số frame mỗi chunk ASGI")
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    args = arg_parser.parse_args()
+
+    random.seed(args.seed)
+    frames = build_frames(args.tokens_per_agent)
+    raw = sum(len(frame) for frame in frames)
+    check_middleware(frames)
+    print(f"{len(frames)} frame, {raw} byte gốc, encoding: {', '.join(_ENCODERS)}")
+    print(f"{'encoding':>8} {'batch':>5} {'chunks':>6} {'bytes':>8} {'ratio':>6} {'ratio-1shot':>11} {'us/chunk':>9} {'MB/s':>7}")
+    for encoding in _ENCODERS:
+        for size in args.batch:
+            chunks = batched(frames, size)
+            cpu, compressed = bench(encoding, chunks, args.repeat)
+            print(
+                f"{encoding:>8} {size:>5} {len(chunks):>6} {compressed:>8} {compressed / raw:>6.3f} "
+                f"{one_shot(encoding, chunks) / raw:>11.3f} {cpu / len(chunks) * 1e6:>9.1f} "
+                f"{raw / cpu / 1e6 if cpu else float('inf'):>7.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
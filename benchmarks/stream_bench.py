@@ -0,0 +1,245 @@
+"""
+Benchmark stream SSE end-to-end: app FastAPI thật + Dify / Gamma giả (benchmarks/mock_upstream.py).
+
+Chạy: python -m benchmarks.stream_bench [--endpoint discuss] [--clients 1 10 50] [--token-rate 50] [--out result.json]
+So sánh với lần chạy trước: python -m benchmarks.stream_bench --baseline result_old.json
+
+Với mỗi mức N client đồng thời, đo:
+- first token p50 / p99: từ lúc gửi request tới frame nội dung đầu tiên (text / content / delta)
+- frames/s: tổng số frame SSE nhận được / thời gian chạy
+- CPU / stream: CPU time (user + sys) của process app chia cho số stream
+- RSS / open stream: (RSS đỉnh khi N stream đang mở - RSS lúc nghỉ) / N
+Đọc CPU / RSS từ /proc nên chỉ chạy được trên Linux.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# Frame có nội dung (không tính start / done / [DONE])
+_CONTENT_MARKERS = (b'"text"', b'"event":"content"', b'"event":"delta"')
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime, stime là trường 14, 15 (tính từ 1) -> index 11, 12 sau khi bỏ "pid (comm)"
+    return (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+
+
+def rss_bytes(pid: int) -> int:
+    with open(f"/proc/{pid}/statm") as f:
+        return int(f.read().split()[1]) * _PAGE_SIZE
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def _wait_ready(url: str, timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} không khởi động được")
+
+
+async def run_client(client: httpx.AsyncClient, url: str, body: dict) -> dict:
+    started = time.perf_counter()
+    first_token = None
+    frames = 0
+    error = None
+    try:
+        async with client.stream("POST", url, json=body) as response:
+            if response.status_code != 200:
+                return {"error": f"HTTP {response.status_code}", "frames": 0, "first_token": None, "duration": 0.0}
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                frames += 1
+                raw = line.encode()
+                if first_token is None and any(m in raw for m in _CONTENT_MARKERS):
+                    first_token = time.perf_counter() - started
+                if raw.startswith(b'data: {"error"'):
+                    error = line[6:200]
+    except httpx.HTTPError as e:
+        error = f"{type(e).__name__}: {e}"
+    return {"error": error, "frames": frames, "first_token": first_token, "duration": time.perf_counter() - started}
+
+
+async def run_level(app_url: str, app_pid: int, endpoint: str, clients: int) -> dict:
+    url = f"{app_url}/api/{'discuss' if endpoint == 'discuss' else 'n1-talk'}"
+    limits = httpx.Limits(max_connections=clients + 10, max_keepalive_connections=clients + 10)
+    timeout = httpx.Timeout(600.0, connect=10.0)
+
+    rss_idle = rss_bytes(app_pid)
+    cpu_before = cpu_seconds(app_pid)
+    peak_rss = rss_idle
+    done = asyncio.Event()
+
+    async def sample_rss():
+        nonlocal peak_rss
+        while not done.is_set():
+            peak_rss = max(peak_rss, rss_bytes(app_pid))
+            await asyncio.sleep(0.05)
+
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        sampler = asyncio.create_task(sample_rss())
+        started = time.perf_counter()
+        results = await asyncio.gather(*(
+            run_client(client, url, {
+                # Query khác nhau để không dính cache / single-flight
+                "query": f"今年のAI開発戦略について {i}-{time.time_ns()}",
+                "user_id": f"bench-{i}",
+                "target_persona": "TECH" if endpoint == "n1-talk" else "DISCUSS",
+                "mode": "response",
+                "conversation_id": "",
+            })
+            for i in range(clients)
+        ))
+        wall = time.perf_counter() - started
+        done.set()
+        await sampler
+
+    cpu = cpu_seconds(app_pid) - cpu_before
+    first_tokens = [r["first_token"] for r in results if r["first_token"] is not None]
+    total_frames = sum(r["frames"] for r in results)
+    errors = [r["error"] for r in results if r["error"]]
+    return {
+        "clients": clients,
+        "wall_seconds": round(wall, 3),
+        "first_token_p50_ms": round(percentile(first_tokens, 50) * 1000, 2),
+        "first_token_p99_ms": round(percentile(first_tokens, 99) * 1000, 2),
+        "frames_total": total_frames,
+        "frames_per_second": round(total_frames / wall, 1) if wall else 0.0,
+        "cpu_ms_per_stream": round(cpu * 1000 / clients, 2),
+        "rss_idle_mb": round(rss_idle / 2**20, 1),
+        "rss_kb_per_open_stream": round(max(0, peak_rss - rss_idle) / 1024 / clients, 1),
+        "errors": len(errors),
+        "error_samples": errors[:3],
+    }
+
+
+def _start(cmd: list, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def compare(current: dict, baseline_path: str):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {r["clients"]: r for r in json.load(f)["results"]}
+    keys = ["first_token_p50_ms", "first_token_p99_ms", "frames_per_second", "cpu_ms_per_stream", "rss_kb_per_open_stream"]
+    print(f"\nSo với {baseline_path}:")
+    for result in current["results"]:
+        old = baseline.get(result["clients"])
+        if old is None:
+            continue
+        deltas = []
+        for key in keys:
+            if old.get(key):
+                deltas.append(f"{key}={(result[key] - old[key]) / old[key] * 100:+.1f}%")
+        print(f"  N={result['clients']}: " + ", ".join(deltas))
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--endpoint", choices=["discuss", "n1-talk"], default="discuss")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--token-rate", type=float, default=50.0, help="Token / giây mỗi stream của mock, 0 = nhanh nhất")
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    parser.add_argument("--tokens-per-agent", type=int, default=60)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--app-env", nargs="*", default=[], help="Biến môi trường thêm cho app, vd. SSE_COALESCE_WINDOW_MS=20")
+    parser.add_argument("--out", help="Ghi kết quả ra file JSON")
+    parser.add_argument("--baseline", help="File JSON của lần chạy trước để so sánh")
+    args = parser.parse_args()
+
+    mock_port, app_port = _free_port(), _free_port()
+    mock = _start([
+        sys.executable, "-m", "benchmarks.mock_upstream", "--port", str(mock_port),
+        "--token-rate", str(args.token_rate), "--jitter-ms", str(args.jitter_ms),
+        "--tokens-per-agent", str(args.tokens_per_agent),
+        "--error-rate", str(args.error_rate), "--drop-rate", str(args.drop_rate),
+    ], os.environ.copy())
+
+    app_env = {
+        **os.environ,
+        "DIFY_API_URL": f"http://127.0.0.1:{mock_port}/v1",
+        "GAMMA_API_URL": f"http://127.0.0.1:{mock_port}/v1.0",
+        "DIFY_KEY_DISCUSS": "mock-discuss",
+        "DIFY_KEY_TECH_RESPONSE": "mock-chat",
+        # Benchmark đo đường stream, không đo admission / cache
+        "ADMISSION_ENABLED": "false",
+        "N1_TALK_CACHE_ENABLED": "false",
+        "HTTP_MAX_CONNECTIONS": str(max(args.clients) * 2 + 10),
+        "HTTP_MAX_KEEPALIVE_CONNECTIONS": str(max(args.clients) + 10),
+    }
+    for item in args.app_env:
+        key, _, value = item.partition("=")
+        app_env[key] = value
+    app = _start([
+        sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(app_port), "--log-level", "warning",
+    ], app_env)
+
+    try:
+        app_url = f"http://127.0.0.1:{app_port}"
+        await _wait_ready(f"http://127.0.0.1:{mock_port}/stats")
+        await _wait_ready(app_url + "/")
+        # Warm-up: connection pool, import lazy
+        await run_level(app_url, app.pid, args.endpoint, 1)
+
+        results = []
+        print(f"{'N':>5} {'p50 ms':>8} {'p99 ms':>8} {'frames/s':>9} {'CPU ms/stream':>14} {'RSS KB/stream':>14} {'errors':>7}")
+        for clients in args.clients:
+            r = await run_level(app_url, app.pid, args.endpoint, clients)
+            results.append(r)
+            print(
+                f"{r['clients']:>5} {r['first_token_p50_ms']:>8} {r['first_token_p99_ms']:>8} {r['frames_per_second']:>9} "
+                f"{r['cpu_ms_per_stream']:>14} {r['rss_kb_per_open_stream']:>14} {r['errors']:>7}"
+            )
+    finally:
+        app.terminate()
+        mock.terminate()
+        app.wait(10)
+        mock.wait(10)
+
+    output = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_rev": subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip(),
+        "python": sys.version.split()[0],
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "baseline")},
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(output, f, ensure_ascii=False, indent=2)
+        print(f"\nĐã ghi kết quả: {args.out}")
+    if args.baseline:
+        compare(output, args.baseline)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
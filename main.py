@@ -1,14 +1,52 @@
 import argparse
+import importlib.util
+import logging
+import logging.config
+import os
 import uvicorn
+from uvicorn.config import LOGGING_CONFIG
+from app.core.config import settings
+
+
+def _installed(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--host", default=settings.SERVER_HOST)
+    parser.add_argument("--port", type=int, default=settings.SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=settings.SERVER_WORKERS)
+    parser.add_argument("--backlog", type=int, default=settings.SERVER_BACKLOG)
+    parser.add_argument("--keep-alive", type=int, default=settings.SERVER_KEEPALIVE_TIMEOUT)
+    parser.add_argument("--graceful-timeout", type=float, default=settings.SERVER_GRACEFUL_TIMEOUT)
+    parser.add_argument("--reload", action="store_true", default=settings.SERVER_RELOAD, help="Chế độ dev: tự reload khi sửa code (1 process)")
     args = parser.parse_args()
 
-    uvicorn.run(
-        "app.main:app",
-        host="0.0.0.0",
-        port=args.port,
-        reload=True
-    )
\ No newline at end of file
+    # Lifespan (drain stream SSE) đọc SERVER_GRACEFUL_TIMEOUT trong từng worker: truyền qua env để khớp tham số dòng lệnh
+    os.environ["SERVER_GRACEFUL_TIMEOUT"] = str(args.graceful_timeout)
+    settings.SERVER_GRACEFUL_TIMEOUT = args.graceful_timeout
+
+    if args.reload:
+        # Dev: file watcher + 1 process như trước
+        uvicorn.run("app.main:app", host=args.host, port=args.port, reload=True)
+    else:
+        # Production: nhiều worker, uvloop / httptools nếu đã cài, tắt server có drain stream
+        loop = "uvloop" if _installed("uvloop") else "asyncio"
+        http = "httptools" if _installed("httptools") else "h11"
+        logging.config.dictConfig(LOGGING_CONFIG)
+        logging.getLogger("uvicorn.error").info(
+            "Production mode: workers=%d, loop=%s, http=%s, graceful_timeout=%.0fs",
+            args.workers, loop, http, args.graceful_timeout,
+        )
+        uvicorn.run(
+            "app.main:app",
+            host=args.host,
+            port=args.port,
+            workers=args.workers,
+            loop=loop,
+            http=http,
+            backlog=args.backlog,
+            timeout_keep_alive=args.keep_alive,
+            timeout_graceful_shutdown=args.graceful_timeout,
+        )